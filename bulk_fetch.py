@@ -0,0 +1,139 @@
+'''
+Concurrent fetch, from a single process, of the datasets of a fetch manifest.
+
+The manifest lists the datasets fetched by the fetch_* rules of the snakefile,
+each entry being a dict with the rule name, the Nexus id (with its optional tag
+or rev) and the output path of the rule. The datasets are retrieved and
+downloaded in-process with forge.download by a pool of threads bounding the
+number of concurrent downloads, so that the Python, kgforge import and forge
+config startup of bba-data-fetch is paid once rather than once per dataset.
+Each worker thread builds its own forge, so that no HTTP session is shared
+between threads.
+The distribution fetched is selected as in default_fetch (bba-data-fetch without
+--favor): the single distribution of the Resource, saved under the output path
+of the rule. The Resources with several distributions need a --favor, so they
+are not fetched here but by their own fetch rule.
+All the messages are written in the log of the calling rule, prefixed by the fetch
+rule of the dataset.
+
+'''
+
+import os
+import shutil
+import tempfile
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from dataset_cache import split_version, distribution_digests, cache_key
+
+# number of datasets downloaded concurrently
+CONNECTIONS = 8
+# arguments of bba-data-fetch in default_fetch, part of the dataset cache key
+DEFAULT_FETCH_ARGS = ["--verbose"]
+
+
+def select_distribution(res, nexus_id):
+    """The distribution fetched by default_fetch for the Resource"""
+    distribution = getattr(res, "distribution", None)
+    if distribution is None:
+        raise Exception(f"The Resource {nexus_id} has no distribution")
+    if isinstance(distribution, list):
+        # selected by bba-data-fetch with a --favor, not available in default_fetch
+        raise Exception(f"The Resource {nexus_id} has {len(distribution)} distributions, "
+                        "it must be fetched by its fetch rule with a --favor")
+    return distribution
+
+
+def download(forge, res, distribution, output, tmp_dir):
+    """Download the distribution of a Resource in tmp_dir, then move it to output"""
+    forge.download(res, "distribution.contentUrl", tmp_dir, overwrite=True)
+    downloaded = os.path.join(tmp_dir, distribution.name)
+    if not os.path.isfile(downloaded):
+        raise Exception(f"The distribution {distribution.name} was not downloaded in {tmp_dir}")
+    os.replace(downloaded, output)
+
+
+def fetch_dataset(forge, entry, log, cache=None, cache_lock=None):
+    """
+    Fetch the dataset of a manifest entry.
+
+    Args:
+        forge: the forge of the Nexus project of the dataset, used by the calling thread only
+        entry: the manifest entry {"rule", "nexus_id", "output"}
+        log: function writing a message to the log
+        cache: optional DatasetCache, looked up before downloading
+        cache_lock: lock of the cache, shared by the threads
+    """
+    nexus_id, output = entry["nexus_id"], entry["output"]
+    res_id, version = split_version(nexus_id)
+    res = forge.retrieve(res_id, version=version)
+    if res is None:
+        raise Exception(f"The Resource {nexus_id} could not be retrieved")
+    distribution = select_distribution(res, nexus_id)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    if cache is None:
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output)))
+        try:
+            download(forge, res, distribution, output, tmp_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        log(f"{nexus_id} fetched in {output}")
+        return
+
+    key = cache_key(nexus_id, res._store_metadata._rev, distribution_digests(res), DEFAULT_FETCH_ARGS)
+    with cache_lock:
+        if cache.materialize(key, output):
+            log(f"{nexus_id} found in the cache {cache.entry_path(key)}")
+            return
+
+    tmp_dir = cache.mkdtemp()
+    try:
+        tmp_out = os.path.join(tmp_dir, os.path.basename(output))
+        download(forge, res, distribution, tmp_out, tmp_dir)
+        with cache_lock:
+            cache.store(key, tmp_out)
+            for path in cache.evict(keep=[key]):
+                log(f"Evicted from the cache: {path}")
+            if not cache.materialize(key, output):
+                raise Exception(f"{nexus_id} could not be materialized from the cache to {output}")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    log(f"{nexus_id} fetched into the cache {cache.entry_path(key)}")
+
+
+def fetch_datasets(create_forge, manifest, connections=CONNECTIONS, cache=None, log=print):
+    """
+    Fetch concurrently the datasets of the manifest, with at most `connections` downloads at once.
+    `create_forge` is called once per worker thread to build its forge.
+    Return the list of the rules whose dataset could not be fetched.
+    """
+    cache_lock = threading.Lock()
+    log_lock = threading.Lock()
+    # Each worker thread gets its own forge so that no HTTP session is shared between threads
+    worker_forges = threading.local()
+
+    def get_worker_forge():
+        if not hasattr(worker_forges, "forge"):
+            worker_forges.forge = create_forge()
+        return worker_forges.forge
+
+    def fetch(entry):
+        def log_entry(message):
+            with log_lock:
+                log(f"{datetime.now().strftime('%Y-%m-%dT%H:%M:%S')} [{entry['rule']}] {message}")
+        try:
+            fetch_dataset(get_worker_forge(), entry, log_entry, cache, cache_lock)
+            return None
+        except Exception as error:
+            log_entry(f"Error when fetching {entry['nexus_id']}: {error!r}")
+            return entry["rule"]
+
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        failed = [rule for rule in executor.map(fetch, manifest) if rule is not None]
+
+    log(f"{len(manifest) - len(failed)}/{len(manifest)} datasets fetched")
+    for rule in failed:
+        log(f"The dataset of {rule} could not be fetched")
+    return failed
@@ -0,0 +1,498 @@
+'''
+Summary statistics of the ME-type densities of a CellCompositionVolume.
+
+The annotation is indexed once: each voxel is given the position of its label
+among the annotation labels, as a compact code. The per-region totals of each
+density are then computed with a bincount over the codes, chunk by chunk of the
+density, instead of masking the annotation for every density. The annotation and
+the densities are read by chunks (raw ones memory-mapped, gzip ones decompressed
+block by block), so that they are never loaded entirely in memory.
+
+With several processes, the index is placed once in shared memory, which the
+workers attach to.
+
+The statistics of each density can be cached (SummaryCache), so that only
+the densities that changed are computed again.
+
+The densities of the CellCompositionVolume are resolved to local files
+(DensityResolver): from the push manifest, from the digests of the local files,
+or downloaded from Nexus in a size-bounded LRU cache.
+
+The resulting CellCompositionSummary has the same statistics as the one produced by
+blue_cwl.statistics.atlas_densities_composition_summary: the same regions and counts,
+and the same densities up to a relative 1e-12, the float64 sums being accumulated in
+another order (see the golden summary of tests/test_cellCompSummary_payload.py).
+
+'''
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from nrrd_volume import NrrdVolume, open_volume, iter_voxel_chunks, CHUNK_ELEMENTS
+
+region_url_base = "http://api.brain-map.org/api/v2/data/Structure/"
+# default maximum size of the densities downloaded from Nexus kept in the local cache
+density_cache_size = 50 * 1024**3
+
+
+class AnnotationIndex:
+    """
+    Index of the labels of an annotation volume.
+
+    Args:
+        annotation: annotation volume, where each voxel contains a region id
+            (voxcell.VoxelData, or NrrdVolume read by chunks)
+        chunk_voxels: number of voxels of the annotation read at once
+
+    Attributes:
+        labels: region ids present in the annotation (0 excluded)
+        voxel_counts: number of voxels of each label
+        codes: for each voxel (in order 'F'), 1 + the position of its label in labels, 0 if empty
+        voxel_volume: volume of a voxel (in the unit of the annotation voxel dimensions, cubed)
+    """
+
+    shared_arrays = ["codes", "labels", "voxel_counts"]
+
+    def __init__(self, annotation=None, chunk_voxels=CHUNK_ELEMENTS):
+        self._shm = None
+        if annotation is None:
+            return
+        if isinstance(annotation, NrrdVolume):
+            self.shape = annotation.shape
+            volume = annotation
+        else:
+            self.shape = annotation.raw.shape
+            volume = annotation.raw
+        self.voxel_volume = annotation.voxel_volume
+        # the codes of a few thousand labels fit in 16 bits, a quarter of a uint64 annotation
+        codes = np.zeros(int(np.prod(self.shape)), dtype=np.uint16)
+        label_codes = {0: 0}
+        start = 0
+        for chunk in iter_voxel_chunks(volume, chunk_voxels):
+            # factorize (hash based) is faster than np.unique (sort based)
+            chunk_codes, chunk_labels = pd.factorize(chunk)
+            lut = np.array([label_codes.setdefault(int(label), len(label_codes)) for label in chunk_labels])
+            if len(label_codes) > np.iinfo(codes.dtype).max:
+                codes = codes.astype(np.uint32)
+            codes[start:start + chunk.size] = lut[chunk_codes]
+            start += chunk.size
+        self.codes = codes
+        self.labels = np.array(list(label_codes)[1:], dtype=np.int64)
+        self.voxel_counts = np.bincount(codes, minlength=self.labels.size + 1)[1:]
+
+    def to_shared_memory(self):
+        """
+        Copy the index arrays in a new shared memory block.
+
+        Returns:
+            The SharedMemory (to be closed and unlinked by the caller) and the
+            description of the index to pass to from_shared_memory.
+        """
+        arrays = {name: np.ascontiguousarray(getattr(self, name)) for name in self.shared_arrays}
+        layout = {}
+        offset = 0
+        for name, array in arrays.items():
+            layout[name] = (offset, array.dtype.str, array.shape)
+            # 64-byte aligned arrays
+            offset += -(-array.nbytes // 64) * 64
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for name, array in arrays.items():
+            array_offset, dtype, shape = layout[name]
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=array_offset)[...] = array
+        description = {"name": shm.name, "layout": layout, "shape": self.shape, "voxel_volume": self.voxel_volume}
+        return shm, description
+
+    @classmethod
+    def from_shared_memory(cls, description):
+        """Attach to an index in shared memory, without copying its arrays"""
+        index = cls()
+        index._shm = shared_memory.SharedMemory(name=description["name"])
+        index.shape = tuple(description["shape"])
+        index.voxel_volume = description["voxel_volume"]
+        for name, (offset, dtype, shape) in description["layout"].items():
+            array = np.ndarray(shape, dtype=dtype, buffer=index._shm.buf, offset=offset)
+            array.flags.writeable = False
+            setattr(index, name, array)
+        return index
+
+    def region_sums(self, volume, chunk_voxels=CHUNK_ELEMENTS):
+        """
+        Sum of the values of volume in each label, in float64.
+
+        Args:
+            volume: NrrdVolume read by chunks, or in-memory (or memory-mapped) array
+            chunk_voxels: number of voxels of the volume read at once
+        """
+        if volume.shape[:len(self.shape)] != self.shape:
+            raise Exception(f"The shape of the density {volume.shape} does not match "
+                            f"the shape of the annotation {self.shape}")
+        sums = np.zeros(self.labels.size + 1)
+        start = 0
+        for chunk in iter_voxel_chunks(volume, chunk_voxels):
+            sums += np.bincount(self.codes[start:start + chunk.size], weights=chunk, minlength=sums.size)
+            start += chunk.size
+        return sums[1:]
+
+
+def _density_rows(annotation_index, label_acronyms, mtype, etype, nrrd_path):
+    sums = annotation_index.region_sums(open_volume(nrrd_path))
+    # ignore the regions where the density is null
+    nonzero = np.flatnonzero(sums != 0.0)
+    total_densities = sums[nonzero]
+    cell_counts = np.round(total_densities * annotation_index.voxel_volume * 1e-9)
+    voxel_counts = annotation_index.voxel_counts[nonzero]
+    return [(label_acronyms[label_index], mtype, etype,
+             total_densities[i] / voxel_counts[i], int(cell_counts[i]))
+            for i, label_index in enumerate(nonzero)]
+
+
+def create_summary(density_distribution, region_map, annotation, processes=1, cache=None):
+    """
+    Compute the CellCompositionSummary of a density distribution.
+
+    Args:
+        density_distribution: pandas.DataFrame of the densities, with the columns
+            mtype, mtype_url, etype, etype_url and path (as materialized by
+            blue_cwl.staging.materialize_density_distribution)
+        region_map: voxcell.RegionMap of the regions hierarchy
+        annotation: annotation volume (voxcell.VoxelData, or NrrdVolume read by chunks)
+        processes: number of processes computing the statistics of the densities in parallel
+        cache: optional SummaryCache of the statistics of the densities already computed
+
+    Returns:
+        The CellCompositionSummary, as a dict.
+    """
+    densities = list(density_distribution[["mtype", "etype", "path"]].itertuples(index=False, name=None))
+    density_rows = [None] * len(densities)
+    if cache:
+        for i, (mtype, etype, nrrd_path) in enumerate(densities):
+            cached_stats = cache.get(nrrd_path)
+            if cached_stats is not None:
+                density_rows[i] = [(region, mtype, etype, density, cell_count)
+                                   for (region, density, cell_count) in cached_stats]
+        print(f"Statistics of {len(densities) - density_rows.count(None)} nrrd volumes found in the cache")
+    to_compute = [i for i, rows in enumerate(density_rows) if rows is None]
+    print(f"Statistics from {len(to_compute)} nrrd volumes will be calculated")
+
+    if to_compute:
+        annotation_index = AnnotationIndex(annotation)
+        # region membership of the labels, so that the workers do not need the region map
+        label_acronyms = [region_map.get(int(label), "acronym") for label in annotation_index.labels]
+        densities_to_compute = [densities[i] for i in to_compute]
+
+        if processes > 1:
+            # The workers attach to the annotation index in shared memory, zero-copy.
+            # The raw densities are memory-mapped, so that their pages are shared too.
+            shm, description = annotation_index.to_shared_memory()
+            del annotation_index
+            try:
+                with multiprocessing.Pool(processes=processes, initializer=_init_worker,
+                                          initargs=(description, label_acronyms)) as pool:
+                    computed_rows = pool.imap(_worker_density_rows, densities_to_compute)
+                    _collect_rows(computed_rows, to_compute, densities, density_rows, cache)
+            finally:
+                shm.close()
+                shm.unlink()
+        else:
+            computed_rows = (_density_rows(annotation_index, label_acronyms, *density)
+                             for density in densities_to_compute)
+            _collect_rows(computed_rows, to_compute, densities, density_rows, cache)
+
+    if cache:
+        cache.save()
+
+    return summary_from_rows([row for rows in density_rows for row in rows], density_distribution, region_map)
+
+
+def _collect_rows(computed_rows, to_compute, densities, density_rows, cache):
+    for count, (i, rows) in enumerate(zip(to_compute, computed_rows)):
+        density_rows[i] = rows
+        if cache:
+            cache.put(densities[i][2], [(region, density, cell_count) for (region, _, _, density, cell_count) in rows])
+        print(f"Completed [{count + 1}|{len(to_compute)}]: {densities[i]}")
+
+
+class SummaryCache:
+    """
+    Content-addressed cache of the per-region statistics of the densities.
+
+    The statistics of a density are stored in <cache_dir>/<key>.json, where the key is
+    derived from the digests of the density, the annotation and the hierarchy files.
+    The digests are memoized in <cache_dir>/digests.json by file path, size and
+    modification time, so that unchanged files are not hashed again.
+
+    Args:
+        cache_dir: directory of the cache, typically in WORKING_DIR
+        annotation_path: path of the annotation volume
+        hierarchy_path: path of the hierarchy
+    """
+
+    def __init__(self, cache_dir, annotation_path, hierarchy_path):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._digests_path = os.path.join(cache_dir, "digests.json")
+        self._digests = {}
+        if os.path.isfile(self._digests_path):
+            try:
+                with open(self._digests_path, "r") as digests_file:
+                    self._digests = json.load(digests_file)
+            except ValueError:
+                self._digests = {}
+        self._context = f"{self.file_digest(annotation_path)}:{self.file_digest(hierarchy_path)}"
+
+    def file_digest(self, path):
+        """SHA-256 digest of a file, memoized by path, size and modification time"""
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        entry = self._digests.get(path)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return entry["digest"]
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(chunk)
+        self._digests[path] = {"size": stat.st_size, "mtime": stat.st_mtime, "digest": sha256.hexdigest()}
+        return self._digests[path]["digest"]
+
+    def _entry_path(self, nrrd_path):
+        key = hashlib.sha256(f"{self.file_digest(nrrd_path)}:{self._context}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, nrrd_path):
+        """The (region acronym, density, count) statistics of the density, None if not in the cache"""
+        entry_path = self._entry_path(nrrd_path)
+        if not os.path.isfile(entry_path):
+            return None
+        try:
+            with open(entry_path, "r") as entry_file:
+                return [tuple(stats) for stats in json.load(entry_file)]
+        except ValueError:
+            return None
+
+    def put(self, nrrd_path, stats):
+        entry_path = self._entry_path(nrrd_path)
+        tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as entry_file:
+            json.dump(stats, entry_file)
+        os.replace(tmp_path, entry_path)
+
+    def paths_by_digest(self):
+        """The local files whose digest is known, by digest"""
+        return {entry["digest"]: path for path, entry in self._digests.items()}
+
+    def save(self):
+        """Save the memoized digests"""
+        tmp_path = f"{self._digests_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as digests_file:
+            json.dump(self._digests, digests_file)
+        os.replace(tmp_path, self._digests_path)
+
+
+class DensityResolver:
+    """
+    Resolve the densities of a CellCompositionVolume (@id and _rev) to local files.
+
+    A density is looked up, in order:
+    - in the push manifest of the densities (file -> @id, _rev), if its file still exists;
+    - in the download cache;
+    - in the digest index of the local files, from the digest of its Nexus distribution;
+    - otherwise its distribution is downloaded from Nexus into the download cache. The
+      least recently used files are evicted when the cache exceeds cache_size bytes.
+
+    Args:
+        push_manifest: optional path of the JSON manifest of the pushed densities
+        digest_index: optional mapping between digests and local files
+        cache_dir: directory of the download cache
+        cache_size: maximum size of the download cache, in bytes
+        forge_factory: function returning the KnowledgeGraphForge used to retrieve and
+            download the densities, only called if needed
+    """
+
+    def __init__(self, push_manifest=None, digest_index=None, cache_dir=None,
+                 cache_size=density_cache_size, forge_factory=None):
+        self.local_paths = {}
+        if push_manifest:
+            with open(push_manifest, "r") as manifest_file:
+                for path, entry in json.load(manifest_file).items():
+                    self.local_paths[(entry["@id"], int(entry["_rev"]))] = path
+        self.digest_index = digest_index or {}
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.cache_size = cache_size
+        self._forge_factory = forge_factory
+        self._forge = None
+        self._used = set()
+
+    @property
+    def forge(self):
+        if self._forge is None:
+            if self._forge_factory is None:
+                raise Exception("The densities not available locally can not be downloaded without a forge")
+            self._forge = self._forge_factory()
+        return self._forge
+
+    def _cache_path(self, density_id, rev):
+        return os.path.join(self.cache_dir, f"{hashlib.sha256(density_id.encode('utf-8')).hexdigest()[:32]}_{rev}.nrrd")
+
+    def resolve(self, density_id, rev):
+        """Local path of the density file"""
+        rev = int(rev)
+        local_path = self.local_paths.get((density_id, rev))
+        if local_path and os.path.isfile(local_path):
+            return local_path
+
+        if self.cache_dir:
+            cache_path = self._cache_path(density_id, rev)
+            if os.path.isfile(cache_path):
+                self._touch(cache_path)
+                return cache_path
+
+        resource = self.forge.retrieve(density_id, version=rev)
+        if resource is None:
+            raise Exception(f"Density {density_id} at revision {rev} can not be retrieved")
+        distribution = resource.distribution[0] if isinstance(resource.distribution, list) else resource.distribution
+        digest = getattr(getattr(distribution, "digest", None), "value", None)
+        local_path = self.digest_index.get(digest)
+        if local_path and os.path.isfile(local_path):
+            return local_path
+
+        if not self.cache_dir:
+            raise Exception(f"Density {density_id} at revision {rev} is not available locally "
+                            "and no download cache is provided")
+        return self._download(resource, cache_path)
+
+    def _download(self, resource, cache_path):
+        download_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".download_")
+        try:
+            print(f"Downloading density {resource.id} in {cache_path}")
+            self.forge.download(resource, "distribution.contentUrl", download_dir, overwrite=True)
+            downloaded = os.listdir(download_dir)
+            if len(downloaded) != 1:
+                raise Exception(f"{len(downloaded)} files downloaded for density {resource.id}, expected 1")
+            os.replace(os.path.join(download_dir, downloaded[0]), cache_path)
+        finally:
+            shutil.rmtree(download_dir, ignore_errors=True)
+        self._touch(cache_path)
+        self._evict()
+        return cache_path
+
+    def _touch(self, cache_path):
+        # only the access time records the use, the modification time is kept for the digest memo
+        os.utime(cache_path, (time.time(), os.stat(cache_path).st_mtime))
+        self._used.add(cache_path)
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(".nrrd"):
+                stat = entry.stat()
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+        total_size = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total_size <= self.cache_size:
+                break
+            # the densities of the current summary are kept
+            if path in self._used:
+                continue
+            os.remove(path)
+            total_size -= size
+
+
+def materialize_density_distribution(volume_dict, resolver, output_file=None):
+    """
+    Build the density distribution of a CellCompositionVolume payload with local density files.
+
+    Returns:
+        pandas.DataFrame with the columns mtype, etype, mtype_url, etype_url and path,
+        as blue_cwl.staging.materialize_density_distribution.
+    """
+    rows = {}
+    for mtype_data in volume_dict["hasPart"]:
+        for etype_data in mtype_data["hasPart"]:
+            key = (mtype_data["@id"], etype_data["@id"])
+            if key in rows:
+                continue
+            density = etype_data["hasPart"][0]
+            rows[key] = (mtype_data["label"], etype_data["label"], mtype_data["@id"], etype_data["@id"],
+                         resolver.resolve(density["@id"], density["_rev"]))
+
+    result = pd.DataFrame(list(rows.values()), columns=["mtype", "etype", "mtype_url", "etype_url", "path"])
+    if output_file:
+        result.to_parquet(path=output_file)
+    return result
+
+
+_worker_annotation_index = None
+_worker_label_acronyms = None
+
+
+def _init_worker(description, label_acronyms):
+    global _worker_annotation_index, _worker_label_acronyms
+    _worker_annotation_index = AnnotationIndex.from_shared_memory(description)
+    _worker_label_acronyms = label_acronyms
+
+
+def _worker_density_rows(density):
+    return _density_rows(_worker_annotation_index, _worker_label_acronyms, *density)
+
+
+def summary_from_rows(rows, density_distribution, region_map):
+    """
+    Serialize the (region acronym, mtype, etype, density, count) statistics rows
+    in the CellCompositionSummary format.
+    """
+    mtype_urls, etype_urls = {}, {}
+    for (mtype, mtype_url, etype, etype_url) in density_distribution[
+            ["mtype", "mtype_url", "etype", "etype_url"]].drop_duplicates().itertuples(index=False, name=None):
+        mtype_urls[mtype] = mtype_url
+        etype_urls[etype] = etype_url
+
+    nested = {}
+    for (region, mtype, etype, density, count) in rows:
+        etypes = nested.setdefault(region, {}).setdefault(mtype, {})
+        if etype in etypes:
+            raise Exception(f"Several statistics for region {region}, mtype {mtype} and etype {etype}")
+        etypes[etype] = (density, count)
+
+    summary = {
+        "version": 1,
+        "unitCode": {
+            "density": "mm^-3",
+        },
+        "hasPart": {},
+    }
+    for region in sorted(nested):
+        region_id = next(iter(region_map.find(region, "acronym")))
+        mtypes_part = {}
+        for mtype in sorted(nested[region]):
+            etypes_part = {}
+            for etype in sorted(nested[region][mtype]):
+                density, count = nested[region][mtype][etype]
+                etypes_part[etype_urls[etype]] = {
+                    "label": etype,
+                    "about": "EType",
+                    "composition": {
+                        "neuron": {"density": float(density), "count": count},
+                    },
+                }
+            mtypes_part[mtype_urls[mtype]] = {
+                "label": mtype,
+                "about": "MType",
+                "hasPart": etypes_part,
+            }
+        summary["hasPart"][f"{region_url_base}{region_id}"] = {
+            "label": region_map.get(region_id, "name"),
+            "notation": region,
+            "about": "BrainRegion",
+            "hasPart": mtypes_part,
+        }
+
+    return summary
@@ -1,10 +1,25 @@
+import os
+import re
 import json
+from pathlib import Path
+
+from nexus_tag_client import WORKERS
 
 hasPart_key = "hasPart"
 
+# Nexus ids in the log of the push
+nexus_id_pattern = re.compile(r"https?://[^\s'\"<>(){}\[\],;|]+")
 
-def create_payload(forge, atlas_release_id, output_file, n_densities_expected,
-                   endpoint, bucket, tag=None):
+
+def query_metype_densities(forge, client, atlas_release_id, endpoint, bucket, tag=None):
+    """
+    Query the annotated ME-type densities of the atlas release having the tag.
+
+    Returns:
+        (resources, generic_resources): the payloads of the ME-type densities and of the
+        Generic{Excitatory,Inhibitory}Neuron densities (one of each), retrieved at the tag
+        by the NexusTagClient client.
+    """
     base_query = f"""
             ?s a METypeDensity ;
             atlasRelease <{atlas_release_id}>;
@@ -27,13 +42,11 @@ def create_payload(forge, atlas_release_id, output_file, n_densities_expected,
     all_resources_with_ann = forge.sparql(query_annotation, limit=3500, debug=False)
     print(f"{len(all_resources_with_ann)} ME-type densities with annotation found in total, filtering those with tag '{tag}'")
 
-    resources = filter_by_tag(all_resources_with_ann, tag, forge)
-    n_res_with_tag = len(resources)
-    print(f"{n_res_with_tag} ME-type densities with annotation found with tag '{tag}'")
-    assert n_res_with_tag == n_densities_expected, (f"The number of ME-type densities "
-        f"found with tag '{tag}' ({n_res_with_tag}) does not match the expected number ({n_densities_expected})")
+    resources = client.retrieve_tagged([res.s for res in all_resources_with_ann], tag)
+    print(f"{len(resources)} ME-type densities with annotation found with tag '{tag}'")
 
     # Get Generic{Excitatory,Inhibitory}Neuron
+    generic_resources = []
     for excInh in ["Excitatory", "Inhibitory"]:
         query_gen = f"""
             SELECT DISTINCT ?s
@@ -45,24 +58,195 @@ def create_payload(forge, atlas_release_id, output_file, n_densities_expected,
             Filter (?_deprecated = 'false'^^xsd:boolean)
             }}"""
         all_generic_resources = forge.sparql(query_gen, limit=1000, debug=False)
-        generic_resources = filter_by_tag(all_generic_resources, tag, forge)
-        assert len(generic_resources) == 1
-        resources.extend(generic_resources)
+        generic = client.retrieve_tagged([res.s for res in all_generic_resources], tag)
+        assert len(generic) == 1
+        generic_resources.extend(generic)
+
+    return resources, generic_resources
+
+
+def as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def metype_of(payload):
+    """(mtype, etype) annotation bodies of a density payload, None if it is not annotated with an M-type"""
+    metype_annotation = [a["hasBody"] for a in as_list(payload.get("annotation", []))]
+    if len(metype_annotation) < 2 or "MType" not in as_list(metype_annotation[0].get("@type", [])):
+        return None
+    return metype_annotation[0], metype_annotation[1]
+
+
+def create_payload(forge, client, atlas_release_id, output_file, n_densities_expected,
+                   endpoint, bucket, tag=None):
+    resources, generic_resources = query_metype_densities(forge, client, atlas_release_id, endpoint, bucket, tag)
+    n_res_with_tag = len(resources)
+    assert n_res_with_tag == n_densities_expected, (f"The number of ME-type densities "
+        f"found with tag '{tag}' ({n_res_with_tag}) does not match the expected number ({n_densities_expected})")
+    resources.extend(generic_resources)
 
     print(f"{len(resources)} ME-type densities will be released, including generic ones (tag '{tag}')")
 
-    metype_annotations = [(a.hasBody for a in r.annotation) for r in resources] 
+    densities = []
+    for resource in resources:
+        metype = metype_of(resource)
+        if metype is not None:
+            mtype, etype = metype
+            densities.append(({"@id": mtype["@id"], "label": mtype["label"]},
+                              {"@id": etype["@id"], "label": etype["label"],
+                               "is_etype": "EType" in as_list(etype.get("@type", []))},
+                              {"@id": resource["@id"], "@type": resource["@type"], "_rev": resource["_rev"]}))
+
+    grouped_by_metype = group_by_metype(densities)
+
+    with open(output_file, "w") as f:
+        json.dump(grouped_by_metype, f)
+
+    return grouped_by_metype
+
+
+def local_density_files(input_paths, files_ext=".nrrd"):
+    """Real paths of the density files in the input directories"""
+    density_files = []
+    for folder in input_paths:
+        density_files.extend(sorted(os.path.realpath(path) for path in Path(folder).rglob("*" + files_ext)))
+    return density_files
+
+
+def pushed_ids(push_log, endpoint=None):
+    """
+    Nexus ids written by the push in its log, in order of appearance.
+    The URLs of the Nexus endpoint itself (e.g. contentUrl) are not ids of Resources.
+    """
+    ids = []
+    with open(push_log, "r") as log_file:
+        for line in log_file:
+            for url in nexus_id_pattern.findall(line):
+                url = url.rstrip(".:")
+                if endpoint and url.startswith(endpoint):
+                    continue
+                ids.append(url)
+    return list(dict.fromkeys(ids))
 
+
+def create_push_manifest(client, push_log, input_paths, output_file, tag=None, files_ext=".nrrd",
+                         workers=WORKERS):
+    """
+    Write the manifest of the pushed ME-type densities, read by create_payload_from_manifest.
+
+    The ids of the pushed densities are those written by push_metype_pipeline_datasets
+    in its log. They are retrieved by id at the tag of the push and matched to the local
+    density files having the name of their distribution. The retrieved Resources which are
+    not annotated ME-type densities (e.g. the atlas release) are skipped, as well as the ids
+    not existing at the tag. The densities without a local file are keyed by their @id.
+
+    Args:
+        client: NexusTagClient of the Nexus project of the densities
+        push_log: path of the output of the push
+        input_paths: directories containing the pushed ME-type density files
+        output_file: path of the manifest to write
+        tag: tag of the pushed densities
+        files_ext: extension of the density files
+        workers: number of concurrent retrieves
+    """
+    ids = pushed_ids(push_log, client.endpoint)
+    print(f"{len(ids)} ids found in the push log {push_log}")
+    resources = client.retrieve_tagged(ids, tag, workers)
+
+    density_files = local_density_files(input_paths, files_ext)
+    by_name = {}
+    for path in density_files:
+        by_name.setdefault(os.path.basename(path), []).append(path)
+
+    manifest = {}
+    for resource in resources:
+        if "METypeDensity" not in as_list(resource.get("@type", [])):
+            continue
+        metype = metype_of(resource)
+        if metype is None:
+            continue
+        mtype, etype = metype
+        distribution = as_list(resource["distribution"])[0]
+        same_name = by_name.get(distribution["name"], [])
+        if len(same_name) > 1:
+            raise Exception(f"The distribution {distribution['name']} of {resource['@id']} matches "
+                            f"{len(same_name)} local density files: {same_name}")
+        manifest[same_name[0] if same_name else resource["@id"]] = {"@id": resource["@id"],
+            "@type": resource["@type"], "_rev": resource["_rev"],
+            "mtype": {"@id": mtype["@id"], "label": mtype["label"]},
+            "etype": {"@id": etype["@id"], "label": etype["label"]}}
+    print(f"{len(manifest)} pushed ME-type densities in the manifest, "
+          f"{len(set(density_files) & set(manifest))}/{len(density_files)} local densities matched")
+
+    with open(output_file, "w") as f:
+        json.dump(manifest, f, indent=4)
+
+    return manifest
+
+
+def create_payload_from_manifest(input_paths, push_manifest, output_file, files_ext=".nrrd"):
+    """
+    Build the CellCompositionVolume payload from the local ME-type density files,
+    without querying Nexus.
+
+    Args:
+        input_paths: directories containing the ME-type density files
+        push_manifest: path of the JSON manifest of the pushed densities (see create_push_manifest),
+            mapping each density file path (or @id, for the densities without a local file) to
+            {"@id", "@type", "_rev", "mtype": {"@id", "label"}, "etype": {"@id", "label"}}.
+            The entry whose M-type is a Generic{Excitatory,Inhibitory}NeuronMType is released
+            even if its file is not in input_paths.
+        output_file: path of the payload to write
+        files_ext: extension of the density files
+    """
+    with open(push_manifest, "r") as manifest_file:
+        manifest = {os.path.realpath(path): entry for path, entry in json.load(manifest_file).items()}
+
+    density_files = local_density_files(input_paths, files_ext)
+    print(f"{len(density_files)} ME-type densities found in {input_paths}")
+    missing = [path for path in density_files if path not in manifest]
+    if missing:
+        missing_str = "\n".join(missing)
+        raise Exception(f"{len(missing)} ME-type densities are not in the push manifest {push_manifest}:\n{missing_str}")
+
+    entries = [manifest[path] for path in density_files]
+    for excInh in ["Excitatory", "Inhibitory"]:
+        generic_paths = [path for path, entry in manifest.items() if
+            entry["mtype"]["@id"].endswith(f"Generic{excInh}NeuronMType")]
+        assert len(generic_paths) == 1, (f"{len(generic_paths)} Generic{excInh}NeuronMType densities "
+            f"found in the push manifest {push_manifest}, expected 1")
+        if generic_paths[0] not in density_files:
+            entries.append(manifest[generic_paths[0]])
+    print(f"{len(entries)} ME-type densities will be released, including generic ones")
+
+    densities = [({"@id": entry["mtype"]["@id"], "label": entry["mtype"]["label"]},
+                  {"@id": entry["etype"]["@id"], "label": entry["etype"]["label"], "is_etype": True},
+                  {"@id": entry["@id"], "@type": entry["@type"], "_rev": entry["_rev"]})
+                 for entry in entries]
+    grouped_by_metype = group_by_metype(densities)
+
+    with open(output_file, "w") as f:
+        json.dump(grouped_by_metype, f)
+
+    return grouped_by_metype
+
+
+def group_by_metype(densities):
+    """
+    Group the densities in the CellCompositionVolume structure (M-type -> E-type -> density).
+
+    Args:
+        densities: list of (mtype, etype, density) where mtype and etype are dicts with
+            "@id" and "label" (etype also has "is_etype"), density has "@id", "@type" and "_rev"
+    """
     mtype_to_etype = {}
-    for i, metype_annotation_gen in enumerate(metype_annotations):
-        metype_annotation_gen_list = list(metype_annotation_gen)
-        if "MType" in metype_annotation_gen_list[0].type:
-            if metype_annotation_gen_list[0].id not in mtype_to_etype:
-                mtype_to_etype[metype_annotation_gen_list[0].id] = {"label": metype_annotation_gen_list[0].label}
-            if "EType" in metype_annotation_gen_list[1].type and metype_annotation_gen_list[1].id not in mtype_to_etype[metype_annotation_gen_list[0].id]:
-                mtype_to_etype[metype_annotation_gen_list[0].id][metype_annotation_gen_list[1].id] = {"label": metype_annotation_gen_list[1].label}
-            if resources[i].id not in mtype_to_etype[metype_annotation_gen_list[0].id][metype_annotation_gen_list[1].id]:
-                mtype_to_etype[metype_annotation_gen_list[0].id][metype_annotation_gen_list[1].id][resources[i].id] = {"type": resources[i].type, "_rev": resources[i]._store_metadata._rev}
+    for (mtype, etype, density) in densities:
+        if mtype["@id"] not in mtype_to_etype:
+            mtype_to_etype[mtype["@id"]] = {"label": mtype["label"]}
+        if etype["is_etype"] and etype["@id"] not in mtype_to_etype[mtype["@id"]]:
+            mtype_to_etype[mtype["@id"]][etype["@id"]] = {"label": etype["label"]}
+        if density["@id"] not in mtype_to_etype[mtype["@id"]][etype["@id"]]:
+            mtype_to_etype[mtype["@id"]][etype["@id"]][density["@id"]] = {"type": density["@type"], "_rev": density["_rev"]}
 
     # CellCompositionVolume structure
     grouped_by_metype = {hasPart_key: []}
@@ -77,23 +261,4 @@ def create_payload(forge, atlas_release_id, output_file, n_densities_expected,
                         m_content[hasPart_key].append(e_content)
         grouped_by_metype[hasPart_key].append(m_content)
 
-    with open(output_file, "w") as f:
-        json.dump(grouped_by_metype, f)
-
     return grouped_by_metype
-
-
-def filter_by_tag(all_resources, tag, forge):
-    if not tag:
-        return all_resources
-
-    tagged_resources = []
-    for count, res in enumerate(all_resources):
-        print(f"Retrieving Resource {count} of {len(all_resources)}")
-        try:
-            retrieved_res = forge.retrieve(id=res.s, version=tag)
-            if retrieved_res is not None:
-                tagged_resources.append(retrieved_res)
-        except Exception:
-            pass
-    return tagged_resources
@@ -2,50 +2,73 @@ import os
 import json
 from pathlib import Path
 from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 
 from voxcell import RegionMap, VoxelData
+from nrrd_volume import NrrdVolume, NrrdWriter, iter_voxel_chunks, CHUNK_ELEMENTS, ENCODING, \
+    COMPRESSION_LEVEL
+
+CROP_MARGIN = 10
+CROP_FILENAME = "crop.json"
 
 
 def main(hierarchy, annotation_volume, user_rule, default_rule_output,
-         merged_output_dir, default_rule_file=None, metadata_path=None):
+         merged_output_dir, default_rule_file=None, metadata_path=None, max_workers=1,
+         encoding=ENCODING, compression_level=COMPRESSION_LEVEL):
     region_map = RegionMap.load_json(hierarchy)
-    annotation = VoxelData.load_nrrd(annotation_volume)
+    # the annotation is read by chunks, never loaded entirely
+    annotation = NrrdVolume(annotation_volume)
 
     rule_name = user_rule["rule"]
 
     region_volume_map = {}
+    region_offset_map = {}
     customized_regions = user_rule["execute"]
     for custom_region in customized_regions:
         region_id = get_region_id(custom_region["brainRegion"])
         region_volume_map[region_id] = custom_region["output_dir"]
+        # Region rules executed on a crop of their inputs
+        if custom_region.get("crop_file"):
+            region_offset_map[region_id] = load_crop_offset(custom_region["crop_file"])
 
     print(f"Merging outputs of rule {rule_name} from {len(customized_regions)} regions")
-    merged_volumes = merge_nrrd_files(region_map, annotation.raw, region_volume_map,
-        default_rule_output, merged_output_dir, default_rule_file, metadata_path)
+    merged_volumes = merge_nrrd_files(region_map, annotation, region_volume_map,
+        default_rule_output, merged_output_dir, default_rule_file, metadata_path, max_workers,
+        region_offset_map, encoding, compression_level)
     print(f"{len(merged_volumes)} files have been merged in {merged_output_dir}: {merged_volumes}")
 
 
-def merge_nrrd_files(region_map: RegionMap, annotation: np.ndarray,
+def merge_nrrd_files(region_map: RegionMap, annotation,
     region_volume_map: dict, default_rule_output: str, merged_output_dir: str,
-    default_rule_file=None, metadata_path=None) -> list:
+    default_rule_file=None, metadata_path=None, max_workers=1, region_offset_map=None,
+    encoding=ENCODING, compression_level=COMPRESSION_LEVEL) -> list:
     """
     Merge nrrd volumes for various brain regions.
 
     Args:
         region_map: voxcell.RegionMap of the regions hierarchy
         annotation: annotation volume, where each voxel contains a region id
+            (numpy array, or NrrdVolume read by chunks)
         region_volume_map: mapping between brain region and its corresponding nrrd file to merge
         default_rule_output: output path of the nrrd file of original default rule.
             The areas of the brain regions in region_volume_map will be superseded.
         merged_output_dir: directory where to save merged volumes
         metadata_path: optional path to the metadata file
+        max_workers: number of processes merging the files in parallel
+        region_offset_map: optional mapping between brain region and the offset (in voxels)
+            of its nrrd files in the annotation, for the regions computed on a crop
+        encoding: NRRD encoding of the merged volumes ("gzip" or "raw")
+        compression_level: zlib compression level of the gzip encoding
 
     Returns:
         The list of volume files with updated values from the volumes in region_volume_map.
     """
 
     extension = ".nrrd"
+    if region_offset_map is None:
+        region_offset_map = {}
     default_output_files = []
     if not os.path.exists(default_rule_output):
         raise Exception("The output of the default rule does not exist at", default_rule_output)
@@ -65,40 +88,77 @@ def merge_nrrd_files(region_map: RegionMap, annotation: np.ndarray,
         metadata_file = open(metadata_path, "r+")
         metadata_json = json.load(metadata_file)
 
-    result = []
+    # Regions not found in the hierarchy are dropped once, before looping on the files
+    region_ids_map = {}
+    for region_id in region_volume_map.keys():
+        ids_reg = region_map.find(region_id, "id", with_descendants=True)
+        if not ids_reg:
+            print(f"Warning: region {region_id} is not found in the hierarchy provided")
+            continue
+        region_ids_map[region_id] = ids_reg
+
+    # The voxels of each region are computed once per set of regions providing a file,
+    # and packed in a single array of flat indices shared by all the merges
+    region_indices_cache = {}
+    packed_indices = []
+    n_packed = 0
+    tasks = []
     os.makedirs(merged_output_dir, exist_ok=True)
     for default_output in default_output_files:
         filename = os.path.basename(default_output)
-        # Get the default volume
-        default_volume = VoxelData.load_nrrd(default_output)
-        result_volume = np.copy(default_volume.raw)
-        # Update the result regions with values from the input map
+        # Regions providing a volume for this file
+        file_regions = []
         for (region_id, volume_path) in region_volume_map.items():
-            ids_reg = region_map.find(region_id, "id", with_descendants=True)
-            if not ids_reg:
-                print(f"Warning: region {region_id} is not found in the hierarchy provided")
+            if region_id not in region_ids_map:
                 continue
-
             volume_file = os.path.join(volume_path, filename)
             if not os.path.isfile(volume_file):
                 print(f"Warning: no file {filename} found in {volume_path}, skipping it.")
                 continue
-            volume = VoxelData.load_nrrd(volume_file).raw
+            file_regions.append((region_id, volume_file))
 
-            # Get region mask
-            region_mask = np.isin(annotation, list(ids_reg))
-            # Supersede region {region_id} in result with values from volume
-            if result_volume.shape[0:len(region_mask.shape)] == region_mask.shape:
-                result_volume[region_mask] = volume[region_mask]
-            else:
-                result_volume[:region_mask] = volume[:region_mask]
+        regions_key = tuple(region_id for (region_id, _) in file_regions)
+        if regions_key not in region_indices_cache:
+            indices_slices = []
+            for voxel_indices in get_region_voxel_indices(annotation,
+                    [region_ids_map[region_id] for region_id in regions_key]):
+                indices_slices.append((n_packed, n_packed + voxel_indices.size))
+                packed_indices.append(voxel_indices)
+                n_packed += voxel_indices.size
+            region_indices_cache[regions_key] = indices_slices
 
-            if metadata_path:
-                metadata_json[filename].append(region_map.get(region_id, "name"))
+        tasks.append((default_output, merged_output_dir, annotation.shape,
+            [(region_id, volume_file, indices_slice, region_offset_map.get(region_id))
+             for ((region_id, volume_file), indices_slice) in zip(file_regions, region_indices_cache[regions_key])]))
 
-        merged_file = os.path.join(merged_output_dir, filename)
-        default_volume.with_data(result_volume).save_nrrd(merged_file)
-        result.append(merged_file)
+    voxel_indices = np.concatenate(packed_indices).astype(np.int64) if packed_indices \
+        else np.zeros(0, dtype=np.int64)
+    if max_workers > 1 and len(tasks) > 1:
+        n_processes = min(max_workers, len(tasks))
+        # the remaining workers compress the merged volumes
+        write_options = {"encoding": encoding, "compression_level": compression_level,
+                         "threads": max(max_workers // n_processes, 1)}
+        print(f"Merging {len(tasks)} files with {n_processes} processes")
+        # The workers attach to the voxel indices in shared memory instead of receiving a copy per task
+        shm = shared_memory.SharedMemory(create=True, size=max(voxel_indices.nbytes, 1))
+        try:
+            np.ndarray(voxel_indices.shape, dtype=np.int64, buffer=shm.buf)[:] = voxel_indices
+            with ProcessPoolExecutor(max_workers=n_processes, initializer=_init_merge_worker,
+                                     initargs=(shm.name, voxel_indices.size, write_options)) as executor:
+                result = list(executor.map(_merge_nrrd_file_task, tasks))
+        finally:
+            shm.close()
+            shm.unlink()
+    else:
+        write_options = {"encoding": encoding, "compression_level": compression_level, "threads": max_workers}
+        result = [merge_nrrd_file(*task, voxel_indices, write_options=write_options) for task in tasks]
+
+    # The metadata is updated once all the files are merged, in the order of the files
+    if metadata_path:
+        for (default_output, _, _, file_regions) in tasks:
+            filename = os.path.basename(default_output)
+            for (region_id, _, _, _) in file_regions:
+                metadata_json[filename].append(region_map.get(region_id, "name"))
 
     if metadata_path:
         metadata_file.seek(0)
@@ -109,6 +169,233 @@ def merge_nrrd_files(region_map: RegionMap, annotation: np.ndarray,
     return result
 
 
+def merge_nrrd_file(default_output: str, merged_output_dir: str, annotation_shape: tuple,
+    file_regions: list, voxel_indices: np.ndarray, chunk_voxels=CHUNK_ELEMENTS, write_options=None) -> str:
+    """
+    Merge the region volumes of one file into its default volume.
+
+    The default volume is read and the merged volume written by chunks of voxels,
+    along with the region volumes of the same shape.
+
+    Args:
+        default_output: path of the nrrd file output by the default rule
+        merged_output_dir: directory where to save the merged volume
+        annotation_shape: shape of the annotation volume
+        file_regions: list of (region_id, volume_file, (start, stop), offset) where the slice of
+            voxel_indices gives the flat indices of the voxels superseded by the region, and
+            offset is the position of volume_file in the annotation if cropped (None otherwise)
+        voxel_indices: packed flat indices (in order 'F', sorted per region) of the voxels of all the regions
+        chunk_voxels: number of voxels read and written at once
+        write_options: optional keyword arguments of the NrrdWriter of the merged volume
+            (encoding, compression_level, threads)
+
+    Returns:
+        The path of the merged volume.
+    """
+    # Get the default volume
+    default_volume = NrrdVolume(default_output)
+    if default_volume.shape != tuple(annotation_shape):
+        raise Exception(f"The shape of {default_output} {default_volume.shape} does not match "
+                        f"the shape of the annotation {annotation_shape}")
+
+    # For each region: its voxel indices, and either the chunks of its volume (read along with
+    # the default volume) or the values of its voxels (for cropped volumes)
+    regions = []
+    for (region_id, volume_file, (start, stop), offset) in file_regions:
+        region_indices = voxel_indices[start:stop]
+        volume = NrrdVolume(volume_file)
+        if offset is None:
+            if volume.shape != tuple(annotation_shape):
+                raise Exception(f"The shape of {volume_file} {volume.shape} does not match "
+                                f"the shape of the annotation {annotation_shape}")
+            regions.append((region_indices, volume.iter_voxel_chunks(chunk_voxels), None))
+        else:
+            # Position of the region voxels in the cropped volume
+            crop_data = volume.load()
+            crop_shape = crop_data.shape[0:len(annotation_shape)]
+            region_coords = np.unravel_index(region_indices, annotation_shape, order="F")
+            volume_indices = np.ravel_multi_index(
+                tuple(coords - o for (coords, o) in zip(region_coords, offset)), crop_shape, order="F")
+            crop_voxels = next(iter_voxel_chunks(crop_data, int(np.prod(crop_shape))))
+            regions.append((region_indices, None, crop_voxels[volume_indices]))
+
+    merged_file = os.path.join(merged_output_dir, os.path.basename(default_output))
+    with NrrdWriter(merged_file, default_volume.header, default_volume.dtype, **(write_options or {})) as writer:
+        chunk_start = 0
+        for default_chunk in default_volume.iter_voxel_chunks(chunk_voxels):
+            result = default_chunk.copy()
+            chunk_stop = chunk_start + len(result)
+            for (region_indices, volume_chunks, region_values) in regions:
+                # Supersede the voxels of the region in this chunk with the values from its volume
+                (first, last) = np.searchsorted(region_indices, [chunk_start, chunk_stop])
+                chunk_indices = region_indices[first:last] - chunk_start
+                if volume_chunks is not None:
+                    result[chunk_indices] = next(volume_chunks)[chunk_indices]
+                else:
+                    result[chunk_indices] = region_values[first:last]
+            writer.write(result)
+            chunk_start = chunk_stop
+    return merged_file
+
+
+_worker_shm = None
+_worker_voxel_indices = None
+_worker_write_options = None
+
+
+def _init_merge_worker(shm_name, n_indices, write_options):
+    global _worker_shm, _worker_voxel_indices, _worker_write_options
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_voxel_indices = np.ndarray((n_indices,), dtype=np.int64, buffer=_worker_shm.buf)
+    _worker_write_options = write_options
+
+
+def _merge_nrrd_file_task(task):
+    return merge_nrrd_file(*task, _worker_voxel_indices, write_options=_worker_write_options)
+
+
+def get_region_voxel_indices(annotation, regions_ids, chunk_voxels=CHUNK_ELEMENTS) -> list:
+    """
+    Compute, in a single pass over the annotation, the voxels superseded by each region.
+
+    Args:
+        annotation: annotation volume (numpy array, or NrrdVolume read by chunks)
+        regions_ids: for each region, the set of its ids (including descendants).
+            When regions overlap, a voxel is assigned to the last region listed,
+            as if the regions were superseded one after the other.
+        chunk_voxels: number of voxels of the annotation read at once
+
+    Returns:
+        For each region, the sorted flat indices of its voxels in the annotation volume,
+        in order 'F' (the order of the NRRD payload).
+    """
+    # sorted region ids -> index of the region superseding it
+    id_source = {}
+    for source, ids_reg in enumerate(regions_ids, start=1):
+        id_source.update((region_id, source) for region_id in ids_reg)
+    lut_ids = np.array(sorted(id_source), dtype=np.int64)
+    lut_sources = np.array([id_source[region_id] for region_id in lut_ids],
+                           dtype=np.min_scalar_type(len(regions_ids)))
+
+    region_indices = [[] for _ in regions_ids]
+    chunk_start = 0
+    for chunk in iter_voxel_chunks(annotation, chunk_voxels):
+        if lut_ids.size:
+            positions = np.minimum(np.searchsorted(lut_ids, chunk), lut_ids.size - 1)
+            # 0 for the voxels superseded by no region
+            voxel_source = np.where(lut_ids[positions] == chunk, lut_sources[positions], 0)
+            for source in range(1, len(regions_ids) + 1):
+                region_indices[source - 1].append(np.flatnonzero(voxel_source == source) + chunk_start)
+        chunk_start += len(chunk)
+
+    return [np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64) for indices in region_indices]
+
+
+def get_region_bbox(region_map: RegionMap, annotation: np.ndarray, region_id,
+    margin=CROP_MARGIN) -> tuple:
+    """
+    Compute the bounding box of a brain region in the annotation.
+
+    Args:
+        region_map: voxcell.RegionMap of the regions hierarchy
+        annotation: annotation volume, where each voxel contains a region id
+        region_id: id of the region (its descendants are included)
+        margin: number of voxels added around the region, on each side
+
+    Returns:
+        (start, stop) voxel coordinates of the bounding box, clipped to the annotation.
+    """
+    ids_reg = region_map.find(region_id, "id", with_descendants=True)
+    region_mask = np.isin(annotation, list(ids_reg))
+    if not region_mask.any():
+        raise Exception(f"Region {region_id} has no voxel in the annotation provided")
+
+    start, stop = [], []
+    for axis in range(region_mask.ndim):
+        other_axes = tuple(a for a in range(region_mask.ndim) if a != axis)
+        axis_indices = np.flatnonzero(region_mask.any(axis=other_axes))
+        start.append(max(int(axis_indices[0]) - margin, 0))
+        stop.append(min(int(axis_indices[-1]) + 1 + margin, region_mask.shape[axis]))
+    return start, stop
+
+
+def crop_hierarchy(hierarchy_json: dict, kept_ids: set) -> dict:
+    """
+    Remove from the hierarchy the regions that are neither in kept_ids nor ancestors of one of them.
+    The root is always kept.
+    """
+    def prune(node):
+        children = [prune(child) for child in node.get("children", [])]
+        children = [child for child in children if child is not None]
+        if not children and node["id"] not in kept_ids:
+            return None
+        pruned_node = {key: value for (key, value) in node.items() if key != "children"}
+        pruned_node["children"] = children
+        return pruned_node
+
+    # some hierarchies have their content in a "msg" sub prop
+    if "msg" in hierarchy_json:
+        cropped_json = dict(hierarchy_json)
+        cropped_json["msg"] = [prune(root) or dict(root, children=[]) for root in hierarchy_json["msg"]]
+        return cropped_json
+    return prune(hierarchy_json) or dict(hierarchy_json, children=[])
+
+
+def crop_region_inputs(hierarchy, annotation_volume, region_id, inputs: dict, outputs: dict,
+    crop_file, margin=CROP_MARGIN):
+    """
+    Crop the inputs of a region-specific rule to the bounding box of the region.
+
+    Args:
+        hierarchy: path of the hierarchy used by the merge
+        annotation_volume: path of the annotation volume used by the merge
+        region_id: id of the customized region
+        inputs: mapping between the rule variables and their input files.
+            The nrrd volumes are cropped, the json hierarchies are restricted to
+            the regions present in the crop.
+        outputs: mapping between the rule variables and the cropped files to write
+        crop_file: path of the json file where to save the position of the crop
+        margin: number of voxels added around the region, on each side
+    """
+    region_map = RegionMap.load_json(hierarchy)
+    annotation = VoxelData.load_nrrd(annotation_volume)
+    start, stop = get_region_bbox(region_map, annotation.raw, region_id, margin)
+    crop_slices = tuple(slice(a, b) for (a, b) in zip(start, stop))
+    print(f"Cropping the inputs of region {region_id} to the voxels {start} - {stop} "
+          f"of the annotation of shape {list(annotation.shape)}")
+
+    kept_ids = None
+    for (var, input_path) in inputs.items():
+        output_path = outputs[var]
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        if input_path.endswith(".nrrd"):
+            volume = VoxelData.load_nrrd(input_path)
+            if volume.shape != annotation.shape:
+                raise Exception(f"The shape of {input_path} {volume.shape} does not match "
+                                f"the shape of the annotation {annotation.shape}")
+            offset = volume.offset + np.array(start) * volume.voxel_dimensions
+            VoxelData(volume.raw[crop_slices], volume.voxel_dimensions, offset).save_nrrd(output_path)
+        elif input_path.endswith(".json"):
+            if kept_ids is None:
+                kept_ids = set(np.unique(annotation.raw[crop_slices]).tolist())
+            with open(input_path, "r") as hierarchy_file:
+                hierarchy_json = json.load(hierarchy_file)
+            with open(output_path, "w") as cropped_file:
+                json.dump(crop_hierarchy(hierarchy_json, kept_ids), cropped_file)
+        else:
+            raise Exception(f"Input {var} ({input_path}) can not be cropped, "
+                            "only .nrrd and .json files are supported")
+
+    with open(crop_file, "w") as f:
+        json.dump({"region_id": region_id, "offset": start, "stop": stop,
+                   "annotation_shape": list(annotation.shape), "margin": margin}, f)
+
+
+def load_crop_offset(crop_file) -> list:
+    with open(crop_file, "r") as f:
+        return json.load(f)["offset"]
+
+
 def get_region_id(full_id):
     parts = full_id.split("/")
     return int(parts[-1])
@@ -0,0 +1,253 @@
+'''
+Content-addressed cache of the datasets fetched from Nexus, shared between WORKING_DIRs.
+
+A fetched file is stored in the cache directory under a key computed from its
+Nexus id (with its tag or rev), the revision of the Resource and the digests of
+its distribution. A fetch rule first retrieves the Resource metadata, then:
+- if the key is in the cache, its output is hardlinked to the cached file
+  (or reflinked / copied when the cache is on another filesystem),
+- otherwise the file is downloaded with bba-data-fetch into the cache, the least
+  recently used files being evicted to keep the cache within its size budget.
+The use of a cached file is recorded by an access stamp file per key (in .access),
+never by the cached file itself, whose inode is shared by the hardlinked outputs.
+
+Usage (same arguments as bba-data-fetch, the unknown ones being passed to it):
+    python dataset_cache.py --cache-dir <dir> --max-size-gb <size> --app bba-data-fetch \\
+        --forge-config <file> --nexus-env <url> --token-file <file> --nexus-org <org> \\
+        --nexus-proj <proj> --nexus-id <id> --out <file> [--verbose] [--favor ...]
+
+The access token is read from the JSON token file of the pipeline token broker
+when connecting to Nexus, rather than given on the command line.
+
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+from token_broker import read_token
+
+TAG_SEP = "?tag="
+REV_SEP = "?rev="
+# directory of the cache where the files are downloaded
+TMP_DIR = ".tmp"
+# directory of the access stamps of the cached files
+ACCESS_DIR = ".access"
+
+
+def split_version(nexus_id):
+    """(id, version) of a Nexus id with an optional tag (str) or rev (int)"""
+    if TAG_SEP in nexus_id:
+        res_id, tag = nexus_id.split(TAG_SEP)
+        return res_id, tag
+    if REV_SEP in nexus_id:
+        res_id, rev = nexus_id.split(REV_SEP)
+        return res_id, int(rev)
+    return nexus_id, None
+
+
+def distribution_digests(res):
+    """Sorted '<algorithm>:<value>' digests of the distribution(s) of a Resource"""
+    distribution = getattr(res, "distribution", None)
+    if distribution is None:
+        return []
+    if not isinstance(distribution, list):
+        distribution = [distribution]
+    digests = []
+    for dist in distribution:
+        digest = getattr(dist, "digest", None)
+        value = getattr(digest, "value", None)
+        if value:
+            digests.append(f"{getattr(digest, 'algorithm', None)}:{value}")
+    return sorted(digests)
+
+
+def cache_key(nexus_id, rev, digests, fetch_args=()):
+    """
+    Key of a fetched file. The fetch arguments are part of it, since they can select
+    a different file of the distribution (e.g. --favor).
+    """
+    content = {"id": nexus_id, "rev": rev, "digests": list(digests), "fetch_args": list(fetch_args)}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def link_or_copy(source, destination):
+    """Hardlink source to destination, or reflink / copy it if they are not on the same filesystem"""
+    try:
+        os.link(source, destination)
+    except OSError:
+        if os.path.exists(destination):
+            raise
+        try:
+            subprocess.run(["cp", "--reflink=auto", source, destination], check=True, capture_output=True)
+        except (OSError, subprocess.CalledProcessError):
+            shutil.copyfile(source, destination)
+
+
+class DatasetCache:
+    """
+    Cache directory of the fetched files.
+
+    Args:
+        cache_dir: path of the cache directory (created if it does not exist)
+        max_size: the least recently used files are evicted beyond this number of bytes
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(os.path.join(cache_dir, TMP_DIR), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, ACCESS_DIR), exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _access_path(self, key):
+        return os.path.join(self.cache_dir, ACCESS_DIR, key)
+
+    def _mark_used(self, key):
+        """Record the use of the entry of key in its access stamp"""
+        with open(self._access_path(key), "w"):
+            pass
+
+    def last_used(self, key):
+        """Time of the last use of the entry of key (its store time if it has no access stamp)"""
+        try:
+            return os.stat(self._access_path(key)).st_mtime
+        except FileNotFoundError:
+            return os.stat(self.entry_path(key)).st_mtime
+
+    def materialize(self, key, output):
+        """Link the cached file of key to output, return False if it is not in the cache"""
+        entry = self.entry_path(key)
+        if not os.path.isfile(entry):
+            return False
+        if os.path.lexists(output):
+            os.remove(output)
+        try:
+            link_or_copy(entry, output)
+        except FileNotFoundError:
+            # evicted in the meantime by another job
+            return False
+        # the access stamp is updated, not the cached file: its mtime is the one of the hardlinked outputs
+        self._mark_used(key)
+        return True
+
+    def store(self, key, path):
+        """Move the downloaded file path (in the cache directory) to the entry of key"""
+        # the cached files are read-only, so that a hardlinked output can not alter them
+        os.chmod(path, 0o444)
+        os.replace(path, self.entry_path(key))
+        self._mark_used(key)
+
+    def mkdtemp(self):
+        return tempfile.mkdtemp(dir=os.path.join(self.cache_dir, TMP_DIR))
+
+    def evict(self, keep=()):
+        """Remove the least recently used files until the cache is within its budget"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name in [TMP_DIR, ACCESS_DIR] or name in keep or not os.path.isfile(path):
+                continue
+            try:
+                entries.append((self.last_used(name), os.path.getsize(path), name))
+            except FileNotFoundError:
+                # evicted in the meantime by another job
+                continue
+        total_size = sum(size for (_, size, _) in entries)
+        for key in keep:
+            if os.path.isfile(self.entry_path(key)):
+                total_size += os.path.getsize(self.entry_path(key))
+        evicted = []
+        for (_, size, key) in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            for path in [self.entry_path(key), self._access_path(key)]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total_size -= size
+            evicted.append(self.entry_path(key))
+        return evicted
+
+
+def fetch_command(args, out, fetch_args):
+    return [*args.app.split(), "--forge-config", args.forge_config, "--nexus-env", args.nexus_env,
+        "--nexus-token", read_token(args.token_file), "--nexus-org", args.nexus_org, "--nexus-proj", args.nexus_proj,
+        "--out", out, "--nexus-id", args.nexus_id, *fetch_args]
+
+
+def resource_key(args, fetch_args):
+    """Cache key of the fetched file, None if the Resource metadata can not be retrieved"""
+    from kgforge.core import KnowledgeGraphForge
+
+    try:
+        forge = KnowledgeGraphForge(args.forge_config, endpoint=args.nexus_env,
+            bucket=f"{args.nexus_org}/{args.nexus_proj}", token=read_token(args.token_file))
+        res_id, version = split_version(args.nexus_id)
+        res = forge.retrieve(res_id, version=version)
+    except Exception as error:
+        print(f"The metadata of {args.nexus_id} could not be retrieved: {error!r}")
+        return None
+    if res is None:
+        print(f"The metadata of {args.nexus_id} could not be retrieved")
+        return None
+    return cache_key(args.nexus_id, res._store_metadata._rev, distribution_digests(res), fetch_args)
+
+
+def fetch(args, fetch_args):
+    cache = DatasetCache(args.cache_dir, int(args.max_size_gb * 1024**3))
+    key = resource_key(args, fetch_args)
+    if key is None:
+        print(f"Fetching {args.nexus_id} without the cache")
+        subprocess.run(fetch_command(args, args.out, fetch_args), check=True)
+        return
+
+    if cache.materialize(key, args.out):
+        print(f"{args.nexus_id} found in the cache {cache.entry_path(key)}")
+        return
+
+    tmp_dir = cache.mkdtemp()
+    try:
+        tmp_out = os.path.join(tmp_dir, os.path.basename(args.out))
+        subprocess.run(fetch_command(args, tmp_out, fetch_args), check=True)
+        if not os.path.isfile(tmp_out):
+            # not a single file, not cached
+            shutil.move(tmp_out, args.out)
+            return
+        cache.store(key, tmp_out)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    for path in cache.evict(keep=[key]):
+        print(f"Evicted from the cache: {path}")
+    if not cache.materialize(key, args.out):
+        raise Exception(f"{args.nexus_id} could not be materialized from the cache to {args.out}")
+    print(f"{args.nexus_id} fetched into the cache {cache.entry_path(key)}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache-dir", required=True, help="Path of the cache directory")
+    parser.add_argument("--max-size-gb", required=True, type=float,
+        help="Size budget of the cache, in GB, beyond which the least recently used files are evicted")
+    parser.add_argument("--app", required=True, help="The bba-data-fetch command")
+    parser.add_argument("--forge-config", required=True)
+    parser.add_argument("--nexus-env", required=True)
+    parser.add_argument("--token-file", required=True,
+        help="JSON token file of the pipeline token broker, holding the Nexus access token")
+    parser.add_argument("--nexus-org", required=True)
+    parser.add_argument("--nexus-proj", required=True)
+    parser.add_argument("--nexus-id", required=True)
+    parser.add_argument("--out", required=True)
+    # the other arguments (e.g. --verbose, --favor) are passed to bba-data-fetch
+    return parser.parse_known_args()
+
+
+if __name__ == "__main__":
+    fetch(*parse_args())
@@ -0,0 +1,155 @@
+'''
+Retrieval of Nexus Resources at a tag, through the Nexus HTTP API.
+
+This adapter is the only place where the Resources are requested with raw HTTP
+rather than kgforge: forge.retrieve returns None both for a Resource without the
+tag and for a failed request, while a missing tag must drop the Resource and a
+failure must stop the release. The Resources are first fetched in bulk with the
+multi-fetch endpoint, the results being keyed by the id they return. The ids
+not resolved in bulk are then fetched individually by a bounded pool of threads,
+each with its own HTTP session, retrying the transient errors (HTTP 429, 5xx
+and connection errors) with an exponential backoff.
+The Resources are returned as their compacted JSON-LD payloads.
+
+'''
+
+import time
+import threading
+from urllib.parse import quote_plus
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# number of Resources fetched individually at once
+WORKERS = 16
+ATTEMPTS = 3
+TIMEOUT = 60
+# Nexus errors meaning that the Resource does not exist at the requested tag
+NOT_FOUND_ERRORS = ["ResourceNotFound", "TagNotFound", "RevisionNotFound"]
+
+
+class NexusTagClient:
+    """
+    Client of the Resources of a Nexus project, retrieved at a tag.
+
+    Args:
+        endpoint: the Nexus endpoint
+        bucket: the Nexus project, "<org>/<project>"
+        token: the Nexus access token
+        session_factory: function returning a new requests.Session (one per thread)
+        attempts: number of attempts of an individual fetch
+        backoff: base (in seconds) of the exponential backoff between the attempts
+    """
+
+    def __init__(self, endpoint, bucket, token, session_factory=requests.Session, attempts=ATTEMPTS, backoff=2):
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.token = token
+        self.session_factory = session_factory
+        self.attempts = attempts
+        self.backoff = backoff
+        self._sessions = threading.local()
+
+    def session(self):
+        """The HTTP session of the calling thread"""
+        if not hasattr(self._sessions, "session"):
+            session = self.session_factory()
+            session.headers.update({"Authorization": f"Bearer {self.token}",
+                                    "Accept": "application/ld+json", "Content-Type": "application/json"})
+            self._sessions.session = session
+        return self._sessions.session
+
+    def fetch_bulk(self, ids, tag=None):
+        """
+        Fetch the Resources at tag with a single request to the multi-fetch endpoint.
+
+        Returns:
+            The payloads of the tagged Resources by id, and the set of ids without such a tag.
+            The ids in neither (transient errors, or endpoint not available) must be fetched individually.
+        """
+        suffix = f"?tag={tag}" if tag else ""
+        body = {"format": "compacted",
+                "resources": [{"id": f"{res_id}{suffix}", "project": self.bucket} for res_id in ids]}
+        try:
+            response = self.session().request("GET", f"{self.endpoint}/multi-fetch/resources", json=body,
+                                              timeout=TIMEOUT * 5)
+        except requests.RequestException as e:
+            print(f"Bulk fetch failed ({e}), falling back to individual fetches")
+            return {}, set()
+        if response.status_code != 200:
+            print(f"Bulk fetch not available (status {response.status_code}), falling back to individual fetches")
+            return {}, set()
+
+        requested = set(ids)
+        payloads = {}
+        not_tagged = set()
+        for result in response.json().get("resources", []):
+            value = result.get("value") or {}
+            # the id of the result, as requested (with the tag) or else as registered
+            res_id = result.get("id") or value.get("@id")
+            if res_id and suffix and res_id.endswith(suffix):
+                res_id = res_id[:-len(suffix)]
+            if res_id not in requested:
+                continue
+            if result.get("@type") == "Success" and value:
+                payloads[res_id] = value
+            elif result.get("reason", {}).get("@type") in NOT_FOUND_ERRORS:
+                not_tagged.add(res_id)
+        return payloads, not_tagged
+
+    def fetch(self, res_id, tag=None):
+        """
+        Fetch one Resource at tag, retrying on transient errors.
+
+        Returns:
+            (payload, error): payload is None if the Resource does not have the tag,
+            error is the last error message if the Resource could not be fetched.
+        """
+        org, project = self.bucket.split("/")
+        url = f"{self.endpoint}/resources/{org}/{project}/_/{quote_plus(res_id)}"
+        params = {"tag": tag} if tag else {}
+        error = None
+        for attempt in range(self.attempts):
+            if attempt:
+                time.sleep(self.backoff ** attempt)
+            try:
+                response = self.session().request("GET", url, params=params, timeout=TIMEOUT)
+            except requests.RequestException as e:
+                error = str(e)
+                continue
+            if response.status_code == 200:
+                return response.json(), None
+            if response.status_code == 404:
+                return None, None
+            error = f"status {response.status_code}: {response.text[:200]}"
+            if response.status_code < 500 and response.status_code != 429:
+                break
+        return None, error
+
+    def retrieve_tagged(self, ids, tag=None, workers=WORKERS):
+        """
+        Payloads of the Resources having the tag, in the order of ids. A Resource without
+        the tag is dropped, while an error persisting after the retries raises an Exception.
+        """
+        ids = list(dict.fromkeys(ids))
+        print(f"Retrieving {len(ids)} Resources at tag '{tag}'")
+        payloads, not_tagged = self.fetch_bulk(ids, tag)
+        to_fetch = [res_id for res_id in ids if res_id not in payloads and res_id not in not_tagged]
+        if to_fetch:
+            print(f"Retrieving {len(to_fetch)} Resources individually with {workers} concurrent requests")
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(lambda res_id: self.fetch(res_id, tag), to_fetch))
+            errors = {}
+            for res_id, (payload, error) in zip(to_fetch, results):
+                if error:
+                    errors[res_id] = error
+                elif payload is None:
+                    not_tagged.add(res_id)
+                else:
+                    payloads[res_id] = payload
+            if errors:
+                errors_str = "\n".join(f"{res_id}: {error}" for res_id, error in errors.items())
+                raise Exception(f"{len(errors)} Resources could not be retrieved at tag '{tag}':\n{errors_str}")
+
+        print(f"{len(payloads)} Resources found with tag '{tag}', {len(not_tagged)} without it")
+        return [payloads[res_id] for res_id in ids if res_id in payloads]
@@ -0,0 +1,419 @@
+'''
+Chunked access to the data of NRRD volumes.
+
+The volumes are read and written by fixed-size chunks of voxels, in the order
+of the NRRD payload, so that element-wise computations on large volumes (e.g. at
+10µm) never hold more than a chunk of each volume in memory:
+- raw-encoded payloads are memory-mapped,
+- gzip-encoded payloads are decompressed block by block.
+
+It is the volume access layer of the in-repo scripts (compute_lamp5, create_hemispheres,
+the merge of the customized volumes and the CellCompositionSummary), so that they
+run at 10µm within the memory of a standard node.
+
+'''
+
+import zlib
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nrrd
+
+# number of elements of each chunk
+CHUNK_ELEMENTS = 16 * 1024**2
+# number of compressed bytes read at once
+READ_SIZE = 4 * 1024**2
+# default encoding and zlib compression level of the written volumes, those of the pipeline rules
+# unless NRRD_ENCODING / NRRD_COMPRESSION_LEVEL are set in the config (6, zlib's default, is
+# close to the size of 9 in a fraction of its time)
+ENCODING = "gzip"
+COMPRESSION_LEVEL = 6
+# number of bytes deflated by each thread of a parallel gzip writer
+GZIP_BLOCK_SIZE = 1024**2
+# size of the deflate window, primed with the end of the previous block
+DICTIONARY_SIZE = 32 * 1024
+
+# NRRD types of the numpy dtypes, and numpy dtypes of all the NRRD type names
+NUMPY_TO_NRRD_TYPE = {"i1": "int8", "u1": "uint8", "i2": "int16", "u2": "uint16", "i4": "int32",
+                      "u4": "uint32", "i8": "int64", "u8": "uint64", "f4": "float", "f8": "double"}
+NRRD_TO_NUMPY_TYPE = {
+    **{name: "i1" for name in ["signed char", "int8", "int8_t"]},
+    **{name: "u1" for name in ["uchar", "unsigned char", "uint8", "uint8_t"]},
+    **{name: "i2" for name in ["short", "short int", "signed short", "signed short int", "int16", "int16_t"]},
+    **{name: "u2" for name in ["ushort", "unsigned short", "unsigned short int", "uint16", "uint16_t"]},
+    **{name: "i4" for name in ["int", "signed int", "int32", "int32_t"]},
+    **{name: "u4" for name in ["uint", "unsigned int", "uint32", "uint32_t"]},
+    **{name: "i8" for name in ["longlong", "long long", "long long int", "signed long long",
+                               "signed long long int", "int64", "int64_t"]},
+    **{name: "u8" for name in ["ulonglong", "unsigned long long", "unsigned long long int", "uint64", "uint64_t"]},
+    "float": "f4",
+    "double": "f8",
+}
+NUMPY_TO_NRRD_ENDIAN = {"<": "little", ">": "big"}
+NRRD_TO_NUMPY_ENDIAN = {"little": "<", "big": ">"}
+# order of the standard fields in a written header, and their type (string by default)
+HEADER_FIELDS_ORDER = ["type", "dimension", "space dimension", "space", "sizes", "space directions", "kinds",
+    "endian", "encoding", "min", "max", "oldmin", "old min", "oldmax", "old max", "content", "sample units",
+    "spacings", "thicknesses", "axis mins", "axismins", "axis maxs", "axismaxs", "centerings", "labels", "units",
+    "space units", "space origin", "measurement frame"]
+HEADER_FIELDS_TYPE = {
+    **{field: "number" for field in ["dimension", "space dimension", "min", "max", "oldmin", "old min",
+                                     "oldmax", "old max", "lineskip", "line skip", "byteskip", "byte skip"]},
+    **{field: "number list" for field in ["sizes", "spacings", "thicknesses", "axis mins", "axismins",
+                                          "axis maxs", "axismaxs"]},
+    **{field: "string list" for field in ["kinds", "centerings"]},
+    **{field: "quoted string list" for field in ["labels", "units", "space units"]},
+    "space origin": "vector",
+    "space directions": "vector list",
+    "measurement frame": "vector list",
+}
+
+
+def nrrd_dtype(header):
+    """numpy dtype of the data of a NRRD header"""
+    if header["type"] not in NRRD_TO_NUMPY_TYPE:
+        raise Exception(f"Unsupported NRRD type '{header['type']}'")
+    dtype = np.dtype(NRRD_TO_NUMPY_TYPE[header["type"]])
+    if dtype.itemsize > 1:
+        if header.get("endian") not in NRRD_TO_NUMPY_ENDIAN:
+            raise Exception(f"Invalid NRRD endian '{header.get('endian')}' for type '{header['type']}'")
+        dtype = dtype.newbyteorder(NRRD_TO_NUMPY_ENDIAN[header["endian"]])
+    return dtype
+
+
+def _format_vector(vector):
+    """'(x,y,z)' NRRD vector, or 'none' if it is undefined (None or NaN)"""
+    if vector is None or np.isnan(np.asarray(vector, dtype=float)).all():
+        return "none"
+    return "(" + ",".join(nrrd.format_number(x) for x in vector) + ")"
+
+
+def _format_header_value(field, value):
+    field_type = HEADER_FIELDS_TYPE.get(field, "string")
+    if field_type == "number":
+        return nrrd.format_number(value)
+    if field_type == "number list":
+        return " ".join(nrrd.format_number(x) for x in value)
+    if field_type == "string list":
+        return " ".join(value)
+    if field_type == "quoted string list":
+        return " ".join(f'"{x}"' for x in value)
+    if field_type == "vector":
+        return _format_vector(value)
+    if field_type == "vector list":
+        return " ".join(_format_vector(vector) for vector in value)
+    return str(value)
+
+
+def write_header(nrrd_file, header):
+    """Write the header of an attached NRRD file, the custom fields as 'key:=value'"""
+    lines = ["NRRD0005", "# Complete NRRD file format specification at:",
+             "# http://teem.sourceforge.net/nrrd/format.html"]
+    for field in HEADER_FIELDS_ORDER:
+        if field in header:
+            lines.append(f"{field}: {_format_header_value(field, header[field])}")
+    for field, value in header.items():
+        if field not in HEADER_FIELDS_ORDER:
+            lines.append(f"{field}:={_format_header_value(field, value)}")
+    nrrd_file.write(("\n".join(lines) + "\n\n").encode("ascii"))
+
+
+class NrrdVolume:
+    """
+    Chunked read access to an attached NRRD file (header and payload in the same file).
+
+    Args:
+        path: path of the NRRD file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as nrrd_file:
+            self.header = nrrd.read_header(nrrd_file)
+            self.data_offset = nrrd_file.tell()
+        if "data file" in self.header or "datafile" in self.header:
+            raise Exception(f"Detached NRRD files are not supported: {path}")
+        self.encoding = self.header["encoding"]
+        if self.encoding not in ["raw", "gzip", "gz"]:
+            raise Exception(f"Unsupported NRRD encoding '{self.encoding}' for chunked access: {path}")
+        self.dtype = nrrd_dtype(self.header)
+        # sizes in the order of the payload, fastest-varying axis first
+        self.sizes = tuple(int(size) for size in self.header["sizes"])
+        self.size = int(np.prod(self.sizes))
+        # the leading non-spatial axes (e.g. vector components, with a 'none' space direction)
+        # are the components of each voxel
+        n_component_axes = 0
+        if self.header.get("space directions") is not None:
+            directions = np.asarray(self.header["space directions"], dtype=float)
+            while n_component_axes < len(directions) and np.isnan(directions[n_component_axes]).any():
+                n_component_axes += 1
+        self.shape = self.sizes[n_component_axes:]
+        self.n_components = int(np.prod(self.sizes[:n_component_axes]))
+
+    @property
+    def voxel_volume(self):
+        """Volume of a voxel, as voxcell.VoxelData.voxel_volume"""
+        directions = np.asarray(self.header["space directions"], dtype=float)[-len(self.shape):]
+        return float(np.abs(np.prod(np.linalg.norm(directions, axis=1))))
+
+    def memmap(self):
+        """Memory-map the payload of a raw-encoded volume, with the NRRD axes order"""
+        if self.encoding != "raw":
+            raise Exception(f"Only raw-encoded NRRD files can be memory-mapped: {self.path}")
+        return np.memmap(self.path, dtype=self.dtype, mode="r", offset=self.data_offset,
+                         shape=self.sizes, order="F")
+
+    def iter_chunks(self, chunk_elements=CHUNK_ELEMENTS):
+        """
+        Iterate on the payload by flat chunks of chunk_elements elements, in the payload order.
+        Volumes of the same sizes are iterated chunk by chunk in lockstep, whatever their dtypes.
+        """
+        if self.encoding == "raw":
+            flat = self.memmap().reshape(-1, order="F")
+            for start in range(0, self.size, chunk_elements):
+                yield np.asarray(flat[start:start + chunk_elements])
+            return
+
+        chunk_bytes = chunk_elements * self.dtype.itemsize
+        n_bytes = self.size * self.dtype.itemsize
+        pending = bytearray()
+        read_bytes = 0
+        for data in self._iter_decompressed(chunk_bytes):
+            pending += data
+            while len(pending) >= chunk_bytes:
+                yield np.frombuffer(bytes(pending[:chunk_bytes]), dtype=self.dtype)
+                del pending[:chunk_bytes]
+                read_bytes += chunk_bytes
+        if read_bytes + len(pending) != n_bytes:
+            raise Exception(f"The payload of {self.path} has {read_bytes + len(pending)} bytes, "
+                            f"expected {n_bytes}")
+        if pending:
+            yield np.frombuffer(bytes(pending), dtype=self.dtype)
+
+    def iter_voxel_chunks(self, chunk_voxels=CHUNK_ELEMENTS):
+        """
+        Iterate on the voxels by chunks of chunk_voxels voxels, in the payload order (i.e. the flat
+        order 'F' of the spatial axes). The chunks have the shape (n,), or (n, n_components) for
+        volumes with several components per voxel.
+        """
+        for chunk in self.iter_chunks(chunk_voxels * self.n_components):
+            yield chunk if self.n_components == 1 else chunk.reshape(-1, self.n_components)
+
+    def _iter_decompressed(self, max_length):
+        with open(self.path, "rb") as nrrd_file:
+            nrrd_file.seek(self.data_offset)
+            # gzip members are decompressed one after the other
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            while True:
+                data = nrrd_file.read(READ_SIZE)
+                if not data:
+                    break
+                while data:
+                    # bounded output, so that highly compressed blocks do not expand at once
+                    yield decompressor.decompress(data, max_length)
+                    if decompressor.eof:
+                        # the remaining input (if any) is the next gzip member
+                        data = decompressor.unused_data
+                        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                    else:
+                        data = decompressor.unconsumed_tail
+            yield decompressor.flush()
+
+    def load(self):
+        """
+        Load the data with the axes order of voxcell (spatial axes first), memory-mapped if raw.
+        """
+        data = self.memmap() if self.encoding == "raw" else self.read()
+        if self.n_components > 1 or len(self.shape) < len(self.sizes):
+            data = data.reshape((self.n_components,) + self.shape, order="F")
+            data = np.moveaxis(data, 0, -1)
+        return data
+
+    def read(self):
+        """Read the whole payload, with the NRRD axes order"""
+        if self.encoding == "raw":
+            return np.array(self.memmap())
+        data = np.empty(self.size, dtype=self.dtype)
+        start = 0
+        for chunk in self.iter_chunks():
+            data[start:start + chunk.size] = chunk
+            start += chunk.size
+        return data.reshape(self.sizes, order="F")
+
+
+def open_volume(nrrd_path):
+    """
+    Open a NRRD volume for chunked access: a NrrdVolume, or the data loaded with nrrd.read for
+    the files that NrrdVolume does not support (detached, other encodings).
+    """
+    header = nrrd.read_header(nrrd_path)
+    if header["encoding"] in ["raw", "gzip", "gz"] and "data file" not in header and "datafile" not in header:
+        return NrrdVolume(nrrd_path)
+    data, _ = nrrd.read(nrrd_path)
+    return data
+
+
+def load_volume(nrrd_path):
+    """
+    Load the data of a NRRD volume, memory-mapped if its encoding is raw.
+    """
+    volume = open_volume(nrrd_path)
+    return volume.load() if isinstance(volume, NrrdVolume) else volume
+
+
+def iter_voxel_chunks(volume, chunk_voxels=CHUNK_ELEMENTS):
+    """
+    Iterate on the voxels of a volume by chunks, in the flat order 'F' of its spatial axes.
+
+    Args:
+        volume: NrrdVolume, or in-memory (or memory-mapped) array with the spatial axes first
+        chunk_voxels: number of voxels of each chunk
+
+    Returns:
+        An iterator on chunks of shape (n,), or (n, n_components) for volumes with
+        several components per voxel.
+    """
+    if isinstance(volume, NrrdVolume):
+        yield from volume.iter_voxel_chunks(chunk_voxels)
+        return
+    n_voxels = int(np.prod(volume.shape[:3]))
+    voxels = volume.reshape((n_voxels, -1) if volume.ndim > 3 else n_voxels, order="F")
+    for start in range(0, n_voxels, chunk_voxels):
+        yield np.asarray(voxels[start:start + chunk_voxels])
+
+
+def _deflate_block(block, compression_level, dictionary):
+    # raw deflate (no gzip header/trailer), primed with the end of the previous block and
+    # ended with a sync flush, so that the blocks can be concatenated in a single stream
+    if dictionary:
+        compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class NrrdWriter:
+    """
+    Write a NRRD file chunk by chunk, in the payload order.
+
+    With several threads, the gzip payload is split in blocks deflated in parallel (as pigz
+    does): each block is primed with the last 32KiB of the previous one and ends on a byte
+    boundary, so that the blocks form a single standard gzip member, readable by pynrrd.
+
+    Args:
+        path: path of the NRRD file to write
+        header: NRRD header of the volume (sizes, space directions, ...). Its type, endian
+            and encoding fields are set from dtype and encoding.
+        dtype: numpy dtype of the data
+        encoding: "gzip", or "raw" (no compression, e.g. for the intermediate files)
+        compression_level: zlib compression level of the gzip encoding
+        threads: number of threads compressing the gzip blocks
+    """
+
+    def __init__(self, path, header, dtype, encoding=ENCODING, compression_level=COMPRESSION_LEVEL, threads=1):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.encoding = encoding
+        if encoding not in ["raw", "gzip", "gz"]:
+            raise Exception(f"Unsupported NRRD encoding '{encoding}'")
+        header = {key: value for (key, value) in header.items() if key not in ["data file", "datafile"]}
+        header["type"] = NUMPY_TO_NRRD_TYPE[self.dtype.str[1:]]
+        header["encoding"] = encoding
+        if self.dtype.itemsize > 1:
+            header["endian"] = NUMPY_TO_NRRD_ENDIAN[self.dtype.str[:1]]
+        else:
+            header.pop("endian", None)
+        self.header = header
+        self.size = int(np.prod([int(size) for size in header["sizes"]]))
+        self.written = 0
+        self.compression_level = compression_level
+
+        self._file = open(path, "wb")
+        write_header(self._file, header)
+        self._compressor = None
+        self._executor = None
+        if encoding != "raw":
+            if threads > 1:
+                self._executor = ThreadPoolExecutor(max_workers=threads)
+                self._pending = deque()
+                self._max_pending = 2 * threads
+                self._dictionary = b""
+                self._crc = 0
+                self._n_bytes = 0
+                # gzip header: deflate, no flags, no modification time, unknown OS
+                self._file.write(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff")
+            else:
+                self._compressor = zlib.compressobj(compression_level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def write(self, chunk):
+        """Append the chunk (flat, in the payload order) to the payload"""
+        data = np.ascontiguousarray(chunk, dtype=self.dtype).reshape(-1)
+        self.written += data.size
+        if self._executor is not None:
+            self._write_blocks(data.tobytes())
+        elif self._compressor is None:
+            self._file.write(data.tobytes())
+        else:
+            self._file.write(self._compressor.compress(data.tobytes()))
+
+    def _write_blocks(self, data):
+        # the checksum is computed in order, while the blocks are deflated by the threads
+        self._crc = zlib.crc32(data, self._crc)
+        self._n_bytes += len(data)
+        view = memoryview(data)
+        for start in range(0, len(data), GZIP_BLOCK_SIZE):
+            block = view[start:start + GZIP_BLOCK_SIZE]
+            self._pending.append(self._executor.submit(_deflate_block, block, self.compression_level,
+                                                       self._dictionary))
+            self._dictionary = bytes(block[-DICTIONARY_SIZE:])
+            # bounded number of blocks in memory, written in order
+            while len(self._pending) >= self._max_pending:
+                self._file.write(self._pending.popleft().result())
+
+    def close(self):
+        if self._executor is not None:
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+            self._executor.shutdown()
+            # empty final block, then the gzip trailer
+            self._file.write(zlib.compressobj(self.compression_level, zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+            self._file.write(struct.pack("<II", self._crc, self._n_bytes & 0xffffffff))
+        elif self._compressor is not None:
+            self._file.write(self._compressor.flush())
+        self._file.close()
+        if self.written != self.size:
+            raise Exception(f"{self.written} elements written in {self.path}, expected {self.size}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+            self._file.close()
+
+
+def write_hemispheres(annotation_path, output_path, encoding=ENCODING, compression_level=COMPRESSION_LEVEL,
+                      threads=1, chunk_voxels=CHUNK_ELEMENTS):
+    """
+    Write the hemispheres volume of an annotation, chunk by chunk, with the values of
+    atlas_commons.utils.assign_hemispheres: 1 for the left hemisphere (the first half of
+    the z axis), 2 for the right one and 0 outside the brain (annotation 0).
+    """
+    annotation = NrrdVolume(annotation_path)
+    (size_x, size_y, size_z) = annotation.shape
+    # in the payload order 'F', the left hemisphere is the first size_z // 2 slices
+    left_voxels = size_x * size_y * (size_z // 2)
+    with NrrdWriter(output_path, annotation.header, np.uint8, encoding=encoding,
+                    compression_level=compression_level, threads=threads) as writer:
+        start = 0
+        for chunk in annotation.iter_voxel_chunks(chunk_voxels):
+            hemispheres = np.full(chunk.size, 2, dtype=np.uint8)
+            hemispheres[:max(left_voxels - start, 0)] = 1
+            hemispheres[chunk == 0] = 0
+            writer.write(hemispheres)
+            start += chunk.size
@@ -1,8 +1,9 @@
 import json
 from kgforge.core import KnowledgeGraphForge
-from blue_cwl import staging, statistics
-import multiprocessing
+from token_broker import read_token
 import voxcell
+from nrrd_volume import NrrdVolume
+from cellCompSummary_payload import create_summary, SummaryCache, DensityResolver, materialize_density_distribution
 
 
 with open(snakemake.log[0], "w") as logfile:
@@ -10,20 +11,29 @@ with open(snakemake.log[0], "w") as logfile:
     with open(snakemake.input.cellCompositionVolume) as volume_json:
         volume_dict = json.load(volume_json)
         nexus_endpoint = snakemake.params.nexus_env
-        forge = KnowledgeGraphForge(snakemake.params.forge_config, bucket=snakemake.params.nexus_bucket,
-                                    endpoint=nexus_endpoint, token=snakemake.params.nexus_token)
+
+        def create_forge():
+            return KnowledgeGraphForge(snakemake.params.forge_config, bucket=snakemake.params.nexus_bucket,
+                                       endpoint=nexus_endpoint, token=read_token(snakemake.params.token_file))
+
+        summary_cache = SummaryCache(snakemake.params.summary_cache_dir, snakemake.input.annotation,
+            snakemake.input.hierarchy)
+        # the densities are looked up locally first, and only downloaded from Nexus if not found
+        density_resolver = DensityResolver(push_manifest=snakemake.input.push_manifest,
+            digest_index=summary_cache.paths_by_digest(), cache_dir=snakemake.params.density_cache_dir,
+            cache_size=int(snakemake.params.density_cache_size_gb * 1024**3),
+            forge_factory=create_forge)
 
         logfile.write(f"Creating density_distribution from endpoint '{nexus_endpoint}' in {snakemake.output.intermediate_density_distribution}\n")
-        density_distribution = staging.materialize_density_distribution(forge=forge, dataset=volume_dict,
+        density_distribution = materialize_density_distribution(volume_dict, density_resolver,
             output_file=snakemake.output.intermediate_density_distribution)
 
         logfile.write(f"Computing CellCompositionSummary payload for endpoint '{nexus_endpoint}'\n")
 
-        with multiprocessing.Pool(processes=snakemake.params.cores) as pool:
-            summary_statistics = statistics.atlas_densities_composition_summary(density_distribution,
-                voxcell.RegionMap.load_json(snakemake.input.hierarchy),
-                voxcell.VoxelData.load_nrrd(snakemake.input.annotation),
-                map_function=pool.imap)
-            logfile.write(f"Writing CellCompositionSummary payload in {snakemake.output.summary_statistics}\n")
-            with open(snakemake.output.summary_statistics, "w") as outfile:
-                outfile.write(json.dumps(summary_statistics, indent=4))
+        summary_statistics = create_summary(density_distribution,
+            voxcell.RegionMap.load_json(snakemake.input.hierarchy),
+            NrrdVolume(snakemake.input.annotation),
+            processes=snakemake.threads, cache=summary_cache)
+        logfile.write(f"Writing CellCompositionSummary payload in {snakemake.output.summary_statistics}\n")
+        with open(snakemake.output.summary_statistics, "w") as outfile:
+            outfile.write(json.dumps(summary_statistics, indent=4))
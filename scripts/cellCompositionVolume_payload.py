@@ -1,6 +1,5 @@
 from pathlib import Path
-from kgforge.core import KnowledgeGraphForge
-from cellCompVolume_payload import create_payload
+from cellCompVolume_payload import create_payload_from_manifest
 
 with open(snakemake.log[0], "w") as logfile:
     total_densities = 0
@@ -10,12 +9,8 @@ with open(snakemake.log[0], "w") as logfile:
         total_densities += n_densities
     logfile.write(f"\nExpecting {total_densities} densities in the CellCompositionVolume payload\n")
 
-    forge = KnowledgeGraphForge(snakemake.params.forge_config, bucket=snakemake.params.nexus_bucket,
-                                endpoint=snakemake.params.nexus_env, token=snakemake.params.nexus_token)
-
-    logfile.write(
-        f"Creating CellCompositionVolume payload for atlasRelease {snakemake.params.atlas_release_id} "
-        f"with tag '{snakemake.params.resource_tag}' from endpoint '{snakemake.params.nexus_env}'\n")
-    create_payload(forge, snakemake.params.atlas_release_id, snakemake.output.payload, total_densities,
-        endpoint=snakemake.params.nexus_env, bucket=snakemake.params.nexus_bucket, tag=snakemake.params.resource_tag)
+    logfile.write(f"Creating CellCompositionVolume payload from the local densities "
+                  f"and the push manifest {snakemake.input.push_manifest}\n")
+    create_payload_from_manifest(snakemake.params.input_paths, snakemake.input.push_manifest,
+        snakemake.output.payload, files_ext=snakemake.params.files_ext)
     logfile.write(f"CellCompositionVolume payload created: {snakemake.output.payload}\n")
@@ -1,10 +1,34 @@
-from voxcell import VoxelData
+import numpy as np
+from nrrd_volume import NrrdVolume, NrrdWriter
 
-gad67 = VoxelData.load_nrrd(snakemake.params.gad67)
-vip = VoxelData.load_nrrd(snakemake.params.vip)
-sst = VoxelData.load_nrrd(snakemake.params.sst)
-pv = VoxelData.load_nrrd(snakemake.params.pv)
-lamp5 = VoxelData(gad67.raw - vip.raw - sst.raw - pv.raw,
-    gad67.voxel_dimensions, gad67.offset)
+# lamp5 = gad67 - vip - sst - pv, computed chunk by chunk so that the four input volumes
+# and the output are never loaded entirely in memory
+gad67 = NrrdVolume(snakemake.params.gad67)
+others = [NrrdVolume(snakemake.params.vip), NrrdVolume(snakemake.params.sst), NrrdVolume(snakemake.params.pv)]
+for volume in others:
+    if volume.sizes != gad67.sizes:
+        raise Exception(f"The shape of {volume.path} {volume.sizes} differs from the shape of "
+                        f"{gad67.path} {gad67.sizes}")
+dtype = np.result_type(gad67.dtype, *[volume.dtype for volume in others])
+clamp_negative = snakemake.params.clamp_negative
 
-lamp5.save_nrrd(snakemake.output[0])
+clamped_count = 0
+with open(snakemake.log[0], "w") as logfile:
+    with NrrdWriter(snakemake.output[0], gad67.header, dtype, encoding=snakemake.params.nrrd_encoding,
+                    compression_level=snakemake.params.compression_level, threads=snakemake.threads) as writer:
+        chunks = zip(gad67.iter_chunks(), *[volume.iter_chunks() for volume in others])
+        lamp5 = None
+        for (gad67_chunk, *other_chunks) in chunks:
+            if lamp5 is None or lamp5.size != gad67_chunk.size:
+                lamp5 = np.empty(gad67_chunk.size, dtype=dtype)
+            np.copyto(lamp5, gad67_chunk)
+            for chunk in other_chunks:
+                np.subtract(lamp5, chunk, out=lamp5)
+            if clamp_negative:
+                negative = lamp5 < 0
+                clamped_count += int(np.count_nonzero(negative))
+                lamp5[negative] = 0
+            writer.write(lamp5)
+    logfile.write(f"lamp5 density computed in {snakemake.output[0]}\n")
+    if clamp_negative:
+        logfile.write(f"{clamped_count} voxels with a negative lamp5 density clamped to 0\n")
@@ -1,6 +1,4 @@
-import voxcell
-from atlas_commons.utils import assign_hemispheres
+from nrrd_volume import write_hemispheres
 
-annotation = voxcell.VoxelData.load_nrrd(snakemake.input[0])
-hemispheres = assign_hemispheres(annotation)
-hemispheres.save_nrrd(snakemake.output[0])
+write_hemispheres(snakemake.input[0], snakemake.output[0], encoding=snakemake.params.nrrd_encoding,
+                  compression_level=snakemake.params.compression_level, threads=snakemake.threads)
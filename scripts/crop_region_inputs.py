@@ -0,0 +1,6 @@
+from customize_pipeline.customize_pipeline import crop_region_inputs
+
+# crop the inputs of a region-specific rule to the bounding box of the region
+crop_region_inputs(snakemake.input.hierarchy, snakemake.input.annotation, snakemake.params.region_id,
+                   snakemake.params.inputs, snakemake.params.outputs, snakemake.output.crop_file,
+                   snakemake.params.margin)
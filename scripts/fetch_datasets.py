@@ -0,0 +1,27 @@
+from kgforge.core import KnowledgeGraphForge
+from token_broker import read_token
+from dataset_cache import DatasetCache
+from bulk_fetch import fetch_datasets
+
+cache = None
+if snakemake.params.cache_dir:
+    cache = DatasetCache(snakemake.params.cache_dir, int(snakemake.params.cache_size_gb * 1024**3))
+
+
+def create_forge():
+    # the forge of default_fetch, built once per worker thread
+    return KnowledgeGraphForge(snakemake.params.forge_config, bucket=snakemake.params.nexus_bucket,
+                               endpoint=snakemake.params.nexus_env, token=read_token(snakemake.params.token_file))
+
+
+with open(snakemake.log[0], "w") as logfile:
+    def log(message):
+        logfile.write(message + "\n")
+        logfile.flush()
+
+    log(f"Fetching {len(snakemake.params.manifest)} datasets with "
+        f"{snakemake.params.connections} concurrent connections")
+    failed = fetch_datasets(create_forge, snakemake.params.manifest, snakemake.params.connections,
+        cache=cache, log=log)
+if failed:
+    raise Exception(f"The datasets of {', '.join(failed)} could not be fetched, see {snakemake.log[0]}")
@@ -0,0 +1,14 @@
+from token_broker import read_token
+from nexus_tag_client import NexusTagClient
+from cellCompVolume_payload import create_push_manifest
+
+with open(snakemake.log[0], "w") as logfile:
+    client = NexusTagClient(snakemake.params.nexus_env, snakemake.params.nexus_bucket,
+                            read_token(snakemake.params.token_file))
+
+    logfile.write(
+        f"Creating the manifest of the ME-type densities pushed with tag '{snakemake.params.resource_tag}' "
+        f"from the push log {snakemake.input.push_log}\n")
+    manifest = create_push_manifest(client, snakemake.input.push_log, snakemake.params.input_paths,
+        snakemake.output.push_manifest, tag=snakemake.params.resource_tag, files_ext=snakemake.params.files_ext)
+    logfile.write(f"{len(manifest)} pushed ME-type densities in the manifest {snakemake.output.push_manifest}\n")
@@ -0,0 +1,38 @@
+'''
+Nexus access token of the push scripts, given either directly or as a token file.
+
+A token file is read when the script connects to Nexus (and not when the
+pipeline is launched), so that a refreshed token is picked up by the late steps.
+It can be the plain-text file of the CLI blue-brain-token-fetch, or the JSON token
+file kept up to date by the pipeline token broker (read by token_broker.read_token,
+so token_broker.py at the root of the repository must be in the PYTHONPATH).
+
+'''
+
+from token_broker import read_token
+
+
+def add_token_args(parser):
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        "--access-token",
+        dest="access_token",
+        metavar="<NAME>",
+        help="Access token (JWT) to push data to Nexus")
+
+    group.add_argument(
+        "--access-token-file",
+        dest="access_token_file",
+        metavar="<FILE PATH>",
+        help="File containing the access token (JWT) to push data to Nexus, read when connecting to Nexus")
+
+
+def get_access_token(args):
+    if args.access_token:
+        return args.access_token
+
+    with open(args.access_token_file) as token_file:
+        content = token_file.read().strip()
+    if content.startswith("{"):
+        return read_token(args.access_token_file)
+    return content
@@ -1,5 +1,7 @@
 # current directory where this very script is
 export BASEDIR=$(dirname "$0")
+# the push scripts read the JSON token files with the token_broker module of the repository
+export PYTHONPATH=$BASEDIR/..${PYTHONPATH:+:$PYTHONPATH}
 
 # Loading the variables
 source $BASEDIR/config.sh
@@ -102,13 +104,11 @@ parcellationexport --hierarchy $COMPUTED_ONTOLOGY_MOUSE_CCF_SPLIT_L2L3 \
 
 
 echo "📤 pushing AtlasRelease and its components onto Nexus..."
-# reading the token from the file
-ACCESS_TOKEN=`cat $TOKEN_FILE`
 python $BASEDIR/push_atlasrelease.py --forge-config $FORGE_CONFIG \
   --nexus-env $NEXUS_DESTINATION_ENV \
   --nexus-org $NEXUS_DESTINATION_ORG \
   --nexus-proj $NEXUS_DESTINATION_PROJ \
-  --access-token $ACCESS_TOKEN \
+  --access-token-file $TOKEN_FILE \
   --nexus-id-aibs-ccf-srs $NEXUS_ID_AIBS_MOUSE_CCF_SRS \
   --hierarchy $COMPUTED_ONTOLOGY_MOUSE_CCF_SPLIT_L2L3 \
   --hierarchy-ld $COMPUTED_ONTOLOGY_MOUSE_CCF_SPLIT_L2L3_JSONLD \
@@ -118,13 +118,12 @@ python $BASEDIR/push_atlasrelease.py --forge-config $FORGE_CONFIG \
 
 
 echo "📤 pushing placement hints and orientation volumes onto Nexus..."
-ACCESS_TOKEN=`cat $TOKEN_FILE`
 ATLAS_RELEASE_ID=`cat $PUSHED_ATLAS_RELEASE_ID_TXT_FILE`
 python $BASEDIR/push_non_mask_volumes.py --forge-config $FORGE_CONFIG \
   --nexus-env $NEXUS_DESTINATION_ENV \
   --nexus-org $NEXUS_DESTINATION_ORG \
   --nexus-proj $NEXUS_DESTINATION_PROJ \
-  --access-token $ACCESS_TOKEN \
+  --access-token-file $TOKEN_FILE \
   --nexus-id-aibs-ccf-srs $NEXUS_ID_AIBS_MOUSE_CCF_SRS \
   --atlasrelease-id $ATLAS_RELEASE_ID \
   --hierarchy $COMPUTED_ONTOLOGY_MOUSE_CCF_SPLIT_L2L3 \
@@ -134,45 +133,44 @@ python $BASEDIR/push_non_mask_volumes.py --forge-config $FORGE_CONFIG \
 
 
 echo "📤 pushing regions mask onto Nexus..."
-# reading the token from the file
-ACCESS_TOKEN=`cat $TOKEN_FILE`
 ATLAS_RELEASE_ID=`cat $PUSHED_ATLAS_RELEASE_ID_TXT_FILE`
 python $BASEDIR/push_region_masks.py --forge-config $FORGE_CONFIG \
   --nexus-env $NEXUS_DESTINATION_ENV \
   --nexus-org $NEXUS_DESTINATION_ORG \
   --nexus-proj $NEXUS_DESTINATION_PROJ \
-  --access-token $ACCESS_TOKEN \
+  --access-token-file $TOKEN_FILE \
   --nexus-id-aibs-ccf-srs $NEXUS_ID_AIBS_MOUSE_CCF_SRS \
   --atlasrelease-id $ATLAS_RELEASE_ID \
   --hierarchy $COMPUTED_ONTOLOGY_MOUSE_CCF_SPLIT_L2L3 \
-  --region-mask-volume-dir $COMPUTED_ANNOTATION_MASKS_DIR
+  --region-mask-volume-dir $COMPUTED_ANNOTATION_MASKS_DIR \
+  --nrrd-manifest $WORKING_DIR/region_masks_nrrd_manifest.json \
+  --journal $WORKING_DIR/push_region_masks_journal.jsonl $PUSH_RESUME_OPTION
 
 
 echo "📤 pushing regions meshes onto Nexus..."
-# reading the token from the file
-ACCESS_TOKEN=`cat $TOKEN_FILE`
 ATLAS_RELEASE_ID=`cat $PUSHED_ATLAS_RELEASE_ID_TXT_FILE`
 python $BASEDIR/push_region_meshes.py --forge-config $FORGE_CONFIG \
   --nexus-env $NEXUS_DESTINATION_ENV \
   --nexus-org $NEXUS_DESTINATION_ORG \
   --nexus-proj $NEXUS_DESTINATION_PROJ \
-  --access-token $ACCESS_TOKEN \
+  --access-token-file $TOKEN_FILE \
   --nexus-id-aibs-ccf-srs $NEXUS_ID_AIBS_MOUSE_CCF_SRS \
   --atlasrelease-id $ATLAS_RELEASE_ID \
   --hierarchy $COMPUTED_ONTOLOGY_MOUSE_CCF_SPLIT_L2L3 \
-  --region-mesh-dir $COMPUTED_ANNOTATION_MESHES_DIR
+  --region-mesh-dir $COMPUTED_ANNOTATION_MESHES_DIR \
+  --journal $WORKING_DIR/push_region_meshes_journal.jsonl $PUSH_RESUME_OPTION
 
 
 echo "📤 pushing regions summaries onto Nexus..."
-# reading the token from the file
-ACCESS_TOKEN=`cat $TOKEN_FILE`
 ATLAS_RELEASE_ID=`cat $PUSHED_ATLAS_RELEASE_ID_TXT_FILE`
 python $BASEDIR/push_region_summaries.py --forge-config $FORGE_CONFIG \
   --nexus-env $NEXUS_DESTINATION_ENV \
   --nexus-org $NEXUS_DESTINATION_ORG \
   --nexus-proj $NEXUS_DESTINATION_PROJ \
-  --access-token $ACCESS_TOKEN \
+  --access-token-file $TOKEN_FILE \
   --nexus-id-aibs-ccf-srs $NEXUS_ID_AIBS_MOUSE_CCF_SRS \
   --atlasrelease-id $ATLAS_RELEASE_ID \
   --hierarchy $COMPUTED_ONTOLOGY_MOUSE_CCF_SPLIT_L2L3 \
-  --region-metadata $COMPUTED_REGIONS_METADATA
\ No newline at end of file
+  --region-metadata $COMPUTED_REGIONS_METADATA \
+  --batch-size $PUSH_SUMMARIES_BATCH_SIZE \
+  --journal $WORKING_DIR/push_region_summaries_journal.jsonl $PUSH_RESUME_OPTION
\ No newline at end of file
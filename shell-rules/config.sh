@@ -98,3 +98,10 @@ export COMPUTED_PLACEMENT_HINTS_DIR="$WORKING_DIR/placement_hints"
 # This file contains the Nexus Resource ID of the AtlasRelease created by this pipeline.
 # This file is create by push_atlasrelease.py
 export PUSHED_ATLAS_RELEASE_ID_TXT_FILE="$WORKING_DIR/new_atlas_release_id.txt"
+
+# Set to "--resume" to resume an interrupted push of the region masks, meshes and summaries
+# from their journal in $WORKING_DIR (push_region_*_journal.jsonl), instead of pushing everything again.
+export PUSH_RESUME_OPTION=""
+
+# Number of region summaries registered in Nexus per request
+export PUSH_SUMMARIES_BATCH_SIZE=100
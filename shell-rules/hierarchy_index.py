@@ -0,0 +1,244 @@
+'''
+Flat index of the brain region hierarchy (1.json), shared by the push scripts.
+
+Flattening the hierarchy with TreeIndexer.flattenTree is done once, the result
+is stored in a binary sidecar file next to the hierarchy (<hierarchy>.idx) and
+keyed by the SHA-256 digest of the hierarchy file. The following loads of the
+same hierarchy memory-map the sidecar instead of parsing and walking the JSON tree:
+a region is looked up by binary search in the sorted ids, and only its own node
+is decoded.
+
+Sidecar layout:
+- magic bytes + header length (uint64, little endian)
+- JSON header (digest, root id, offsets of the sections below)
+- raw int64 arrays: region ids, parent ids (-1 for the root), ascendants offsets, ascendants,
+  sorted region ids and their positions, nodes offsets
+- nodes: the scalar attributes (id, name, acronym, ...) of each node as UTF-8 JSON objects,
+  concatenated in the order of the region ids
+
+'''
+
+import os
+import json
+import mmap
+import struct
+import hashlib
+import numpy as np
+import blue_brain_atlas_web_exporter.TreeIndexer as TreeIndexer
+
+
+INDEX_MAGIC = b"BBAHIDX2"
+INDEX_EXTENSION = ".idx"
+ARRAY_DTYPE = "<i8"
+NO_PARENT = -1
+
+
+def hierarchy_digest(hierarchy_path, chunk_size=1 << 20):
+    sha256 = hashlib.sha256()
+    with open(hierarchy_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def load_hierarchy_root(hierarchy_path):
+    brain_onto_json = json.loads(open(hierarchy_path, "r").read())
+    # sometimes, the 1.json has its content in a "msg" sub prop (the original version has).
+    # and some other versions don't. Here we deal with both
+    if "msg" in brain_onto_json:
+        return brain_onto_json["msg"][0]
+    return brain_onto_json
+
+
+class HierarchyIndex:
+    """
+    Flat view of the brain region hierarchy.
+
+    Indexing the HierarchyIndex with a region id returns the node of that region,
+    with its scalar attributes (id, name, acronym, ...) and its '_ascendants',
+    as TreeIndexer.flattenTree does.
+    """
+
+    def __init__(self, arrays, nodes, root_id):
+        self.ids = arrays["ids"]
+        self.parents = arrays["parents"]
+        self._ascendants_offsets = arrays["ascendants_offsets"]
+        self._ascendants = arrays["ascendants"]
+        self._sorted_ids = arrays["sorted_ids"]
+        self._sorted_positions = arrays["sorted_positions"]
+        self._nodes_offsets = arrays["nodes_offsets"]
+        self._nodes = nodes
+        self.root_id = root_id
+
+    @property
+    def root_node(self):
+        return self[self.root_id]
+
+    def _position(self, region_id):
+        """Position of the region in the ids, None if the region is not in the hierarchy"""
+        try:
+            region_id = int(region_id)
+        except (TypeError, ValueError):
+            return None
+        k = int(np.searchsorted(self._sorted_ids, region_id))
+        if k == len(self._sorted_ids) or self._sorted_ids[k] != region_id:
+            return None
+        return int(self._sorted_positions[k])
+
+    def parent(self, region_id):
+        """Id of the parent region, None for the root"""
+        i = self._position(region_id)
+        if i is None:
+            raise KeyError(region_id)
+        parent_id = int(self.parents[i])
+        return None if parent_id == NO_PARENT else parent_id
+
+    def ascendants(self, region_id):
+        i = self._position(region_id)
+        if i is None:
+            raise KeyError(region_id)
+        return [int(a) for a in self._ascendants[self._ascendants_offsets[i]:self._ascendants_offsets[i + 1]]]
+
+    def __getitem__(self, region_id):
+        i = self._position(region_id)
+        if i is None:
+            raise KeyError(region_id)
+        node = json.loads(bytes(self._nodes[self._nodes_offsets[i]:self._nodes_offsets[i + 1]]).decode("utf-8"))
+        node["_ascendants"] = self.ascendants(region_id)
+        return node
+
+    def __contains__(self, region_id):
+        return self._position(region_id) is not None
+
+    def __iter__(self):
+        return (int(region_id) for region_id in self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def node_attributes(node):
+    """Scalar attributes of a node (its children and the lists computed by flattenTree excluded)"""
+    return {key: value for (key, value) in node.items() if not isinstance(value, (list, dict))}
+
+
+def build_index(hierarchy_root):
+    """Flatten the hierarchy and compute the arrays and the nodes of the index"""
+    flat_tree = TreeIndexer.flattenTree(hierarchy_root)
+
+    parent_map = {hierarchy_root["id"]: NO_PARENT}
+    nodes_to_visit = [hierarchy_root]
+    while nodes_to_visit:
+        node = nodes_to_visit.pop()
+        for child in node.get("children", []):
+            parent_map[child["id"]] = node["id"]
+            nodes_to_visit.append(child)
+
+    ids = np.fromiter(flat_tree.keys(), dtype=ARRAY_DTYPE, count=len(flat_tree))
+    parents = np.array([parent_map.get(region_id, NO_PARENT) for region_id in flat_tree], dtype=ARRAY_DTYPE)
+    ascendants_lists = [flat_tree[region_id].get("_ascendants", []) for region_id in flat_tree]
+    ascendants_offsets = np.zeros(len(ascendants_lists) + 1, dtype=ARRAY_DTYPE)
+    ascendants_offsets[1:] = np.cumsum([len(a) for a in ascendants_lists])
+    ascendants = np.array([a for asc in ascendants_lists for a in asc], dtype=ARRAY_DTYPE)
+    sorted_positions = np.argsort(ids, kind="stable").astype(ARRAY_DTYPE)
+
+    encoded_nodes = [json.dumps(node_attributes(flat_tree[region_id])).encode("utf-8") for region_id in flat_tree]
+    nodes_offsets = np.zeros(len(encoded_nodes) + 1, dtype=ARRAY_DTYPE)
+    nodes_offsets[1:] = np.cumsum([len(node) for node in encoded_nodes])
+
+    arrays = {"ids": ids, "parents": parents, "ascendants_offsets": ascendants_offsets,
+              "ascendants": ascendants, "sorted_ids": ids[sorted_positions],
+              "sorted_positions": sorted_positions, "nodes_offsets": nodes_offsets}
+    return HierarchyIndex(arrays, b"".join(encoded_nodes), hierarchy_root["id"])
+
+
+ARRAY_NAMES = ["ids", "parents", "ascendants_offsets", "ascendants", "sorted_ids", "sorted_positions",
+               "nodes_offsets"]
+
+
+def write_index(index, digest, index_path):
+    arrays = {
+        "ids": index.ids,
+        "parents": index.parents,
+        "ascendants_offsets": index._ascendants_offsets,
+        "ascendants": index._ascendants,
+        "sorted_ids": index._sorted_ids,
+        "sorted_positions": index._sorted_positions,
+        "nodes_offsets": index._nodes_offsets,
+    }
+    nodes = bytes(index._nodes)
+
+    # the header size depends on the offsets it contains, so the sections are laid out
+    # after a fixed-size, space-padded, header
+    header_size = 4096
+    offset = len(INDEX_MAGIC) + 8 + header_size
+    sections = {}
+    for name in ARRAY_NAMES:
+        sections[name] = [offset, int(arrays[name].size)]
+        offset += arrays[name].size * np.dtype(ARRAY_DTYPE).itemsize
+    sections["nodes"] = [offset, len(nodes)]
+    header = json.dumps({"digest": digest, "root_id": index.root_id, "dtype": ARRAY_DTYPE,
+                         "sections": sections}).encode("utf-8")
+    if len(header) > header_size:
+        raise Exception(f"The hierarchy index header is larger than {header_size} bytes")
+
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as index_file:
+        index_file.write(INDEX_MAGIC)
+        index_file.write(struct.pack("<Q", header_size))
+        index_file.write(header.ljust(header_size, b" "))
+        for name in ARRAY_NAMES:
+            index_file.write(np.ascontiguousarray(arrays[name], dtype=ARRAY_DTYPE).tobytes())
+        index_file.write(nodes)
+    # atomic, so that concurrent push processes never read a partially written index
+    os.replace(tmp_path, index_path)
+
+
+def read_index(index_path, digest):
+    """Memory-map the index sidecar, return None if it does not match the digest"""
+    with open(index_path, "rb") as index_file:
+        mm = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic_size = len(INDEX_MAGIC)
+    if mm[:magic_size] != INDEX_MAGIC:
+        return None
+    header_size = struct.unpack("<Q", mm[magic_size:magic_size + 8])[0]
+    header = json.loads(mm[magic_size + 8:magic_size + 8 + header_size].decode("utf-8"))
+    if header["digest"] != digest or header["dtype"] != ARRAY_DTYPE:
+        return None
+
+    sections = header["sections"]
+    arrays = {}
+    for name in ARRAY_NAMES:
+        offset, count = sections[name]
+        arrays[name] = np.frombuffer(mm, dtype=ARRAY_DTYPE, count=count, offset=offset)
+    nodes_offset, nodes_size = sections["nodes"]
+    nodes = memoryview(mm)[nodes_offset:nodes_offset + nodes_size]
+    return HierarchyIndex(arrays, nodes, header["root_id"])
+
+
+def load(hierarchy_path, index_path=None):
+    """
+    Load the flat index of the hierarchy, building and caching it if needed.
+
+    Args:
+        hierarchy_path: path of the hierarchy JSON file (1.json)
+        index_path: path of the sidecar index file, <hierarchy_path>.idx by default
+    """
+    if index_path is None:
+        index_path = hierarchy_path + INDEX_EXTENSION
+    digest = hierarchy_digest(hierarchy_path)
+
+    if os.path.isfile(index_path):
+        try:
+            index = read_index(index_path, digest)
+        except (ValueError, KeyError, struct.error, json.JSONDecodeError):
+            index = None
+        if index is not None:
+            return index
+
+    index = build_index(load_hierarchy_root(hierarchy_path))
+    try:
+        write_index(index, digest, index_path)
+    except OSError as e:
+        print(f"Warning: could not write the hierarchy index {index_path}: {e}")
+    return index
@@ -0,0 +1,125 @@
+'''
+Header-only scanner of NRRD files.
+
+Only the NRRD headers are read (never the data payload), concurrently over all
+the files of a directory. The metadata needed by the payload builders (sizes,
+type, encoding, endianness, space directions, file size) is gathered into a
+manifest, optionally cached as JSON and reused for the files whose size and
+modification time did not change.
+
+'''
+
+import os
+import glob
+import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nrrd
+
+
+MANIFEST_VERSION = 1
+
+
+def _space_directions_to_list(space_directions):
+    if space_directions is None:
+        return None
+    directions = []
+    for row in np.asarray(space_directions, dtype=float):
+        # non-spatial axes (e.g. vector components) have a 'none' direction, read as NaNs
+        directions.append(None if np.isnan(row).any() else row.tolist())
+    return directions
+
+
+def read_nrrd_metadata(filepath):
+    """Read the header of a NRRD file and return the metadata used to describe the volume"""
+    header = nrrd.read_header(filepath)
+    stat = os.stat(filepath)
+    sizes = [int(size) for size in header["sizes"]]
+    space_directions = _space_directions_to_list(header.get("space directions"))
+    if space_directions is None:
+        space_sizes = sizes[-3:]
+    else:
+        space_sizes = [size for size, direction in zip(sizes, space_directions) if direction is not None]
+    space_origin = header.get("space origin")
+    return {
+        "file": filepath,
+        "file_size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sizes": sizes,
+        "space_sizes": space_sizes,
+        "type": header["type"],
+        "encoding": header["encoding"],
+        "endian": header.get("endian", "little"),
+        "space_directions": space_directions,
+        "space_origin": None if space_origin is None else np.asarray(space_origin, dtype=float).tolist(),
+    }
+
+
+def resolution(nrrd_metadata):
+    """
+    Voxel size of the volume (in the unit of the space directions, i.e. µm for the atlas volumes),
+    as an int when it is a whole number.
+    """
+    space_directions = [d for d in (nrrd_metadata["space_directions"] or []) if d is not None]
+    if not space_directions:
+        raise Exception(f"No space directions in the header of {nrrd_metadata['file']}, "
+                        "the resolution can not be determined")
+    voxel_size = float(np.linalg.norm(space_directions[0]))
+    return int(round(voxel_size)) if np.isclose(voxel_size, round(voxel_size)) else voxel_size
+
+
+def _is_up_to_date(entry, filepath):
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return False
+    return entry["file_size"] == stat.st_size and entry["mtime"] == stat.st_mtime
+
+
+def index_directory(dir_path, pattern="*.nrrd", workers=8, manifest_path=None):
+    """
+    Read the headers of all the NRRD files of a directory.
+
+    Args:
+        dir_path: directory containing the NRRD files
+        pattern: glob pattern of the files to index
+        workers: number of headers read concurrently
+        manifest_path: optional JSON file caching the manifest between runs
+
+    Returns:
+        The manifest, a dict mapping each file path to its metadata (see read_nrrd_metadata).
+    """
+    filepaths = sorted(glob.glob(os.path.join(dir_path, pattern)))
+
+    cached = {}
+    if manifest_path and os.path.isfile(manifest_path):
+        try:
+            with open(manifest_path, "r") as manifest_file:
+                manifest_json = json.load(manifest_file)
+            if manifest_json.get("version") == MANIFEST_VERSION:
+                cached = manifest_json["files"]
+        except (OSError, ValueError, KeyError):
+            cached = {}
+
+    manifest = {}
+    to_read = []
+    for filepath in filepaths:
+        entry = cached.get(filepath)
+        if entry is not None and _is_up_to_date(entry, filepath):
+            manifest[filepath] = entry
+        else:
+            to_read.append(filepath)
+
+    if to_read:
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            for filepath, metadata in zip(to_read, executor.map(read_nrrd_metadata, to_read)):
+                manifest[filepath] = metadata
+        manifest = {filepath: manifest[filepath] for filepath in filepaths}
+
+        if manifest_path:
+            tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as manifest_file:
+                json.dump({"version": MANIFEST_VERSION, "files": manifest}, manifest_file)
+            os.replace(tmp_path, manifest_path)
+
+    return manifest
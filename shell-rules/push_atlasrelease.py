@@ -21,7 +21,9 @@ import os
 import numpy as np
 import nrrd
 from datetime import datetime
-import blue_brain_atlas_web_exporter.TreeIndexer as TreeIndexer
+import hierarchy_index
+import nrrd_index
+from access_token import add_token_args, get_access_token
 
 
 
@@ -107,9 +109,12 @@ VOLUMETRICDATALAYER_SCHEMAS_ID = "https://neuroshapes.org/dash/volumetricdatalay
 ONTOLOGY_SCHEMAS_ID = "https://neuroshapes.org/dash/ontology"
 ATLASRELEASE_SCHEMAS_ID = "https://neuroshapes.org/dash/atlasrelease"
 
-def generate_payload_volumetric_data_layer(filepath, id, name, description, type, atlas_release_id, srs_id, region_node, sample_modality, resolution):
-    
-    nrrd_header = nrrd.read_header(filepath)
+def generate_payload_volumetric_data_layer(filepath, id, name, description, type, atlas_release_id, srs_id, region_node, sample_modality, resolution=None, nrrd_metadata=None):
+    # nrrd_metadata can be provided from a directory index (nrrd_index.index_directory) to avoid reading the header again
+    if nrrd_metadata is None:
+        nrrd_metadata = nrrd_index.read_nrrd_metadata(filepath)
+    if resolution is None:
+        resolution = nrrd_index.resolution(nrrd_metadata)
     return {
         "@id": id,
         "@type": [
@@ -134,9 +139,9 @@ def generate_payload_volumetric_data_layer(filepath, id, name, description, type
             }
         },
         
-        "bufferEncoding": nrrd_header["encoding"],
+        "bufferEncoding": nrrd_metadata["encoding"],
 
-        "componentEncoding": NRRD_TYPES_TO_NUMPY[nrrd_header["type"]],
+        "componentEncoding": NRRD_TYPES_TO_NUMPY[nrrd_metadata["type"]],
 
         "contribution": {
             "@type": "Contribution",
@@ -158,24 +163,14 @@ def generate_payload_volumetric_data_layer(filepath, id, name, description, type
             "name": dataSampleModalities[sample_modality],
             "size": dataSampleModalitiesNumberOfComponents[sample_modality],
             },
-            {
-            "@type": "SpaceDimension",
-            "size": 528,
-            "unitCode": "voxel"
-            },
-            {
-            "@type": "SpaceDimension",
-            "size": 320,
-            "unitCode": "voxel"
-            },
-            {
+            *[{
             "@type": "SpaceDimension",
-            "size": 456,
+            "size": space_size,
             "unitCode": "voxel"
-            }
+            } for space_size in nrrd_metadata["space_sizes"]]
         ],
    
-        "endianness": nrrd_header.get("endian", "little"),
+        "endianness": nrrd_metadata["endian"],
 
         "fileExtension": "nrrd",
         "isRegisteredIn": {
@@ -346,12 +341,7 @@ def parse_args():
         metavar="<NAME>",
         help="Name of the Nexus project to push data to")
 
-    parser.add_argument(
-        "--access-token",
-        dest="access_token",
-        required=True,
-        metavar="<NAME>",
-        help="Access token (JWT) to push data to Nexus")
+    add_token_args(parser)
         
     parser.add_argument(
         "--nexus-id-aibs-ccf-srs",
@@ -406,7 +396,7 @@ def main():
         args.forge_config,
         endpoint=args.nexus_env,
         bucket=f"{args.nexus_org}/{args.nexus_proj}",
-        token=args.access_token,
+        token=get_access_token(args),
         debug=True,
     )
 
@@ -426,22 +416,12 @@ def main():
     print("Using SRS: ", srs_id)
 
     # Reading the brain region ontology, to later being able to generate
-    # better names that include brain region labels
-    brain_onto_json = json.loads(open(args.hierarchy, "r").read())
-    # sometimes, the 1.json has its content in a "msg" sub prop (the original version has).
-    # and some other versions don't. Here we deal with both
-    if "msg" in brain_onto_json:
-        onto_flat_tree = TreeIndexer.flattenTree(brain_onto_json['msg'][0])
-    else:
-        onto_flat_tree = TreeIndexer.flattenTree(brain_onto_json)
-
-    # finding the root node of the brain region ontology
-    root_node = None
-    for node_id in onto_flat_tree:
-        node = onto_flat_tree[node_id]
-        if len(node["_ascendants"]) == 0:
-            root_node = node
-            break
+    # better names that include brain region labels.
+    # The flattened hierarchy is cached in a sidecar file shared by all the push scripts
+    onto_flat_tree = hierarchy_index.load(args.hierarchy)
+
+    # the root node of the brain region ontology
+    root_node = onto_flat_tree.root_node
 
     # Generating the base payload for the brain region ontology
     print("Pushing to Nexus: Brain region ontology...")
@@ -457,16 +437,19 @@ def main():
 
     # Generating the base payload for the brain annotation volume
     print("Pushing to Nexus: annotation volume...")
+    annotation_metadata = nrrd_index.read_nrrd_metadata(args.annotation_volume)
+    annotation_resolution = nrrd_index.resolution(annotation_metadata)
     brain_annotation_volume_payload = generate_payload_volumetric_data_layer(args.annotation_volume, 
         brain_annotation_volume_id,
-        "BBP Mouse Brain Annotation Volume, 25µm",
+        f"BBP Mouse Brain Annotation Volume, {annotation_resolution}µm",
         "This raster volume contains the brain region annotation as IDs, including the separation of cortical layers 2 and 3.",
         "BrainParcellationDataLayer",
         atlas_release_id,
         srs_id,
         root_node,
         "PARCELLATION_ID",
-        25,
+        annotation_resolution,
+        nrrd_metadata=annotation_metadata,
     )
     nexus_resource_annotation_volume = Resource.from_json(brain_annotation_volume_payload)
     nexus_resource_annotation_volume.distribution = forge.attach(args.annotation_volume, content_type="application/nrrd")
@@ -474,16 +457,19 @@ def main():
 
     # Generating the base payload for the brain annotation volume
     print("Pushing to Nexus: template volume...")
+    template_metadata = nrrd_index.read_nrrd_metadata(args.template_volume)
+    template_resolution = nrrd_index.resolution(template_metadata)
     brain_template_payload = generate_payload_volumetric_data_layer(args.template_volume, 
         brain_template_volume_id,
-        "BBP Mouse Brain Template Volume, 25µm",
-        "Raster volume of the brain template. This originaly comes from AIBS CCF (25µm)",
+        f"BBP Mouse Brain Template Volume, {template_resolution}µm",
+        f"Raster volume of the brain template. This originaly comes from AIBS CCF ({template_resolution}µm)",
         "BrainTemplateDataLayer",
         atlas_release_id,
         srs_id,
         root_node,
         "LUMINANCE",
-        25,
+        template_resolution,
+        nrrd_metadata=template_metadata,
     )
     nexus_resource_template_volume = Resource.from_json(brain_template_payload)
     nexus_resource_template_volume.distribution = forge.attach(args.template_volume, content_type="application/nrrd")
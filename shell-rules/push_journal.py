@@ -0,0 +1,132 @@
+'''
+Append-only JSONL journal of the Resources pushed by the region push scripts
+(masks, meshes, summaries), so that an interrupted push can be resumed.
+
+Each line records, for one region, the pushed file path, its content digest,
+the minted Nexus @id and the outcome of the push ("started", "succeeded" or "failed").
+Only the last line of a given file path is relevant.
+
+'''
+
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime
+
+
+STARTED = "started"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+def file_digest(filepath, chunk_size=1 << 20):
+    """Compute the SHA-256 digest of a file, reading it by chunks"""
+    sha256 = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def json_digest(content):
+    """Compute the SHA-256 digest of a JSON-serializable content"""
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class PushJournal:
+    """
+    Journal of the pushed Resources.
+
+    Args:
+        journal_path: path of the JSONL journal file (created if it does not exist)
+        resume: if True, the entries already in the journal are loaded so that completed
+            pushes can be skipped and the ids of half-finished ones reused.
+            If False, any existing journal is truncated.
+    """
+
+    def __init__(self, journal_path, resume=False):
+        self.journal_path = journal_path
+        self.entries = {}
+        self._lock = threading.Lock()
+
+        if resume and os.path.isfile(journal_path):
+            with open(journal_path, "r") as journal_file:
+                for line in journal_file:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a line truncated by a killed process
+                        continue
+                    self.entries[entry["file"]] = entry
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(journal_path)), exist_ok=True)
+            open(journal_path, "w").close()
+
+    def lookup(self, file, digest):
+        """
+        Return the last journal entry of file if it was recorded for the same content digest,
+        None otherwise.
+        """
+        entry = self.entries.get(file)
+        if entry is None or entry["digest"] != digest:
+            return None
+        return entry
+
+    def is_completed(self, file, digest):
+        entry = self.lookup(file, digest)
+        return entry is not None and entry["outcome"] == SUCCEEDED
+
+    def reusable_id(self, file, digest):
+        """The @id minted for a previous, unfinished, push of the same file content"""
+        entry = self.lookup(file, digest)
+        if entry is None or entry["outcome"] == SUCCEEDED:
+            return None
+        return entry["id"]
+
+    def record(self, file, digest, nexus_id, outcome, message=None):
+        entry = {
+            "file": file,
+            "digest": digest,
+            "id": nexus_id,
+            "outcome": outcome,
+            "time": datetime.now().isoformat(),
+        }
+        if message:
+            entry["message"] = message
+        with self._lock:
+            self.entries[file] = entry
+            with open(self.journal_path, "a") as journal_file:
+                journal_file.write(json.dumps(entry) + "\n")
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+
+def add_journal_args(parser, journal_name):
+    parser.add_argument(
+        "--journal",
+        dest="journal",
+        required=False,
+        default=None,
+        metavar="<FILE PATH>",
+        help=f"Path of the JSONL push journal, typically $WORKING_DIR/{journal_name}. "
+             "No journal is written if not provided")
+
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        default=False,
+        help="Resume from the push journal: skip the regions already pushed and reuse the "
+             "ids of the unfinished ones")
+
+
+def resource_exists(forge, nexus_id):
+    """Check whether a Resource with a reused id has already been registered"""
+    try:
+        return forge.retrieve(nexus_id) is not None
+    except Exception:
+        return False
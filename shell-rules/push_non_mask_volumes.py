@@ -21,7 +21,9 @@ import os
 import numpy as np
 import nrrd
 from datetime import datetime
-import blue_brain_atlas_web_exporter.TreeIndexer as TreeIndexer
+import hierarchy_index
+import nrrd_index
+from access_token import add_token_args, get_access_token
 
 
 
@@ -111,9 +113,12 @@ VOLUMETRICDATALAYER_SCHEMAS_ID = "https://neuroshapes.org/dash/volumetricdatalay
 ONTOLOGY_SCHEMAS_ID = "https://neuroshapes.org/dash/ontology"
 ATLASRELEASE_SCHEMAS_ID = "https://neuroshapes.org/dash/atlasrelease"
 
-def generate_payload_volumetric_data_layer(filepath, id, name, description, type, atlas_release_id, srs_id, region_node, sample_modality, resolution):
-    
-    nrrd_header = nrrd.read_header(filepath)
+def generate_payload_volumetric_data_layer(filepath, id, name, description, type, atlas_release_id, srs_id, region_node, sample_modality, resolution=None, nrrd_metadata=None):
+    # nrrd_metadata can be provided from a directory index (nrrd_index.index_directory) to avoid reading the header again
+    if nrrd_metadata is None:
+        nrrd_metadata = nrrd_index.read_nrrd_metadata(filepath)
+    if resolution is None:
+        resolution = nrrd_index.resolution(nrrd_metadata)
     return {
         "@id": id,
         "@type": [
@@ -138,9 +143,9 @@ def generate_payload_volumetric_data_layer(filepath, id, name, description, type
             }
         },
         
-        "bufferEncoding": nrrd_header["encoding"],
+        "bufferEncoding": nrrd_metadata["encoding"],
 
-        "componentEncoding": NRRD_TYPES_TO_NUMPY[nrrd_header["type"]],
+        "componentEncoding": NRRD_TYPES_TO_NUMPY[nrrd_metadata["type"]],
 
         "contribution": {
             "@type": "Contribution",
@@ -162,24 +167,14 @@ def generate_payload_volumetric_data_layer(filepath, id, name, description, type
             "name": dataSampleModalities[sample_modality],
             "size": dataSampleModalitiesNumberOfComponents[sample_modality],
             },
-            {
-            "@type": "SpaceDimension",
-            "size": 528,
-            "unitCode": "voxel"
-            },
-            {
+            *[{
             "@type": "SpaceDimension",
-            "size": 320,
+            "size": space_size,
             "unitCode": "voxel"
-            },
-            {
-            "@type": "SpaceDimension",
-            "size": 456,
-            "unitCode": "voxel"
-            }
+            } for space_size in nrrd_metadata["space_sizes"]]
         ],
    
-        "endianness": nrrd_header.get("endian", "little"),
+        "endianness": nrrd_metadata["endian"],
 
         "fileExtension": "nrrd",
         "isRegisteredIn": {
@@ -254,12 +249,7 @@ def parse_args():
         metavar="<NAME>",
         help="Name of the Nexus project to push data to")
 
-    parser.add_argument(
-        "--access-token",
-        dest="access_token",
-        required=True,
-        metavar="<NAME>",
-        help="Access token (JWT) to push data to Nexus")
+    add_token_args(parser)
         
     parser.add_argument(
         "--nexus-id-aibs-ccf-srs",
@@ -314,7 +304,7 @@ def main():
         args.forge_config,
         endpoint=args.nexus_env,
         bucket=f"{args.nexus_org}/{args.nexus_proj}",
-        token=args.access_token,
+        token=get_access_token(args),
         debug=True,
     )
 
@@ -333,35 +323,28 @@ def main():
     print("Using SRS: ", srs_id)
 
     # Reading the brain region ontology, to later being able to generate
-    # better names that include brain region labels
-    brain_onto_json = json.loads(open(args.hierarchy, "r").read())
-    # sometimes, the 1.json has its content in a "msg" sub prop (the original version has).
-    # and some other versions don't. Here we deal with both
-    if "msg" in brain_onto_json:
-        onto_flat_tree = TreeIndexer.flattenTree(brain_onto_json['msg'][0])
-    else:
-        onto_flat_tree = TreeIndexer.flattenTree(brain_onto_json)
-
-    # finding the root node of the brain region ontology
-    root_node = None
-    for node_id in onto_flat_tree:
-        node = onto_flat_tree[node_id]
-        if len(node["_ascendants"]) == 0:
-            root_node = node
-            break
+    # better names that include brain region labels.
+    # The flattened hierarchy is cached in a sidecar file shared by all the push scripts
+    onto_flat_tree = hierarchy_index.load(args.hierarchy)
+
+    # the root node of the brain region ontology
+    root_node = onto_flat_tree.root_node
     
     # Generating the base payload for the direction vector volume
     print("Pushing to Nexus: direction vector volume...")
+    direction_vector_metadata = nrrd_index.read_nrrd_metadata(args.direction_vector_volume)
+    direction_vector_resolution = nrrd_index.resolution(direction_vector_metadata)
     direction_vector_volume_payload = generate_payload_volumetric_data_layer(args.direction_vector_volume, 
         direction_vector_volume_id,
-        "BBP Mouse Brain Direction Vector Volume, 25µm",
+        f"BBP Mouse Brain Direction Vector Volume, {direction_vector_resolution}µm",
         "This raster volume contains the direction vectors as (x, y, z)",
         "CellOrientationField",
         atlas_release_id,
         srs_id,
         root_node,
         "VECTOR_3D",
-        25,
+        direction_vector_resolution,
+        nrrd_metadata=direction_vector_metadata,
     )
     nexus_resource_direction_vector_volume = Resource.from_json(direction_vector_volume_payload)
     nexus_resource_direction_vector_volume.distribution = forge.attach(args.direction_vector_volume, content_type="application/nrrd")
@@ -369,16 +352,19 @@ def main():
 
     # Generating the base payload for the orientation field (quaternion) volume
     print("Pushing to Nexus: orientation field volume...")
+    orientation_field_metadata = nrrd_index.read_nrrd_metadata(args.orientation_field_volume)
+    orientation_field_resolution = nrrd_index.resolution(orientation_field_metadata)
     orientation_field_volume_payload = generate_payload_volumetric_data_layer(args.orientation_field_volume , 
         orientation_field_volume_id,
-        "BBP Mouse Brain Orientation Field Volume, 25µm",
+        f"BBP Mouse Brain Orientation Field Volume, {orientation_field_resolution}µm",
         "This raster volume contains orientation field as quaternions",
         "CellOrientationField",
         atlas_release_id,
         srs_id,
         root_node,
         "QUATERNION",
-        25,
+        orientation_field_resolution,
+        nrrd_metadata=orientation_field_metadata,
     )
     nexus_resource_orientation_field_volume = Resource.from_json(orientation_field_volume_payload)
     nexus_resource_orientation_field_volume.distribution = forge.attach(args.orientation_field_volume, content_type="application/nrrd")
@@ -388,16 +374,19 @@ def main():
     # There are multiple nrrd files, one for each cortical layer and one for pia
     placement_hints_nrrd_paths = glob.glob(f"{args.placement_hints_volume_dir}/*.nrrd")
     print("Pushing to Nexus: placement hints volume...")
+    placement_hints_metadata = nrrd_index.read_nrrd_metadata(placement_hints_nrrd_paths[0])
+    placement_hints_resolution = nrrd_index.resolution(placement_hints_metadata)
     placement_hints_volume_payload = generate_payload_volumetric_data_layer(placement_hints_nrrd_paths[0] , 
         placement_hints_volume_id,
-        "BBP Mouse Brain Placement Hints Volumes, 25µm",
+        f"BBP Mouse Brain Placement Hints Volumes, {placement_hints_resolution}µm",
         "This raster volume contains placement hints volumes for all the cortical layers",
         "PlacementHintsDataLayer",
         atlas_release_id,
         srs_id,
         root_node,
         "DISTANCE",
-        25,
+        placement_hints_resolution,
+        nrrd_metadata=placement_hints_metadata,
     )
     nexus_resource_orientation_field_volume = Resource.from_json(placement_hints_volume_payload)
     placemement_hints_distributions = []
@@ -6,6 +6,8 @@ This is in charge of pushing the NRRD region masks
 import uuid
 import glob
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from kgforge.core import KnowledgeGraphForge
 from kgforge.core import Resource
 import sys
@@ -14,7 +16,10 @@ import os
 import numpy as np
 import nrrd
 from datetime import datetime
-import blue_brain_atlas_web_exporter.TreeIndexer as TreeIndexer
+import hierarchy_index
+import nrrd_index
+from push_journal import PushJournal, add_journal_args, file_digest, resource_exists, STARTED, SUCCEEDED, FAILED
+from access_token import add_token_args, get_access_token
 
 
 
@@ -98,9 +103,12 @@ dataSampleModalitiesNumberOfComponents = {
 
 VOLUMETRICDATALAYER_SCHEMAS_ID = "https://neuroshapes.org/dash/volumetricdatalayer"
 
-def generate_payload_volumetric_data_layer(filepath, id, name, description, type, atlas_release_id, srs_id, region_node, sample_modality, resolution):
-    
-    nrrd_header = nrrd.read_header(filepath)
+def generate_payload_volumetric_data_layer(filepath, id, name, description, type, atlas_release_id, srs_id, region_node, sample_modality, resolution=None, nrrd_metadata=None):
+    # nrrd_metadata can be provided from a directory index (nrrd_index.index_directory) to avoid reading the header again
+    if nrrd_metadata is None:
+        nrrd_metadata = nrrd_index.read_nrrd_metadata(filepath)
+    if resolution is None:
+        resolution = nrrd_index.resolution(nrrd_metadata)
     return {
         "@id": id,
         "@type": [
@@ -125,9 +133,9 @@ def generate_payload_volumetric_data_layer(filepath, id, name, description, type
             }
         },
         
-        "bufferEncoding": nrrd_header["encoding"],
+        "bufferEncoding": nrrd_metadata["encoding"],
 
-        "componentEncoding": NRRD_TYPES_TO_NUMPY[nrrd_header["type"]],
+        "componentEncoding": NRRD_TYPES_TO_NUMPY[nrrd_metadata["type"]],
 
         "contribution": {
             "@type": "Contribution",
@@ -149,24 +157,14 @@ def generate_payload_volumetric_data_layer(filepath, id, name, description, type
             "name": dataSampleModalities[sample_modality],
             "size": dataSampleModalitiesNumberOfComponents[sample_modality],
             },
-            {
-            "@type": "SpaceDimension",
-            "size": 528,
-            "unitCode": "voxel"
-            },
-            {
-            "@type": "SpaceDimension",
-            "size": 320,
-            "unitCode": "voxel"
-            },
-            {
+            *[{
             "@type": "SpaceDimension",
-            "size": 456,
+            "size": space_size,
             "unitCode": "voxel"
-            }
+            } for space_size in nrrd_metadata["space_sizes"]]
         ],
    
-        "endianness": nrrd_header.get("endian", "little"),
+        "endianness": nrrd_metadata["endian"],
 
         "fileExtension": "nrrd",
         "isRegisteredIn": {
@@ -241,12 +239,7 @@ def parse_args():
         metavar="<NAME>",
         help="Name of the Nexus project to push data to")
 
-    parser.add_argument(
-        "--access-token",
-        dest="access_token",
-        required=True,
-        metavar="<NAME>",
-        help="Access token (JWT) to push data to Nexus")
+    add_token_args(parser)
         
     parser.add_argument(
         "--nexus-id-aibs-ccf-srs",
@@ -276,61 +269,168 @@ def parse_args():
         metavar="<NEXUS ID>",
         help="Nexus ID of the AtlasRelease Nexus Resource the volumes are linked to")
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        required=False,
+        default=1,
+        type=int,
+        metavar="<N>",
+        help="Number of masks to push concurrently (default: 1, serial push)")
+
+    parser.add_argument(
+        "--nrrd-manifest",
+        dest="nrrd_manifest",
+        required=False,
+        default=None,
+        metavar="<FILE PATH>",
+        help="JSON file caching the NRRD headers of the masks between runs")
+
+    add_journal_args(parser, "push_region_masks_journal.jsonl")
 
+    args = parser.parse_args()
+    if args.resume and not args.journal:
+        parser.error("--resume requires --journal")
+    return args
 
 
-def main():
-    args = parse_args()
 
+def create_forge(args):
     forge = KnowledgeGraphForge(
         args.forge_config,
         endpoint=args.nexus_env,
         bucket=f"{args.nexus_org}/{args.nexus_proj}",
-        token=args.access_token,
+        token=get_access_token(args),
         debug=True,
     )
 
     forge._debug=True
+    return forge
+
+
+def push_region_mask(forge, mask_filepath, region_node, region_mask_nexus_id, atlas_release_id, srs_id, nrrd_metadata=None):
+    """
+    Build the payload of a region mask, attach its NRRD file and register it.
+
+    Returns:
+        A (succeeded, message) tuple describing the outcome of the registration.
+    """
+    if nrrd_metadata is None:
+        nrrd_metadata = nrrd_index.read_nrrd_metadata(mask_filepath)
+    resolution = nrrd_index.resolution(nrrd_metadata)
+    region_mask_volume_payload = generate_payload_volumetric_data_layer(mask_filepath,
+        region_mask_nexus_id,
+        f"Mask Volume of {region_node['name']}, {resolution}µm",
+        f"Blue Brain Atlas mask raster volume of the region {region_node['name']}, at resolution {resolution}µm",
+        "BrainParcellationMask",
+        atlas_release_id,
+        srs_id,
+        region_node,
+        "MASK",
+        resolution,
+        nrrd_metadata=nrrd_metadata,
+    )
+    region_mask_volume_resource = Resource.from_json(region_mask_volume_payload)
+    region_mask_volume_resource.distribution = forge.attach(mask_filepath, content_type="application/nrrd")
+    forge.register(region_mask_volume_resource, schema_id=VOLUMETRICDATALAYER_SCHEMAS_ID)
+
+    last_action = getattr(region_mask_volume_resource, "_last_action", None)
+    if last_action is None:
+        return False, "No registration action recorded"
+    return last_action.succeeded, last_action.message
+
+
+def print_push_report(push_results):
+    failed = [result for result in push_results if not result["succeeded"]]
+    skipped = [result for result in push_results if result.get("skipped")]
+    print(f"\nPushed {len(push_results) - len(failed)}/{len(push_results)} region masks successfully"
+          f" ({len(skipped)} already pushed according to the journal)")
+    print(f"{'status':<8} {'region id':<12} {'file':<40} nexus id / error")
+    for result in push_results:
+        status = "SKIPPED" if result.get("skipped") else ("OK" if result["succeeded"] else "FAILED")
+        detail = result["nexus_id"] if result["succeeded"] else f"{result['nexus_id']}: {result['message']}"
+        print(f"{status:<8} {result['region_id']:<12} {os.path.basename(result['file']):<40} {detail}")
+    return failed
+
+
+def main():
+    args = parse_args()
+
+    forge = create_forge(args)
 
     srs_id = args.nexus_id_aibs_ccf_srs
     atlas_release_id = args.atlasrelease_id
 
     # Reading the brain region ontology, to later being able to generate
-    # better names that include brain region labels
-    brain_onto_json = json.loads(open(args.hierarchy, "r").read())
-    # sometimes, the 1.json has its content in a "msg" sub prop (the original version has).
-    # and some other versions don't. Here we deal with both
-    if "msg" in brain_onto_json:
-        onto_flat_tree = TreeIndexer.flattenTree(brain_onto_json['msg'][0])
-    else:
-        onto_flat_tree = TreeIndexer.flattenTree(brain_onto_json)
-
-    # finding all the masks
-    masks_nrrd_paths = glob.glob(f"{args.region_mask_volume_dir}/*.nrrd")
-
-    print("Pushing to Nexus: region masks volume...")
-    for i in range(0, len(masks_nrrd_paths)):
-        mask_filepath = masks_nrrd_paths[i]
+    # better names that include brain region labels.
+    # The flattened hierarchy is cached in a sidecar file shared by all the push scripts
+    onto_flat_tree = hierarchy_index.load(args.hierarchy)
+
+    # finding all the masks and reading their headers (in parallel, only the headers are read)
+    masks_manifest = nrrd_index.index_directory(args.region_mask_volume_dir, "*.nrrd",
+        workers=max(args.workers, 8), manifest_path=args.nrrd_manifest)
+    masks_nrrd_paths = list(masks_manifest.keys())
+
+    journal = PushJournal(args.journal, resume=args.resume) if args.journal else None
+
+    # Each worker thread gets its own forge so that no HTTP session is shared between threads
+    worker_forges = threading.local()
+
+    def get_worker_forge():
+        if args.workers <= 1:
+            return forge
+        if not hasattr(worker_forges, "forge"):
+            worker_forges.forge = create_forge(args)
+        return worker_forges.forge
+
+    def push_task(mask_filepath):
         region_id = int(os.path.basename(mask_filepath).split(".")[0])
         region_node = onto_flat_tree[region_id]
-        region_mask_nexus_id = forge.format("identifier", str(uuid.uuid4()))
-        print(f"[{i+1}/{len(masks_nrrd_paths)}] ", region_node["name"], " --> ", region_mask_nexus_id)
-
-        region_mask_volume_payload = generate_payload_volumetric_data_layer(mask_filepath, 
-            region_mask_nexus_id,
-            f"Mask Volume of {region_node['name']}, 25µm",
-            f"Blue Brain Atlas mask raster volume of the region {region_node['name']}, at resolution 25µm",
-            "BrainParcellationMask",
-            atlas_release_id,
-            srs_id,
-            region_node,
-            "MASK",
-            25,
-        )
-        region_mask_volume_resource = Resource.from_json(region_mask_volume_payload)
-        region_mask_volume_resource.distribution = forge.attach(mask_filepath, content_type="application/nrrd")
-        forge.register(region_mask_volume_resource, schema_id=VOLUMETRICDATALAYER_SCHEMAS_ID)
+        result = {"file": mask_filepath, "region_id": region_id, "region_name": region_node["name"]}
+
+        journal_key = os.path.abspath(mask_filepath)
+        digest = None
+        region_mask_nexus_id = None
+        if journal:
+            digest = file_digest(mask_filepath)
+            if journal.is_completed(journal_key, digest):
+                entry = journal.lookup(journal_key, digest)
+                return dict(result, nexus_id=entry["id"], succeeded=True, message=None, skipped=True)
+            region_mask_nexus_id = journal.reusable_id(journal_key, digest)
+            # the previous run may have died after the registration but before journaling it
+            if region_mask_nexus_id and resource_exists(get_worker_forge(), region_mask_nexus_id):
+                journal.record(journal_key, digest, region_mask_nexus_id, SUCCEEDED)
+                return dict(result, nexus_id=region_mask_nexus_id, succeeded=True, message=None, skipped=True)
+        if not region_mask_nexus_id:
+            region_mask_nexus_id = forge.format("identifier", str(uuid.uuid4()))
+
+        if journal:
+            journal.record(journal_key, digest, region_mask_nexus_id, STARTED)
+        try:
+            succeeded, message = push_region_mask(get_worker_forge(), mask_filepath, region_node,
+                region_mask_nexus_id, atlas_release_id, srs_id, masks_manifest[mask_filepath])
+        except Exception as e:
+            succeeded, message = False, f"{type(e).__name__}: {e}"
+        if journal:
+            journal.record(journal_key, digest, region_mask_nexus_id, SUCCEEDED if succeeded else FAILED,
+                None if succeeded else message)
+        return dict(result, nexus_id=region_mask_nexus_id, succeeded=succeeded, message=message)
+
+    print(f"Pushing to Nexus: region masks volume ({max(args.workers, 1)} worker(s))...")
+    push_results = []
+    with ThreadPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+        # map() yields in submission order, which keeps the progress output ordered
+        for i, result in enumerate(executor.map(push_task, masks_nrrd_paths)):
+            if result.get("skipped"):
+                status = " (already pushed)"
+            else:
+                status = "" if result["succeeded"] else f" FAILED ({result['message']})"
+            print(f"[{i+1}/{len(masks_nrrd_paths)}] ", result["region_name"], " --> ", result["nexus_id"], status)
+            push_results.append(result)
+
+    failed = print_push_report(push_results)
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
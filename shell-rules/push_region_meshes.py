@@ -13,7 +13,9 @@ import os
 import numpy as np
 import nrrd
 from datetime import datetime
-import blue_brain_atlas_web_exporter.TreeIndexer as TreeIndexer
+import hierarchy_index
+from push_journal import PushJournal, add_journal_args, file_digest, resource_exists, STARTED, SUCCEEDED, FAILED
+from access_token import add_token_args, get_access_token
 
 
 REGION_MESH_SCHEMAS_ID = "https://neuroshapes.org/dash/brainparcellationmesh"
@@ -95,12 +97,7 @@ def parse_args():
         metavar="<NAME>",
         help="Name of the Nexus project to push data to")
 
-    parser.add_argument(
-        "--access-token",
-        dest="access_token",
-        required=True,
-        metavar="<NAME>",
-        help="Access token (JWT) to push data to Nexus")
+    add_token_args(parser)
         
     parser.add_argument(
         "--nexus-id-aibs-ccf-srs",
@@ -130,7 +127,12 @@ def parse_args():
         metavar="<NEXUS ID>",
         help="Nexus ID of the AtlasRelease Nexus Resource the volumes are linked to")
 
-    return parser.parse_args()
+    add_journal_args(parser, "push_region_meshes_journal.jsonl")
+
+    args = parser.parse_args()
+    if args.resume and not args.journal:
+        parser.error("--resume requires --journal")
+    return args
 
 
 
@@ -141,7 +143,7 @@ def main():
         args.forge_config,
         endpoint=args.nexus_env,
         bucket=f"{args.nexus_org}/{args.nexus_proj}",
-        token=args.access_token,
+        token=get_access_token(args),
         debug=True,
     )
 
@@ -151,24 +153,38 @@ def main():
     atlas_release_id = args.atlasrelease_id
 
     # Reading the brain region ontology, to later being able to generate
-    # better names that include brain region labels
-    brain_onto_json = json.loads(open(args.hierarchy, "r").read())
-    # sometimes, the 1.json has its content in a "msg" sub prop (the original version has).
-    # and some other versions don't. Here we deal with both
-    if "msg" in brain_onto_json:
-        onto_flat_tree = TreeIndexer.flattenTree(brain_onto_json['msg'][0])
-    else:
-        onto_flat_tree = TreeIndexer.flattenTree(brain_onto_json)
+    # better names that include brain region labels.
+    # The flattened hierarchy is cached in a sidecar file shared by all the push scripts
+    onto_flat_tree = hierarchy_index.load(args.hierarchy)
 
     # finding all the masks
     mesh_paths = glob.glob(f"{args.region_mesh_dir}/*.obj")
 
+    journal = PushJournal(args.journal, resume=args.resume) if args.journal else None
+
     print("Pushing to Nexus: region meshes...")
     for i in range(0, len(mesh_paths)):
         mesh_filepath = mesh_paths[i]
         region_id = int(os.path.basename(mesh_filepath).split(".")[0])
         region_node = onto_flat_tree[region_id]
-        region_mesh_nexus_id = forge.format("identifier", str(uuid.uuid4()))
+
+        journal_key = os.path.abspath(mesh_filepath)
+        digest = None
+        region_mesh_nexus_id = None
+        if journal:
+            digest = file_digest(mesh_filepath)
+            if journal.is_completed(journal_key, digest):
+                print(f"[{i+1}/{len(mesh_paths)}] ", region_node["name"], " --> ",
+                      journal.lookup(journal_key, digest)["id"], " (already pushed)")
+                continue
+            region_mesh_nexus_id = journal.reusable_id(journal_key, digest)
+            # the previous run may have died after the registration but before journaling it
+            if region_mesh_nexus_id and resource_exists(forge, region_mesh_nexus_id):
+                journal.record(journal_key, digest, region_mesh_nexus_id, SUCCEEDED)
+                print(f"[{i+1}/{len(mesh_paths)}] ", region_node["name"], " --> ", region_mesh_nexus_id, " (already pushed)")
+                continue
+        if not region_mesh_nexus_id:
+            region_mesh_nexus_id = forge.format("identifier", str(uuid.uuid4()))
         print(f"[{i+1}/{len(mesh_paths)}] ", region_node["name"], " --> ", region_mesh_nexus_id)
 
         region_mesh_payload = generate_payload_region_mesh(region_mesh_nexus_id,
@@ -179,9 +195,16 @@ def main():
             region_node
         )
 
+        if journal:
+            journal.record(journal_key, digest, region_mesh_nexus_id, STARTED)
         region_mask_volume_resource = Resource.from_json(region_mesh_payload)
         region_mask_volume_resource.distribution = forge.attach(mesh_filepath, content_type="application/obj")
         forge.register(region_mask_volume_resource, schema_id=REGION_MESH_SCHEMAS_ID)
+        if journal:
+            last_action = getattr(region_mask_volume_resource, "_last_action", None)
+            succeeded = last_action is not None and last_action.succeeded
+            journal.record(journal_key, digest, region_mesh_nexus_id, SUCCEEDED if succeeded else FAILED,
+                None if succeeded or last_action is None else last_action.message)
 
 if __name__ == "__main__":
     main()
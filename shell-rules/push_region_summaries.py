@@ -13,8 +13,12 @@ import os
 import numpy as np
 import nrrd
 from datetime import datetime
-import blue_brain_atlas_web_exporter.TreeIndexer as TreeIndexer
+import hierarchy_index
+from push_journal import PushJournal, add_journal_args, json_digest, resource_exists, STARTED, SUCCEEDED, FAILED
+from access_token import add_token_args, get_access_token
 
+# number of RegionSummary Resources registered per request
+BATCH_SIZE = 100
 
 def generate_payload_region_summary(id, name, description, atlas_release_id, srs_id, region_node, metadata):
     return {
@@ -101,12 +105,7 @@ def parse_args():
         metavar="<NAME>",
         help="Name of the Nexus project to push data to")
 
-    parser.add_argument(
-        "--access-token",
-        dest="access_token",
-        required=True,
-        metavar="<NAME>",
-        help="Access token (JWT) to push data to Nexus")
+    add_token_args(parser)
         
     parser.add_argument(
         "--nexus-id-aibs-ccf-srs",
@@ -136,7 +135,22 @@ def parse_args():
         metavar="<NEXUS ID>",
         help="Nexus ID of the AtlasRelease Nexus Resource the volumes are linked to")
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--batch-size",
+        dest="batch_size",
+        required=False,
+        default=BATCH_SIZE,
+        type=int,
+        metavar="<N>",
+        help=f"Number of RegionSummary Resources registered per request (default: {BATCH_SIZE}, "
+             "1 for one request per region)")
+
+    add_journal_args(parser, "push_region_summaries_journal.jsonl")
+
+    args = parser.parse_args()
+    if args.resume and not args.journal:
+        parser.error("--resume requires --journal")
+    return args
 
 
 
@@ -147,7 +161,7 @@ def main():
         args.forge_config,
         endpoint=args.nexus_env,
         bucket=f"{args.nexus_org}/{args.nexus_proj}",
-        token=args.access_token,
+        token=get_access_token(args),
         debug=True,
     )
 
@@ -157,23 +171,41 @@ def main():
     atlas_release_id = args.atlasrelease_id
 
     # Reading the brain region ontology, to later being able to generate
-    # better names that include brain region labels
-    brain_onto_json = json.loads(open(args.hierarchy, "r").read())
-    # sometimes, the 1.json has its content in a "msg" sub prop (the original version has).
-    # and some other versions don't. Here we deal with both
-    if "msg" in brain_onto_json:
-        onto_flat_tree = TreeIndexer.flattenTree(brain_onto_json['msg'][0])
-    else:
-        onto_flat_tree = TreeIndexer.flattenTree(brain_onto_json)
+    # better names that include brain region labels.
+    # The flattened hierarchy is cached in a sidecar file shared by all the push scripts
+    onto_flat_tree = hierarchy_index.load(args.hierarchy)
 
     all_regions_meta = json.loads(open(args.region_metadata).read())
     region_keys = list(all_regions_meta.keys())
 
+    journal = PushJournal(args.journal, resume=args.resume) if args.journal else None
+
+    # Build all the payloads first, they do not depend on Nexus
+    region_summary_resources = []
+    journal_entries = []
     for i in range(0, len(region_keys)):
         region_id = region_keys[i]
         region_node = onto_flat_tree[int(region_id)]
         summary_metadata = all_regions_meta[region_id]
-        region_summary_nexus_id = forge.format("identifier", str(uuid.uuid4()))
+
+        # summaries have no file of their own, they are journaled per region of the metadata file
+        journal_key = f"{os.path.abspath(args.region_metadata)}#{region_id}"
+        digest = None
+        region_summary_nexus_id = None
+        if journal:
+            digest = json_digest(summary_metadata)
+            if journal.is_completed(journal_key, digest):
+                print(f"[{i+1}/{len(region_keys)}] ", region_node["name"], " --> ",
+                      journal.lookup(journal_key, digest)["id"], " (already pushed)")
+                continue
+            region_summary_nexus_id = journal.reusable_id(journal_key, digest)
+            # the previous run may have died after the registration but before journaling it
+            if region_summary_nexus_id and resource_exists(forge, region_summary_nexus_id):
+                journal.record(journal_key, digest, region_summary_nexus_id, SUCCEEDED)
+                print(f"[{i+1}/{len(region_keys)}] ", region_node["name"], " --> ", region_summary_nexus_id, " (already pushed)")
+                continue
+        if not region_summary_nexus_id:
+            region_summary_nexus_id = forge.format("identifier", str(uuid.uuid4()))
 
         print(f"[{i+1}/{len(region_keys)}] ", region_node["name"], " --> ", region_summary_nexus_id)
 
@@ -186,8 +218,52 @@ def main():
             summary_metadata
         )
 
-        region_summary_resource = Resource.from_json(region_summary_payload)
-        forge.register(region_summary_resource)
+        region_summary_resources.append(Resource.from_json(region_summary_payload))
+        journal_entries.append((journal_key, digest))
+
+    failed = register_in_batches(forge, region_summary_resources, args.batch_size,
+        journal=journal, journal_entries=journal_entries)
+    if failed:
+        sys.exit(1)
+
+
+def register_in_batches(forge, resources, batch_size, journal=None, journal_entries=None):
+    """
+    Register the resources in chunks of batch_size Resources per forge.register() call.
+
+    If a journal is provided, journal_entries holds the (journal key, digest) of each Resource.
+
+    Returns:
+        The list of (Resource, error message) for the Resources whose registration failed.
+    """
+    batch_size = max(batch_size, 1)
+    n_batches = (len(resources) + batch_size - 1) // batch_size
+    failed = []
+    for b in range(n_batches):
+        batch_slice = slice(b * batch_size, (b + 1) * batch_size)
+        batch = resources[batch_slice]
+        print(f"Registering batch {b+1}/{n_batches} ({len(batch)} RegionSummary Resources)")
+        if journal:
+            for resource, (journal_key, digest) in zip(batch, journal_entries[batch_slice]):
+                journal.record(journal_key, digest, resource.id, STARTED)
+        forge.register(batch if len(batch) > 1 else batch[0])
+        batch_failed = []
+        for r, resource in enumerate(batch):
+            last_action = getattr(resource, "_last_action", None)
+            succeeded = last_action is not None and last_action.succeeded
+            message = None
+            if not succeeded:
+                message = last_action.message if last_action is not None else "not registered"
+                batch_failed.append((resource, message))
+            if journal:
+                journal_key, digest = journal_entries[batch_slice][r]
+                journal.record(journal_key, digest, resource.id, SUCCEEDED if succeeded else FAILED, message)
+        for resource, message in batch_failed:
+            print(f"\tFailed to register '{resource.name}' ({resource.id}): {message}")
+        failed.extend(batch_failed)
+
+    print(f"{len(resources) - len(failed)}/{len(resources)} RegionSummary Resources registered successfully")
+    return failed
 
 
 if __name__ == "__main__":
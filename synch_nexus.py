@@ -3,6 +3,8 @@ import json
 import yaml
 from pathlib import Path
 import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from kgforge.core import KnowledgeGraphForge
 from kgforge.core import Resource
@@ -15,6 +17,11 @@ metadata_dir = os.environ["METADATA_DIR"]
 file_nexus_id_map = os.environ["FILE_NEXUS_ID_MAP"]
 commit_sha = os.environ["COMMIT_SHA"]
 is_prod_env = os.environ["IS_PROD_ENV"]
+# number of Resources synchronized concurrently in prod
+synch_workers = int(os.environ.get("SYNCH_WORKERS", 8))
+# digests of the metadata files, and of their Resource distribution, from the previous runs
+digest_manifest_path = os.environ.get("DIGEST_MANIFEST_PATH", os.path.join(metadata_dir, ".digest_manifest.json"))
+digest_chunk_size = 1024**2
 
 
 def create_prob_map_resource(name, description):
@@ -46,10 +53,15 @@ def synch_nexus():
     pipeline_config = yaml.safe_load(open("config.yaml").read().strip())
 
     if is_prod_env:
-        forge = KnowledgeGraphForge("forge-config.yml", bucket="bbp/atlas",
-                                    endpoint=pipeline_config["NEXUS_PROD_ENV"],
-                                    token=nexus_token)
-        synch_nexus_prod(nexus_ids, forge, pipeline_config["NEXUS_STAGING_ENV"])
+        def create_forges():
+            forge = KnowledgeGraphForge("forge-config.yml", bucket="bbp/atlas",
+                                        endpoint=pipeline_config["NEXUS_PROD_ENV"],
+                                        token=nexus_token)
+            forge_staging = KnowledgeGraphForge("forge-config.yml", bucket=forge._store.bucket,
+                                                endpoint=pipeline_config["NEXUS_STAGING_ENV"],
+                                                token=nexus_token_staging)
+            return forge, forge_staging
+        synch_nexus_prod(nexus_ids, create_forges)
     else:
         forge = KnowledgeGraphForge("forge-config.yml", bucket="bbp/atlas",
                                     endpoint=pipeline_config["NEXUS_STAGING_ENV"],
@@ -57,31 +69,93 @@ def synch_nexus():
         update_nexus_staging(nexus_ids, forge)
 
 
-def synch_nexus_prod(nexus_ids, forge_prod, staging_env):
-    skip_synch = ["AtlasRelease", "CellComposition", "species", "ParcellationOntology", "10"]
+def list_resources_to_synch(nexus_ids, skip_synch):
+    """
+    Flatten the nexus_ids tree into the list of (Resource id with tag, Resource name) to synchronize.
+    """
+    resources = []
     for res_type, res_names in nexus_ids.items():
         if res_type in skip_synch:
             continue
 
         if isinstance(res_names, str):
-            res_id = res_names
-            synch_resource(res_id, forge_prod, res_names, staging_env)
+            resources.append((res_names, res_names))
             continue
 
         for res_name in res_names:
             if isinstance(res_names[res_name], str):
-                res_id = res_names[res_name]
-                synch_resource(res_id, forge_prod, res_name, staging_env)
+                resources.append((res_names[res_name], res_name))
             else:
                 resolution = res_name
                 if resolution in skip_synch:
                     continue
                 for res_sub_type, res_sub_names in res_names[resolution].items():
                     for res_sub_name, res_id in res_sub_names.items():
-                        synch_resource(res_id, forge_prod, res_sub_name, staging_env)
+                        resources.append((res_id, res_sub_name))
+    return resources
 
 
-def synch_resource(res_id_tag, forge_prod, res_name, staging_env):
+def synch_nexus_prod(nexus_ids, create_forges, workers=synch_workers):
+    """
+    Synchronize the Resources of nexus_ids concurrently, `create_forges` returning the
+    (prod, staging) forges being called once per worker thread.
+    """
+    skip_synch = ["AtlasRelease", "CellComposition", "species", "ParcellationOntology", "10"]
+    resources = list_resources_to_synch(nexus_ids, skip_synch)
+    print(f"Synchronizing {len(resources)} Resources with {workers} workers")
+
+    # Each worker thread gets its own forges so that no HTTP session is shared between threads
+    worker_forges = threading.local()
+
+    def synch_task(resource):
+        res_id_tag, res_name = resource
+        # the messages of a Resource are printed together, not interleaved with the other workers
+        messages = []
+        try:
+            if not hasattr(worker_forges, "forges"):
+                worker_forges.forges = create_forges()
+            forge_prod, forge_staging = worker_forges.forges
+            status = synch_resource(res_id_tag, forge_prod, res_name, forge_staging, log=messages.append)
+        except Exception as e:
+            messages.append(f"\tSynchronization of '{res_name}' failed: {str(e).strip()}")
+            status = "failed"
+        print("\n".join(messages), flush=True)
+        return status
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        statuses = list(executor.map(synch_task, resources))
+
+    print("\n\nSynchronization summary:")
+    for ((res_id_tag, res_name), status) in zip(resources, statuses):
+        print(f"\t{status}: '{res_name}' ({res_id_tag})")
+    for status in sorted(set(statuses)):
+        print(f"{statuses.count(status)} Resources {status}")
+    failed = [res_name for ((_, res_name), status) in zip(resources, statuses) if status == "failed"]
+    if failed:
+        raise Exception(f"The synchronization of {len(failed)} Resources failed: {', '.join(failed)}")
+
+
+def distribution_digest(res):
+    """(algorithm, value) of the digest of the Resource distribution, None if not available"""
+    distribution = getattr(res, "distribution", None)
+    # several distributions have no single digest to compare
+    if distribution is None or isinstance(distribution, list):
+        return None
+    digest = getattr(distribution, "digest", None)
+    value = getattr(digest, "value", None)
+    if not value:
+        return None
+    return (getattr(digest, "algorithm", None), value)
+
+
+def synch_resource(res_id_tag, forge_prod, res_name, forge_staging, log=print):
+    """
+    Synchronize a tagged staging Resource in prod.
+
+    Returns:
+        The status of the synchronization: "skipped" (no tag), "up to date", "ignored",
+        "synchronized (metadata only)" or "synchronized".
+    """
     res_tag = None
     if res_tag_sep in res_id_tag:
         res_id, res_tag = res_id_tag.split(res_tag_sep)
@@ -89,62 +163,117 @@ def synch_resource(res_id_tag, forge_prod, res_name, staging_env):
         res_id = res_id_tag
 
     if not res_tag:
-        print(f"\nResource {res_name} (Nexus id: '{res_id}') has no tag, skipping it.")
-        return
+        log(f"\nResource {res_name} (Nexus id: '{res_id}') has no tag, skipping it.")
+        return "skipped"
 
     nexus_prod_string = f"in project '{forge_prod._store.bucket}' (Nexus env: '{forge_prod._store.endpoint}')"
-    print(f"\n\nRetrieving Resource for '{res_name}' (Nexus id: '{res_id}', at tag '{res_tag}) {nexus_prod_string}")
+    log(f"\n\nRetrieving Resource for '{res_name}' (Nexus id: '{res_id}', at tag '{res_tag}) {nexus_prod_string}")
     res_prod = forge_prod.retrieve(res_id, version=res_tag)
     if res_prod:
-        print(f"\tFound Resource with id '{res_id}' and tag '{res_tag}' {nexus_prod_string})")
-        print("\tNo synchronization will be performed")
-        return
+        log(f"\tFound Resource with id '{res_id}' and tag '{res_tag}' {nexus_prod_string})")
+        log("\tNo synchronization will be performed")
+        return "up to date"
 
-    print(f"\tNo Resource with id '{res_id}' and tag '{res_tag}' found {nexus_prod_string}")
-    print(f"\tLooking for Resource with id '{res_id}' (dropping tag requirement)")
+    log(f"\tNo Resource with id '{res_id}' and tag '{res_tag}' found {nexus_prod_string}")
+    log(f"\tLooking for Resource with id '{res_id}' (dropping tag requirement)")
     res_prod = forge_prod.retrieve(res_id)
     if not res_prod:
-        print(f"\tNo Resource with id '{res_id}' found {nexus_prod_string}")
-        print(f"\tRegistering a new Resource for '{res_name}':")
+        log(f"\tNo Resource with id '{res_id}' found {nexus_prod_string}")
+        log(f"\tRegistering a new Resource for '{res_name}':")
         res_prod = Resource(id=res_id)
         forge_prod.register(res_prod)
     else:
-        print(f"Resource found")
+        log(f"Resource found")
 
-    print(f"\tSynchronizing Resource for '{res_name}' with staging version:")
-    forge_staging = KnowledgeGraphForge("forge-config.yml",
-        bucket=forge_prod._store.bucket, endpoint=staging_env, token=nexus_token_staging)
-    nexus_staging_string = f"in project '{forge_prod._store.bucket}' (Nexus env: '{forge_staging._store.endpoint}'"
-    print(f"\t\tRetrieving Resource for '{res_name}' (Nexus id: '{res_id}', at tag '{res_tag}) {nexus_staging_string}")
+    log(f"\tSynchronizing Resource for '{res_name}' with staging version:")
+    nexus_staging_string = f"in project '{forge_staging._store.bucket}' (Nexus env: '{forge_staging._store.endpoint}'"
+    log(f"\t\tRetrieving Resource for '{res_name}' (Nexus id: '{res_id}', at tag '{res_tag}) {nexus_staging_string}")
     res_staging = forge_staging.retrieve(res_id, version=res_tag)
     if not res_staging:
         if res_name in ["brain_realigned"]:
-            print("\t\tIgnoring Resource")
-            return
+            log("\t\tIgnoring Resource")
+            return "ignored"
         else:
             raise Exception(f"\t\tNo Resource with id '{res_id}' and tag '{res_tag}' found {nexus_staging_string}")
 
-    print("\t\tSynchronize Resource distribution")
-    if not hasattr(res_staging.distribution.atLocation, "location"):
-        raise Exception("The Resource.distribution.atLocation has no property 'location', maybe the Resource hsa not been migrated to gpfs?")
-    distribution_file = res_staging.distribution.atLocation.location.replace("file:///gpfs", "/gpfs")
-    res_prod.distribution = forge_prod.attach(distribution_file,
-        content_type=res_staging.distribution.encodingFormat)
+    log("\t\tSynchronize Resource distribution")
+    staging_digest = distribution_digest(res_staging)
+    metadata_only = bool(staging_digest) and staging_digest == distribution_digest(res_prod)
+    if metadata_only:
+        # the latest prod revision already has the same file, only the metadata and tag are synchronized
+        log(f"\t\tDigest of the staging distribution identical to the latest prod one ({staging_digest[1]}), "
+            "no upload needed")
+    else:
+        if not hasattr(res_staging.distribution.atLocation, "location"):
+            raise Exception("The Resource.distribution.atLocation has no property 'location', maybe the Resource hsa not been migrated to gpfs?")
+        distribution_file = res_staging.distribution.atLocation.location.replace("file:///gpfs", "/gpfs")
+        res_prod.distribution = forge_prod.attach(distribution_file,
+            content_type=res_staging.distribution.encodingFormat)
 
-    print("\t\tSynchronize Resource attributes")
+    log("\t\tSynchronize Resource attributes")
     skip_props = ["context", "id", "atlasRelease", "brainLocation", "distribution", "generation", "isRegisteredIn"]
     for attr, value in vars(res_staging).items():
         if attr.startswith("_") or attr in skip_props:
             continue
         setattr(res_prod, attr, value)
 
-    print(f"\t\tUpdating Resource with id '{res_id}' {nexus_prod_string}")
+    log(f"\t\tUpdating Resource with id '{res_id}' {nexus_prod_string}")
     forge_prod.update(res_prod)
-    print(f"\t\tTagging Resource with tag '{res_tag}' {nexus_prod_string}")
+    log(f"\t\tTagging Resource with tag '{res_tag}' {nexus_prod_string}")
     forge_prod.tag(res_prod, res_tag)
+    return "synchronized (metadata only)" if metadata_only else "synchronized"
+
+
+def load_digest_manifest(manifest_path):
+    if os.path.isfile(manifest_path):
+        try:
+            with open(manifest_path) as manifest_file:
+                return json.load(manifest_file)
+        except ValueError:
+            print(f"Invalid digest manifest {manifest_path}, it will be rebuilt")
+    return {}
+
+
+def save_digest_manifest(manifest, manifest_path):
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def file_digest(manifest, file_path):
+    """
+    SHA-256 digest of a file, read from the manifest if the file size and modification
+    time did not change, computed by chunks (and stored in the manifest) otherwise.
+    """
+    stat = os.stat(file_path)
+    entry = manifest.get(file_path)
+    if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+        return entry["digest"]
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(digest_chunk_size), b""):
+            sha256.update(chunk)
+    digest = sha256.hexdigest()
+    manifest[file_path] = {"size": stat.st_size, "mtime": stat.st_mtime, "digest": digest,
+                           "remote": entry.get("remote") if entry else None}
+    return digest
+
+
+def set_remote_digest(manifest, file_path, res_id_tag, digest):
+    """Record the digest of the distribution of the Resource (at tag) of a file"""
+    manifest[file_path]["remote"] = {"id_tag": res_id_tag, "digest": digest}
 
 
 def update_nexus_staging(nexus_ids, forge):
+    digest_manifest = load_digest_manifest(digest_manifest_path)
+    try:
+        _update_nexus_staging(nexus_ids, forge, digest_manifest)
+    finally:
+        save_digest_manifest(digest_manifest, digest_manifest_path)
+
+
+def _update_nexus_staging(nexus_ids, forge, digest_manifest):
     file_nexus_map_path = os.path.join(metadata_dir, file_nexus_id_map)
     with open(file_nexus_map_path) as file_nexus_map_:
         file_nexus_map = json.loads(file_nexus_map_.read().strip())
@@ -184,14 +313,21 @@ def update_nexus_staging(nexus_ids, forge):
                 nexus_id_path = nexus_id_path[step]
             res_id_tag = nexus_id_path[steps[-1]]
 
+            local_digest = file_digest(digest_manifest, prob_map_path)
+            remote = digest_manifest[prob_map_path]["remote"]
+            if remote and remote["id_tag"] == res_id_tag and remote["digest"] == local_digest:
+                print(f"\nFile {prob_map} identical to the distribution of Resource '{res_id_tag}' at the last "
+                      "synchronization, nothing to update")
+                continue
+
             print(f"\nRetrieving Resource for {prob_map} (Nexus id: '{res_id_tag}'")
             res = forge.retrieve(res_id_tag)
             if not res:
                 raise Exception(f"No Resource with id '{res_id_tag}' found in project '{forge._store.bucket}' (Nexus env: '{forge._store.endpoint}')")
-            with open(prob_map_path, "rb") as prob_map_file:
-                if res.distribution.digest.value == hashlib.sha256(prob_map_file.read()).hexdigest():
-                    print(f"Hash of Resource distribution is identical to current file, nothing to update")
-                    continue
+            if res.distribution.digest.value == local_digest:
+                print(f"Hash of Resource distribution is identical to current file, nothing to update")
+                set_remote_digest(digest_manifest, prob_map_path, res_id_tag, local_digest)
+                continue
             print(f"Hash of Resource distribution is different from hash of current file, updating the Resource")
             res.description = prob_map_desc
 
@@ -220,7 +356,9 @@ def update_nexus_staging(nexus_ids, forge):
             file_nexus_map[prob_map] = "/".join([metadata_dir, prob_map_no_ext])
         else:
             print(f"Update tag of Resource at '{nexus_id_key}' in {nexus_ids_path} to '{new_tag}'")
-            nexus_id_path[steps[-1]] = res_id_tag.replace(res_tag, new_tag)
+            res_id_tag = res_id_tag.replace(res_tag, new_tag)
+            nexus_id_path[steps[-1]] = res_id_tag
+        set_remote_digest(digest_manifest, prob_map_path, res_id_tag, file_digest(digest_manifest, prob_map_path))
 
     if len(file_nexus_map_keys):
         print(f"The following elements from {file_nexus_map_path} are not found in {metadata_dir}: {', '.join(file_nexus_map_keys)}")
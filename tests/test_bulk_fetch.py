@@ -0,0 +1,73 @@
+import os
+import shutil
+import threading
+from types import SimpleNamespace
+
+from bulk_fetch import fetch_datasets
+from dataset_cache import DatasetCache
+
+
+class FakeForge:
+    """Forge of the Resources of a remote directory, whose files are named after their id"""
+
+    def __init__(self, remote, downloaded):
+        self.remote = remote
+        self.downloaded = downloaded
+        self.thread = threading.get_ident()
+
+    def retrieve(self, res_id, version=None):
+        if not os.path.exists(os.path.join(self.remote, res_id)):
+            return None
+        distribution = SimpleNamespace(name=f"{res_id}.nrrd", contentUrl=res_id,
+            digest=SimpleNamespace(algorithm="SHA-256", value=f"digest_{res_id}"))
+        if res_id == "several":
+            distribution = [distribution, distribution]
+        return SimpleNamespace(id=res_id, _store_metadata=SimpleNamespace(_rev=1), distribution=distribution)
+
+    def download(self, res, follow, path, overwrite=False):
+        # a forge is only used by the thread which built it
+        assert threading.get_ident() == self.thread
+        self.downloaded.append(res.id)
+        shutil.copyfile(os.path.join(self.remote, res.distribution.contentUrl),
+                        os.path.join(path, res.distribution.name))
+
+
+def test_fetch_datasets(tmp_path):
+    contents = {"gene_gad": "gad", "gene_nrn1": "nrn1", "several": "several"}
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    for (res_id, content) in contents.items():
+        (remote / res_id).write_text(content)
+    downloaded = []
+    forges = []
+
+    def create_forge():
+        forges.append(FakeForge(str(remote), downloaded))
+        return forges[-1]
+
+    def manifest(working_dir):
+        return [{"rule": f"fetch_{name}", "nexus_id": f"{name}?tag=v1", "output": str(working_dir / f"{name}.nrrd")}
+                for name in ["gene_gad", "gene_nrn1", "missing", "several"]]
+
+    messages = []
+    failed = fetch_datasets(create_forge, manifest(tmp_path / "run_1"), connections=2, log=messages.append)
+    assert failed == ["fetch_missing", "fetch_several"]
+    assert "2/4 datasets fetched" in messages
+    assert any("[fetch_missing] Error when fetching missing?tag=v1" in message for message in messages)
+    assert any("[fetch_several] Error when fetching several?tag=v1" in message for message in messages)
+    with open(tmp_path / "run_1" / "gene_nrn1.nrrd") as f:
+        assert f.read() == "nrn1"
+    # one forge per worker thread, not per dataset
+    assert 1 <= len(forges) <= 2
+    # nothing is left in the output directory but the fetched files
+    assert sorted(os.listdir(tmp_path / "run_1")) == ["gene_gad.nrrd", "gene_nrn1.nrrd"]
+
+    # with a dataset cache, a second working directory does not download the datasets again
+    downloaded.clear()
+    cache = DatasetCache(str(tmp_path / "cache"), max_size=1024)
+    for run in ["run_2", "run_3"]:
+        fetch_datasets(create_forge, manifest(tmp_path / run), connections=2, cache=cache, log=messages.append)
+        with open(tmp_path / run / "gene_gad.nrrd") as f:
+            assert f.read() == "gad"
+    assert sorted(downloaded) == ["gene_gad", "gene_nrn1"]
+    assert any("[fetch_gene_gad] gene_gad?tag=v1 found in the cache" in message for message in messages)
@@ -0,0 +1,236 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+from voxcell import RegionMap, VoxelData
+import cellCompSummary_payload
+from types import SimpleNamespace
+from cellCompSummary_payload import (create_summary, AnnotationIndex, SummaryCache,
+    DensityResolver, materialize_density_distribution)
+from nrrd_volume import NrrdVolume, load_volume
+
+region_url_base = "http://api.brain-map.org/api/v2/data/Structure/"
+hierarchy = {"id": 1, "acronym": "root", "name": "root", "children": [
+    {"id": 2, "acronym": "A", "name": "region A", "children": []},
+    {"id": 3, "acronym": "B", "name": "region B", "children": []},
+    {"id": 4, "acronym": "C", "name": "region C", "children": []}]}
+
+
+def test_create_summary(tmp_path):
+    rng = np.random.default_rng(0)
+    region_map = RegionMap.from_dict(hierarchy)
+    annotation = VoxelData(rng.choice([0, 2, 3], size=(12, 10, 8)).astype(np.uint32), (25.0, 25.0, 25.0))
+
+    rows = []
+    for (i, encoding) in enumerate(["raw", "gzip"]):
+        density = rng.random(annotation.shape, dtype=np.float32) * 1e5
+        density[annotation.raw == 3] = 0
+        path = str(tmp_path / f"density_{i}.nrrd")
+        annotation.with_data(density).save_nrrd(path, encoding=encoding)
+        rows.append({"mtype": "L1_DAC", "mtype_url": "http://uri/L1_DAC",
+                     "etype": f"etype_{i}", "etype_url": f"http://uri/etype_{i}", "path": path})
+    density_distribution = pd.DataFrame(rows)
+
+    summary = create_summary(density_distribution, region_map, annotation)
+
+    # region B has a null density, region C has no voxel
+    assert list(summary["hasPart"]) == [f"{region_url_base}2"]
+    region_part = summary["hasPart"][f"{region_url_base}2"]
+    assert (region_part["label"], region_part["notation"]) == ("region A", "A")
+    etypes_part = region_part["hasPart"]["http://uri/L1_DAC"]["hasPart"]
+    for row in rows:
+        density = load_volume(row["path"])
+        region_mask = annotation.raw == 2
+        total = density[region_mask].astype(float).sum()
+        neuron = etypes_part[row["etype_url"]]["composition"]["neuron"]
+        assert np.isclose(neuron["density"], total / region_mask.sum())
+        assert neuron["count"] == int(np.round(total * annotation.voxel_volume * 1e-9))
+
+    assert create_summary(density_distribution, region_map, annotation, processes=2) == summary
+
+    # the annotation read by chunks
+    annotation_path = str(tmp_path / "annotation.nrrd")
+    annotation.save_nrrd(annotation_path)
+    chunked_summary = create_summary(density_distribution, region_map, NrrdVolume(annotation_path))
+    assert chunked_summary == summary
+
+
+test_data = os.path.join(os.path.dirname(__file__), "data")
+# golden CellCompositionSummary of golden_summary_inputs, computed by
+# blue_cwl.statistics.atlas_densities_composition_summary (blue-cwl 1.0.0)
+golden_summary_path = os.path.join(test_data, "cellCompositionSummary_golden.json")
+
+
+def golden_summary_inputs(tmp_path):
+    """A block of the leaves-only annotation, with two deterministic densities (raw and gzip encoded)"""
+    region_map = RegionMap.load_json(os.path.join(test_data, "hierarchy_leaves_only.json"))
+    annotation = VoxelData.load_nrrd(os.path.join(test_data, "annotation_leaves_only.nrrd"))
+    annotation = annotation.with_data(np.ascontiguousarray(annotation.raw[200:328, 100:228, 100:228]))
+
+    rows = []
+    voxel_index = np.arange(annotation.raw.size, dtype=np.int64).reshape(annotation.shape)
+    for (i, encoding) in enumerate(["raw", "gzip"]):
+        density = ((voxel_index * (2654435761 + i)) % 100003).astype(np.float32) * np.float32(1.7)
+        # regions with a null density are not in the summary
+        density[np.isin(annotation.raw, np.unique(annotation.raw)[i::7])] = 0
+        path = str(tmp_path / f"density_{i}.nrrd")
+        annotation.with_data(density).save_nrrd(path, encoding=encoding)
+        rows.append({"mtype": f"mtype_{i}", "mtype_url": f"http://uri/mtype_{i}",
+                     "etype": "etype", "etype_url": "http://uri/etype", "path": path})
+    return pd.DataFrame(rows), region_map, annotation
+
+
+def test_create_summary_golden(tmp_path):
+    """
+    The summary matches the blue_cwl one: same regions, M-types, E-types and counts, and the same
+    densities up to a relative tolerance of 1e-12, the sums being accumulated in another order.
+    """
+    density_distribution, region_map, annotation = golden_summary_inputs(tmp_path)
+    with open(golden_summary_path) as golden_file:
+        golden = json.load(golden_file)
+
+    annotation_path = str(tmp_path / "annotation.nrrd")
+    annotation.save_nrrd(annotation_path)
+    for summary in [create_summary(density_distribution, region_map, annotation),
+                    create_summary(density_distribution, region_map, NrrdVolume(annotation_path), processes=2)]:
+        assert summary.keys() == golden.keys()
+        assert summary["hasPart"].keys() == golden["hasPart"].keys()
+        for (region_url, region_part) in golden["hasPart"].items():
+            assert {k: v for k, v in summary["hasPart"][region_url].items() if k != "hasPart"} == \
+                {k: v for k, v in region_part.items() if k != "hasPart"}
+            for (mtype_url, mtype_part) in region_part["hasPart"].items():
+                etypes_part = summary["hasPart"][region_url]["hasPart"][mtype_url]["hasPart"]
+                assert etypes_part.keys() == mtype_part["hasPart"].keys()
+                for (etype_url, etype_part) in mtype_part["hasPart"].items():
+                    neuron = etypes_part[etype_url]["composition"]["neuron"]
+                    golden_neuron = etype_part["composition"]["neuron"]
+                    assert neuron["count"] == golden_neuron["count"]
+                    assert np.isclose(neuron["density"], golden_neuron["density"], rtol=1e-12, atol=0)
+
+
+def test_create_summary_cache(tmp_path, monkeypatch):
+    rng = np.random.default_rng(3)
+    region_map = RegionMap.from_dict(hierarchy)
+    annotation = VoxelData(rng.choice([0, 2, 3, 4], size=(8, 6, 4)).astype(np.uint32), (25.0, 25.0, 25.0))
+    annotation_path = str(tmp_path / "annotation.nrrd")
+    annotation.save_nrrd(annotation_path)
+    hierarchy_path = tmp_path / "hierarchy.json"
+    hierarchy_path.write_text(json.dumps(hierarchy))
+
+    rows = []
+    for i in range(2):
+        path = str(tmp_path / f"density_{i}.nrrd")
+        annotation.with_data(rng.random(annotation.shape, dtype=np.float32) * 1e5).save_nrrd(path)
+        rows.append({"mtype": "L1_DAC", "mtype_url": "http://uri/L1_DAC",
+                     "etype": f"etype_{i}", "etype_url": f"http://uri/etype_{i}", "path": path})
+    density_distribution = pd.DataFrame(rows)
+    cache_dir = str(tmp_path / "cache")
+
+    summary = create_summary(density_distribution, region_map, annotation,
+                             cache=SummaryCache(cache_dir, annotation_path, str(hierarchy_path)))
+
+    # every density is in the cache, the annotation is not even indexed
+    def no_index(annotation):
+        raise AssertionError("The statistics should be read from the cache")
+    with monkeypatch.context() as m:
+        m.setattr(cellCompSummary_payload, "AnnotationIndex", no_index)
+        assert create_summary(density_distribution, region_map, annotation,
+            cache=SummaryCache(cache_dir, annotation_path, str(hierarchy_path))) == summary
+
+    # a changed density is computed again
+    annotation.with_data(np.zeros(annotation.shape, dtype=np.float32)).save_nrrd(rows[1]["path"])
+    summary_updated = create_summary(density_distribution, region_map, annotation,
+                                     cache=SummaryCache(cache_dir, annotation_path, str(hierarchy_path)))
+    assert summary_updated == create_summary(density_distribution, region_map, annotation)
+    assert summary_updated != summary
+
+
+class DownloadForge:
+    """Forge serving the distributions of densities from a local directory"""
+
+    def __init__(self, files):
+        self.files = files
+        self.downloads = []
+
+    def retrieve(self, density_id, version=None):
+        return SimpleNamespace(id=density_id, distribution=SimpleNamespace(
+            name=os.path.basename(self.files[density_id]), digest=SimpleNamespace(value=f"digest_{density_id}")))
+
+    def download(self, resource, follow, path, overwrite=False):
+        self.downloads.append(resource.id)
+        shutil.copy(self.files[resource.id], os.path.join(path, resource.distribution.name))
+
+
+def test_materialize_density_distribution(tmp_path):
+    files = {}
+    for name in ["pushed", "remote_1", "remote_2", "remote_3"]:
+        files[name] = str(tmp_path / f"{name}.nrrd")
+        with open(files[name], "wb") as density_file:
+            density_file.write(bytes(100))
+    manifest_path = tmp_path / "manifest.json"
+    manifest_path.write_text(json.dumps({files["pushed"]: {"@id": "pushed", "_rev": 2}}))
+
+    volume_dict = {"hasPart": [
+        {"@id": "http://uri/L1_DAC", "label": "L1_DAC", "hasPart": [
+            {"@id": f"http://uri/etype_{i}", "label": f"etype_{i}", "hasPart": [{"@id": density_id, "_rev": 2}]}
+            for i, density_id in enumerate(["pushed", "remote_1", "remote_2"])]}]}
+    forge = DownloadForge(files)
+    cache_dir = str(tmp_path / "cache")
+
+    # the cache only holds one download, but the densities of a summary are never evicted
+    resolver = DensityResolver(push_manifest=str(manifest_path), cache_dir=cache_dir, cache_size=150,
+                               forge_factory=lambda: forge)
+    density_distribution = materialize_density_distribution(volume_dict, resolver)
+    assert list(density_distribution.columns) == ["mtype", "etype", "mtype_url", "etype_url", "path"]
+    assert density_distribution["path"].iloc[0] == files["pushed"]
+    assert forge.downloads == ["remote_1", "remote_2"]
+    assert all(os.path.isfile(path) for path in density_distribution["path"])
+
+    # the least recently used download is evicted, the other one is reused
+    resolver = DensityResolver(cache_dir=cache_dir, cache_size=150, forge_factory=lambda: forge)
+    resolver.resolve("remote_2", 2)
+    resolver.resolve("remote_3", 2)
+    assert forge.downloads == ["remote_1", "remote_2", "remote_3"]
+    assert len(os.listdir(cache_dir)) == 2
+    resolver.resolve("remote_1", 2)
+    assert forge.downloads == ["remote_1", "remote_2", "remote_3", "remote_1"]
+
+    # a local file with the digest of the distribution is used without downloading
+    resolver = DensityResolver(digest_index={"digest_remote_1": files["remote_1"]}, cache_dir=str(tmp_path / "other"),
+                               forge_factory=lambda: forge)
+    assert resolver.resolve("remote_1", 2) == files["remote_1"]
+    assert forge.downloads == ["remote_1", "remote_2", "remote_3", "remote_1"]
+
+
+def test_annotation_index_memory_order():
+    rng = np.random.default_rng(1)
+    raw = rng.choice([0, 2, 3, 4], size=(6, 5, 4)).astype(np.uint32)
+    annotation_index = AnnotationIndex(VoxelData(np.asfortranarray(raw), (10.0, 10.0, 10.0)))
+    values = rng.random(raw.shape)
+
+    sums_c = annotation_index.region_sums(np.ascontiguousarray(values))
+    sums_f = annotation_index.region_sums(np.asfortranarray(values))
+    assert np.array_equal(sums_c, sums_f)
+    assert np.allclose(annotation_index.region_sums(values, chunk_voxels=7), sums_c)
+    for (label, label_sum, count) in zip(annotation_index.labels, sums_c, annotation_index.voxel_counts):
+        assert np.isclose(label_sum, values[raw == label].sum())
+        assert count == (raw == label).sum()
+
+
+def test_annotation_index_shared_memory():
+    rng = np.random.default_rng(2)
+    raw = rng.choice([0, 2, 3, 4], size=(6, 5, 4)).astype(np.uint32)
+    annotation_index = AnnotationIndex(VoxelData(raw, (10.0, 10.0, 10.0)))
+    values = np.asfortranarray(rng.random(raw.shape))
+
+    shm, description = annotation_index.to_shared_memory()
+    try:
+        shared_index = AnnotationIndex.from_shared_memory(description)
+        assert np.array_equal(shared_index.labels, annotation_index.labels)
+        assert np.array_equal(shared_index.region_sums(values), annotation_index.region_sums(values))
+        shared_index._shm.close()
+    finally:
+        shm.close()
+        shm.unlink()
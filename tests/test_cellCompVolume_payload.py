@@ -2,7 +2,9 @@ import os
 import logging
 
 from kgforge.core import KnowledgeGraphForge
-from cellCompVolume_payload import create_payload
+import json
+from cellCompVolume_payload import create_payload, create_payload_from_manifest, create_push_manifest
+from nexus_tag_client import NexusTagClient
 
 from blue_cwl.validation import validate_schema
 
@@ -25,8 +27,89 @@ def test_cellCompVolume_payload():
     forge = KnowledgeGraphForge(forge_config, bucket=bucket, endpoint=nexus_env, token=nexus_token)
                        
     output_file = os.path.join(test_folder, "cellCompositionVolume_payload.json")
-    payload = create_payload(forge, atlasrelease_id, output_file, expected_densities,
+    client = NexusTagClient(nexus_env, bucket, nexus_token)
+    payload = create_payload(forge, client, atlasrelease_id, output_file, expected_densities,
         endpoint=nexus_env, bucket=bucket, tag=tag)
     L.info("Test output: %s" % output_file)
 
     validate_schema(data=payload, schema_name="cell_composition_volume_distribution.yml")
+
+
+def test_cellCompVolume_payload_from_manifest(tmp_path):
+    def manifest_entry(density_id, mtype, etype):
+        return {"@id": density_id, "@type": ["METypeDensity", "NeuronDensity", "VolumetricDataLayer"], "_rev": 3,
+                "mtype": {"@id": f"https://bbp.epfl.ch/ontologies/core/bmo/{mtype}", "label": mtype},
+                "etype": {"@id": f"https://bbp.epfl.ch/ontologies/core/bmo/{etype}", "label": etype}}
+
+    densities_dirs = [tmp_path / "excitatory", tmp_path / "inhibitory"]
+    manifest = {}
+    for (densities_dir, mtype, etype) in zip(densities_dirs, ["L2_IPC", "L1_DAC"], ["cADpyr", "bNAC"]):
+        densities_dir.mkdir()
+        density_file = densities_dir / f"{mtype}_{etype}_densities.nrrd"
+        density_file.touch()
+        manifest[str(density_file)] = manifest_entry(f"{mtype}_{etype}", mtype, etype)
+    for excInh in ["Excitatory", "Inhibitory"]:
+        manifest[str(tmp_path / f"generic_{excInh}.nrrd")] = manifest_entry(
+            f"Generic{excInh}", f"Generic{excInh}NeuronMType", f"Generic{excInh}NeuronEType")
+    manifest_path = tmp_path / "manifest.json"
+    with open(manifest_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    output_file = str(tmp_path / "cellCompositionVolume_payload.json")
+    payload = create_payload_from_manifest([str(d) for d in densities_dirs], str(manifest_path), output_file)
+
+    assert len(payload["hasPart"]) == 4
+    densities = [res for m in payload["hasPart"] for e in m["hasPart"] for res in e["hasPart"]]
+    assert sorted(res["@id"] for res in densities) == sorted(entry["@id"] for entry in manifest.values())
+    validate_schema(data=payload, schema_name="cell_composition_volume_distribution.yml")
+
+
+def test_create_push_manifest(tmp_path):
+    def annotation(type_name, label):
+        return {"hasBody": {"@id": f"https://bbp.epfl.ch/ontologies/core/bmo/{label}", "@type": [type_name],
+                            "label": label}}
+
+    def resource(density_id, mtype, etype, name):
+        return {"@id": density_id, "@type": ["METypeDensity", "VolumetricDataLayer"], "_rev": 2,
+                "annotation": [annotation("MType", mtype), annotation("EType", etype)],
+                "distribution": {"name": name}}
+
+    densities_dir = tmp_path / "densities"
+    densities_dir.mkdir()
+    resources = {}
+    for (mtype, etype) in [("L2_IPC", "cADpyr"), ("L1_DAC", "bNAC"),
+                           ("GenericExcitatoryNeuronMType", "GenericExcitatoryNeuronEType")]:
+        (densities_dir / f"{mtype}_{etype}_densities.nrrd").touch()
+        density_id = f"https://bbp.epfl.ch/data/bbp/atlas/{mtype}_{etype}"
+        resources[density_id] = resource(density_id, mtype, etype, f"{mtype}_{etype}_densities.nrrd")
+    # pushed previously, without local file
+    generic_id = "https://bbp.epfl.ch/data/bbp/atlas/GenericInhibitory"
+    resources[generic_id] = resource(generic_id, "GenericInhibitoryNeuronMType", "GenericInhibitoryNeuronEType",
+        "generic_inhibitory.nrrd")
+    atlas_release_id = "https://bbp.epfl.ch/data/bbp/atlas/atlas_release"
+    resources[atlas_release_id] = {"@id": atlas_release_id, "@type": "AtlasRelease", "_rev": 1}
+
+    push_log = tmp_path / "push.log"
+    push_log.write_text(f"INFO Atlas release: {atlas_release_id}\n" + "".join(
+        f"INFO Registered Resource {density_id} (https://nexus/files/bbp/atlas/{density_id[-6:]}).\n"
+        for density_id in resources if density_id != atlas_release_id) + "INFO Not pushed: https://unknown\n")
+
+    class FakeClient:
+        endpoint = "https://nexus"
+
+        def retrieve_tagged(self, ids, tag=None, workers=None):
+            assert tag == "v1"
+            assert "https://nexus/files/bbp/atlas/L2_IPC" not in ids
+            return [resources[res_id] for res_id in ids if res_id in resources]
+
+    manifest_path = str(tmp_path / "manifest.json")
+    manifest = create_push_manifest(FakeClient(), str(push_log), [str(densities_dir)], manifest_path, tag="v1")
+    assert len(manifest) == 4
+    local_file = str((densities_dir / "L2_IPC_cADpyr_densities.nrrd").resolve())
+    assert manifest[local_file]["@id"] == "https://bbp.epfl.ch/data/bbp/atlas/L2_IPC_cADpyr"
+    assert manifest[local_file]["_rev"] == 2
+    assert manifest[generic_id]["mtype"]["label"] == "GenericInhibitoryNeuronMType"
+
+    payload = create_payload_from_manifest([str(densities_dir)], manifest_path, str(tmp_path / "payload.json"))
+    densities = [res["@id"] for m in payload["hasPart"] for e in m["hasPart"] for res in e["hasPart"]]
+    assert sorted(densities) == sorted(density_id for density_id in resources if density_id != atlas_release_id)
@@ -4,7 +4,8 @@ import numpy as np
 
 from voxcell import RegionMap, VoxelData
 from customize_pipeline.customize_pipeline import (merge_nrrd_files, get_region_id,
-    check_rule_existence, get_var_path_map)
+    check_rule_existence, get_var_path_map, get_region_voxel_indices, crop_region_inputs,
+    load_crop_offset)
 
 
 def test_merge_nrrd_files():
@@ -44,6 +45,81 @@ def test_merge_nrrd_files():
     assert np.array_equal(result, expected_volume)
 
 
+
+def test_merge_nrrd_files_parallel(tmp_path):
+    test_folder = os.environ["TEST_FOLDER"]
+    test_data = os.path.join(test_folder, "data")
+
+    region_map = RegionMap.load_json(os.path.join(test_data, "hierarchy_leaves_only.json"))
+    annotation = VoxelData.load_nrrd(os.path.join(test_data, "annotation_leaves_only.nrrd")).raw
+    region_volume_map = {
+        315: os.path.join(test_data, "output_315"),
+        549: os.path.join(test_data, "output_549"),
+    }
+
+    # all the nrrd files of the data directory are merged, only output.nrrd exists in the region dirs
+    serial_results = merge_nrrd_files(region_map, annotation, region_volume_map,
+                                      test_data, str(tmp_path / "serial"))
+    parallel_results = merge_nrrd_files(region_map, annotation, region_volume_map,
+                                        test_data, str(tmp_path / "parallel"), max_workers=2)
+
+    assert len(parallel_results) == len(serial_results) > 1
+    for (serial_result, parallel_result) in zip(serial_results, parallel_results):
+        assert os.path.basename(serial_result) == os.path.basename(parallel_result)
+        assert np.array_equal(VoxelData.load_nrrd(serial_result).raw,
+                              VoxelData.load_nrrd(parallel_result).raw)
+
+
+def test_merge_nrrd_files_cropped(tmp_path):
+    test_folder = os.environ["TEST_FOLDER"]
+    test_data = os.path.join(test_folder, "data")
+
+    hierarchy_file = os.path.join(test_data, "hierarchy_leaves_only.json")
+    annotation_file = os.path.join(test_data, "annotation_leaves_only.nrrd")
+    default_output = os.path.join(test_data, "output.nrrd")
+    region_volume_map = {
+        315: os.path.join(test_data, "output_315"),
+        549: os.path.join(test_data, "output_549"),
+    }
+    region_map = RegionMap.load_json(hierarchy_file)
+    annotation = VoxelData.load_nrrd(annotation_file).raw
+
+    # crop the region outputs as a region rule executed on cropped inputs would produce them
+    cropped_volume_map = {}
+    region_offset_map = {}
+    for (region_id, volume_dir) in region_volume_map.items():
+        crop_dir = tmp_path / f"crop_{region_id}"
+        crop_file = str(crop_dir / "crop.json")
+        crop_region_inputs(hierarchy_file, annotation_file, region_id,
+                           {"output": os.path.join(volume_dir, "output.nrrd"), "hierarchy": hierarchy_file},
+                           {"output": str(crop_dir / "output.nrrd"), "hierarchy": str(crop_dir / "hierarchy.json")},
+                           crop_file, margin=2)
+        cropped_volume_map[region_id] = str(crop_dir)
+        region_offset_map[region_id] = load_crop_offset(crop_file)
+        assert VoxelData.load_nrrd(str(crop_dir / "output.nrrd")).raw.size < annotation.size
+        assert region_id in RegionMap.load_json(str(crop_dir / "hierarchy.json")).find(
+            region_id, "id")
+
+    expected = merge_nrrd_files(region_map, annotation, region_volume_map,
+                                default_output, str(tmp_path / "merged"))
+    result = merge_nrrd_files(region_map, annotation, cropped_volume_map,
+                              default_output, str(tmp_path / "merged_cropped"),
+                              region_offset_map=region_offset_map)
+
+    assert np.array_equal(VoxelData.load_nrrd(result[0]).raw, VoxelData.load_nrrd(expected[0]).raw)
+
+
+def test_get_region_voxel_indices():
+    annotation = np.array([[0, 1, 2], [3, 2, 1]])
+    # the voxels of region {2, 3} overlapping the first region go to the last one listed
+    regions_ids = [{1, 2}, {2, 3}]
+
+    # flat indices in order 'F', whatever the size of the chunks of annotation read
+    for chunk_voxels in [1, 4, 6]:
+        region_indices = get_region_voxel_indices(annotation, regions_ids, chunk_voxels)
+        assert [indices.tolist() for indices in region_indices] == [[2, 5], [1, 3, 4]]
+
+
 def test_get_region_id():
     root_region = "http://api.brain-map.org/api/v2/data/Structure/997"
     region_id = get_region_id(root_region)
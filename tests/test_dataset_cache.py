@@ -0,0 +1,69 @@
+import os
+import time
+from types import SimpleNamespace
+
+from dataset_cache import DatasetCache, cache_key, distribution_digests, split_version
+
+
+def test_cache_key():
+    assert split_version("https://id?tag=v0.1.0") == ("https://id", "v0.1.0")
+    assert split_version("https://id?rev=3") == ("https://id", 3)
+    assert split_version("https://id") == ("https://id", None)
+
+    res = SimpleNamespace(distribution=[
+        SimpleNamespace(digest=SimpleNamespace(algorithm="SHA-256", value="b")),
+        SimpleNamespace(digest=SimpleNamespace(algorithm="SHA-256", value="a"))])
+    digests = distribution_digests(res)
+    assert digests == ["SHA-256:a", "SHA-256:b"]
+    key = cache_key("https://id", 2, digests, ["--verbose"])
+    assert key == cache_key("https://id", 2, digests, ["--verbose"])
+    assert key != cache_key("https://id", 3, digests, ["--verbose"])
+    assert key != cache_key("https://id", 2, digests, ["--verbose", "--favor", "name:1.json"])
+
+
+def test_dataset_cache(tmp_path):
+    cache = DatasetCache(str(tmp_path / "cache"), max_size=25)
+    working_dir = tmp_path / "working_dir"
+    working_dir.mkdir()
+
+    for (i, key) in enumerate(["key_a", "key_b", "key_c"]):
+        output = str(working_dir / f"{key}.nrrd")
+        assert not cache.materialize(key, output)
+        downloaded = os.path.join(cache.mkdtemp(), "file.nrrd")
+        with open(downloaded, "w") as f:
+            f.write(str(i) * 10)
+        cache.store(key, downloaded)
+        # the least recently used file is evicted beyond the budget of 25 bytes
+        assert cache.evict(keep=[key]) == ([cache.entry_path("key_a")] if key == "key_c" else [])
+        assert cache.materialize(key, output)
+        with open(output) as f:
+            assert f.read() == str(i) * 10
+
+    # hardlinked to the cached file, which is read-only
+    assert os.path.samefile(str(working_dir / "key_c.nrrd"), cache.entry_path("key_c"))
+    assert not os.access(cache.entry_path("key_c"), os.W_OK) or os.geteuid() == 0
+    # materialized again in another working directory
+    assert cache.materialize("key_b", str(tmp_path / "key_b.nrrd"))
+    assert not cache.materialize("key_a", str(tmp_path / "key_a.nrrd"))
+
+
+def test_dataset_cache_keeps_outputs_mtime(tmp_path):
+    cache = DatasetCache(str(tmp_path / "cache"), max_size=25)
+    for key in ["key_a", "key_b"]:
+        downloaded = os.path.join(cache.mkdtemp(), "file.nrrd")
+        with open(downloaded, "w") as f:
+            f.write(key * 2)
+        cache.store(key, downloaded)
+
+    first_output = str(tmp_path / "working_dir_1.nrrd")
+    assert cache.materialize("key_a", first_output)
+    # an old output, as seen by snakemake in its working directory
+    os.utime(first_output, (1000000000, 1000000000))
+    time.sleep(0.01)
+    assert cache.materialize("key_a", str(tmp_path / "working_dir_2.nrrd"))
+    assert os.stat(first_output).st_mtime == 1000000000
+
+    # key_a was used last, key_b is evicted first
+    assert cache.last_used("key_a") > cache.last_used("key_b")
+    cache.max_size = 10
+    assert cache.evict() == [cache.entry_path("key_b")]
@@ -0,0 +1,101 @@
+import threading
+
+import pytest
+import requests
+
+from nexus_tag_client import NexusTagClient
+
+endpoint = "https://nexus/v1"
+bucket = "bbp/atlas"
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, content=None):
+        self.status_code = status_code
+        self.content = content
+        self.text = str(content)
+
+    def json(self):
+        return self.content
+
+
+class FakeSession:
+    """
+    Session answering the multi-fetch request with `bulk` (a status code or a list of results),
+    and the requests of a Resource with the successive responses of `responses[id]`
+    (a status code, a payload or a RequestException), the last one being repeated.
+    """
+    sessions = []
+
+    def __init__(self, bulk, responses):
+        self.bulk = bulk
+        self.responses = responses
+        self.requests = []
+        self.headers = {}
+        self.thread = threading.get_ident()
+        FakeSession.sessions.append(self)
+
+    def request(self, method, url, json=None, params=None, timeout=None):
+        # a session is only used by the thread which built it
+        assert threading.get_ident() == self.thread
+        if url == f"{endpoint}/multi-fetch/resources":
+            self.requests.append("bulk")
+            if isinstance(self.bulk, int):
+                return FakeResponse(self.bulk)
+            return FakeResponse(200, {"resources": self.bulk})
+        res_id = next(res_id for res_id in self.responses if url.endswith(requests.utils.quote(res_id, safe="")))
+        assert params == {"tag": "v1"}
+        self.requests.append(res_id)
+        responses = self.responses[res_id]
+        response = responses.pop(0) if len(responses) > 1 else responses[0]
+        if isinstance(response, Exception):
+            raise response
+        if isinstance(response, int):
+            return FakeResponse(response, "error")
+        return FakeResponse(200, response)
+
+
+def client_of(bulk, responses):
+    FakeSession.sessions = []
+    return NexusTagClient(endpoint, bucket, "token", session_factory=lambda: FakeSession(bulk, responses), backoff=0)
+
+
+def payload(res_id):
+    return {"@id": res_id, "@type": "METypeDensity", "_rev": 3}
+
+
+def test_retrieve_tagged_bulk():
+    # the results are keyed by their id, whatever their order
+    bulk = [{"@type": "Error", "id": "https://res/b?tag=v1", "reason": {"@type": "TagNotFound"}},
+            {"@type": "Success", "id": "https://res/a?tag=v1", "value": payload("https://res/a")}]
+    client = client_of(bulk, {})
+    assert client.retrieve_tagged(["https://res/a", "https://res/b"], "v1") == [payload("https://res/a")]
+    assert FakeSession.sessions[0].requests == ["bulk"]
+    assert FakeSession.sessions[0].headers["Authorization"] == "Bearer token"
+
+
+def test_retrieve_tagged_not_tagged():
+    # multi-fetch not available, the Resource without the tag is dropped
+    client = client_of(404, {"https://res/a": [payload("https://res/a")], "https://res/b": [404]})
+    assert client.retrieve_tagged(["https://res/a", "https://res/b"], "v1", workers=2) == [payload("https://res/a")]
+
+
+def test_retrieve_tagged_transient_error():
+    bulk = [{"@type": "Error", "id": "https://res/a?tag=v1", "reason": {"@type": "InternalError"}}]
+    client = client_of(bulk, {"https://res/a": [503, requests.ConnectionError("reset"), payload("https://res/a")]})
+    assert client.retrieve_tagged(["https://res/a"], "v1") == [payload("https://res/a")]
+    assert sum(session.requests.count("https://res/a") for session in FakeSession.sessions) == 3
+
+
+def test_retrieve_tagged_persistent_error():
+    client = client_of(500, {"https://res/a": [payload("https://res/a")], "https://res/b": [503]})
+    with pytest.raises(Exception, match="1 Resources could not be retrieved at tag 'v1'"):
+        client.retrieve_tagged(["https://res/a", "https://res/b"], "v1", workers=2)
+    assert sum(session.requests.count("https://res/b") for session in FakeSession.sessions) == 3
+
+    # a client error is not retried
+    client = client_of(500, {"https://res/b": [403]})
+    with pytest.raises(Exception, match="status 403"):
+        client.retrieve_tagged(["https://res/b"], "v1")
+    assert sum(session.requests.count("https://res/b") for session in FakeSession.sessions) == 1
@@ -0,0 +1,157 @@
+import gzip
+import zlib
+import numpy as np
+import nrrd
+import pytest
+
+from voxcell import VoxelData
+import nrrd_volume
+from nrrd_volume import NrrdVolume, NrrdWriter, iter_voxel_chunks
+
+
+def test_iter_chunks(tmp_path):
+    rng = np.random.default_rng(0)
+    raw = rng.random((7, 6, 5), dtype=np.float32)
+    for encoding in ["raw", "gzip"]:
+        path = str(tmp_path / f"volume_{encoding}.nrrd")
+        VoxelData(raw, (10.0, 10.0, 10.0)).save_nrrd(path, encoding=encoding)
+
+        volume = NrrdVolume(path)
+        assert volume.sizes == raw.shape
+        chunks = list(volume.iter_chunks(chunk_elements=40))
+        assert [chunk.size for chunk in chunks] == [40] * 5 + [10]
+        assert np.array_equal(np.concatenate(chunks), raw.reshape(-1, order="F"))
+        assert np.array_equal(volume.read(), raw)
+
+
+def test_iter_chunks_gzip_members(tmp_path):
+    raw = np.arange(60, dtype=np.int16).reshape((5, 4, 3))
+    path = str(tmp_path / "volume.nrrd")
+    VoxelData(raw, (10.0, 10.0, 10.0)).save_nrrd(path, encoding="raw")
+    volume = NrrdVolume(path)
+
+    # the payload compressed as several concatenated gzip members
+    payload = raw.tobytes(order="F")
+    with open(path, "r+b") as nrrd_file:
+        header = nrrd_file.read(volume.data_offset).replace(b"encoding: raw", b"encoding: gzip")
+        nrrd_file.seek(0)
+        nrrd_file.truncate()
+        nrrd_file.write(header)
+        for start in range(0, len(payload), 50):
+            nrrd_file.write(gzip.compress(payload[start:start + 50]))
+
+    chunks = list(NrrdVolume(path).iter_chunks(chunk_elements=7))
+    assert np.array_equal(np.concatenate(chunks), raw.reshape(-1, order="F"))
+
+
+def test_nrrd_writer(tmp_path):
+    rng = np.random.default_rng(1)
+    raw = rng.random((7, 6, 5))
+    reference = VoxelData(raw, (25.0, 25.0, 25.0), offset=(1.0, 2.0, 3.0))
+    reference_path = str(tmp_path / "reference.nrrd")
+    reference.save_nrrd(reference_path)
+    header = NrrdVolume(reference_path).header
+
+    for encoding in ["raw", "gzip"]:
+        path = str(tmp_path / f"written_{encoding}.nrrd")
+        with NrrdWriter(path, header, np.float32, encoding=encoding) as writer:
+            for chunk in NrrdVolume(reference_path).iter_chunks(chunk_elements=32):
+                writer.write(chunk)
+
+        data, written_header = nrrd.read(path)
+        assert written_header["encoding"] == encoding
+        assert data.dtype == np.float32
+        assert np.array_equal(data, raw.astype(np.float32))
+        written = VoxelData.load_nrrd(path)
+        assert np.allclose(written.offset, reference.offset)
+        assert np.allclose(written.voxel_dimensions, reference.voxel_dimensions)
+
+
+
+def test_write_header(tmp_path):
+    header = {"type": "double", "dimension": 4, "space": "left-posterior-superior", "sizes": np.array([3, 4, 5, 6]),
+        "space directions": np.array([[np.nan] * 3, [10.0, 0, 0], [0, 10.0, 0], [0, 0, 10.0]]),
+        "kinds": ["vector", "domain", "domain", "domain"], "endian": "big", "encoding": "raw",
+        "labels": ["component", "x", "y", "z"], "space origin": np.array([1.5, -2.0, 0.1]), "comment_id": "42"}
+    path = str(tmp_path / "header.nrrd")
+    with open(path, "wb") as nrrd_file:
+        nrrd_volume.write_header(nrrd_file, header)
+    written = nrrd.read_header(path)
+    assert written.keys() == header.keys()
+    for (field, value) in header.items():
+        if isinstance(value, np.ndarray):
+            assert np.array_equal(written[field], value, equal_nan=True)
+        else:
+            assert written[field] == value
+    assert nrrd_volume.nrrd_dtype(written) == np.dtype(">f8")
+    assert nrrd_volume.nrrd_dtype({"type": "unsigned char", "encoding": "gzip"}) == np.dtype("u1")
+
+def test_iter_voxel_chunks_components(tmp_path):
+    rng = np.random.default_rng(2)
+    raw = rng.random((5, 4, 3, 2), dtype=np.float32)
+    path = str(tmp_path / "vectors.nrrd")
+    VoxelData(raw, (10.0, 10.0, 10.0)).save_nrrd(path)
+
+    volume = NrrdVolume(path)
+    assert (volume.shape, volume.n_components, volume.voxel_volume) == ((5, 4, 3), 2, 1000.0)
+    assert np.array_equal(volume.load(), VoxelData.load_nrrd(path).raw)
+    chunks = list(volume.iter_voxel_chunks(chunk_voxels=16))
+    assert [chunk.shape for chunk in chunks] == [(16, 2)] * 3 + [(12, 2)]
+    # the chunks of the file and of the array in memory are the same
+    for (chunk, array_chunk) in zip(chunks, iter_voxel_chunks(raw, chunk_voxels=16)):
+        assert np.array_equal(chunk, array_chunk)
+
+
+def test_nrrd_writer_threads(tmp_path, monkeypatch):
+    # small blocks, so that the payload is deflated in many blocks by the threads
+    monkeypatch.setattr(nrrd_volume, "GZIP_BLOCK_SIZE", 1000)
+    rng = np.random.default_rng(3)
+    raw = rng.integers(0, 50, size=(20, 15, 10)).astype(np.float64)
+    header = {"dimension": 3, "sizes": raw.shape, "space": "left-posterior-superior",
+              "space directions": np.eye(3) * 10.0, "space origin": np.zeros(3)}
+    path = str(tmp_path / "threads.nrrd")
+    with NrrdWriter(path, header, raw.dtype, compression_level=6, threads=3) as writer:
+        for chunk in iter_voxel_chunks(raw, chunk_voxels=700):
+            writer.write(chunk)
+
+    # a single gzip member, as read by pynrrd
+    data, _ = nrrd.read(path)
+    assert np.array_equal(data, raw)
+    with open(path, "rb") as nrrd_file:
+        payload = nrrd_file.read()[NrrdVolume(path).data_offset:]
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    assert decompressor.decompress(payload) == raw.tobytes(order="F")
+    assert decompressor.eof and not decompressor.unused_data
+
+
+def hemispheres_annotation(tmp_path):
+    rng = np.random.default_rng(4)
+    raw = rng.integers(0, 4, size=(6, 5, 7)).astype(np.uint32)
+    path = str(tmp_path / "annotation.nrrd")
+    VoxelData(raw, (10.0, 10.0, 10.0), offset=(1.0, 2.0, 3.0)).save_nrrd(path)
+    return raw, path
+
+
+def test_write_hemispheres(tmp_path):
+    raw, annotation_path = hemispheres_annotation(tmp_path)
+    # left hemisphere in the first 7 // 2 slices of the z axis
+    expected = np.full(raw.shape, 2, dtype=np.uint8)
+    expected[:, :, :3] = 1
+    expected[raw == 0] = 0
+    for encoding in ["raw", "gzip"]:
+        path = str(tmp_path / f"hemispheres_{encoding}.nrrd")
+        # chunks across the boundary of the hemispheres
+        nrrd_volume.write_hemispheres(annotation_path, path, encoding=encoding, chunk_voxels=17)
+        hemispheres = VoxelData.load_nrrd(path)
+        assert hemispheres.raw.dtype == np.uint8
+        assert np.array_equal(hemispheres.raw, expected)
+        assert np.allclose(hemispheres.offset, (1.0, 2.0, 3.0))
+
+
+def test_write_hemispheres_atlas_commons(tmp_path):
+    utils = pytest.importorskip("atlas_commons.utils")
+    _, annotation_path = hemispheres_annotation(tmp_path)
+    path = str(tmp_path / "hemispheres.nrrd")
+    nrrd_volume.write_hemispheres(annotation_path, path, chunk_voxels=17)
+    expected = utils.assign_hemispheres(VoxelData.load_nrrd(annotation_path))
+    assert np.array_equal(VoxelData.load_nrrd(path).raw, expected.raw)
@@ -0,0 +1,49 @@
+import os
+import json
+import time
+import stat
+import base64
+import pytest
+
+import token_broker
+from token_broker import TokenBroker, read_token, token_expiry, write_token_file
+
+
+def make_token(expiry, subject="user"):
+    def encode(content):
+        return base64.urlsafe_b64encode(json.dumps(content).encode()).rstrip(b"=").decode()
+    return ".".join([encode({"alg": "RS256"}), encode({"sub": subject, "exp": expiry}), "signature"])
+
+
+def test_token_file(tmp_path):
+    token_file = str(tmp_path / "token.json")
+    expiry = int(time.time()) + 3600
+    token = make_token(expiry)
+    assert token_expiry(token) == expiry
+
+    write_token_file(token_file, token)
+    assert stat.S_IMODE(os.stat(token_file).st_mode) == 0o600
+    assert read_token(token_file) == token
+
+    write_token_file(token_file, make_token(int(time.time()) - 1))
+    with pytest.raises(Exception, match="expired"):
+        read_token(token_file)
+
+
+def test_token_broker_refresh(tmp_path, monkeypatch):
+    monkeypatch.setattr(token_broker, "RETRY_INTERVAL", 0.05)
+    token_file = str(tmp_path / "token.json")
+    # the first token expires within the refresh margin, so it is refreshed right away
+    first, second = make_token(time.time() + 1, "first"), make_token(time.time() + 3600, "second")
+    current = [first]
+    broker = TokenBroker(lambda: current[0], token_file, refresh_margin=10)
+    broker.start()
+    assert read_token(token_file) == first
+
+    # the token fetcher refreshes its token
+    current[0] = second
+    deadline = time.time() + 5
+    while read_token(token_file) != second and time.time() < deadline:
+        time.sleep(0.05)
+    broker.stop()
+    assert read_token(token_file) == second
@@ -0,0 +1,117 @@
+'''
+Shared Nexus access token of the pipeline jobs.
+
+The snakemake process writes the current access token, with its expiry, to a
+token file readable only by the user, and refreshes it in the background before
+it expires. The jobs read the token from this file when they are executed (and
+not when the workflow is parsed), so that the rules running late in a long
+pipeline get a valid token, without a Keycloak round-trip per rule.
+
+From a shell rule, the token is printed by
+    python token_broker.py <token file>
+
+'''
+
+import os
+import sys
+import json
+import time
+import base64
+import threading
+
+# the token is refreshed this number of seconds before it expires
+REFRESH_MARGIN = 300
+# number of seconds between two attempts to get a refreshed token
+RETRY_INTERVAL = 10
+
+
+def token_expiry(token):
+    """Expiry time (seconds since the epoch) of a JWT, read from its 'exp' claim"""
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"])
+    except (IndexError, KeyError, TypeError, ValueError) as error:
+        raise Exception(f"The expiry of the access token can not be read: {error!r}")
+
+
+def write_token_file(token_file, token):
+    """
+    Write atomically the token and its expiry to token_file,
+    which is only readable and writable by the user.
+    """
+    tmp_path = f"{token_file}.{os.getpid()}.tmp"
+    file_descriptor = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(file_descriptor, "w") as tmp_file:
+        json.dump({"access_token": token, "expires_at": token_expiry(token)}, tmp_file)
+    os.replace(tmp_path, token_file)
+
+
+def read_token(token_file):
+    """Access token of token_file, which must not be expired"""
+    if not os.path.isfile(token_file):
+        raise Exception(f"The token file {token_file} does not exist, it is written when the "
+                        "pipeline starts (not in a dry-run)")
+    with open(token_file) as token_json:
+        content = json.load(token_json)
+    if content["expires_at"] <= time.time():
+        raise Exception(f"The access token of {token_file} expired at "
+                        f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(content['expires_at']))}")
+    return content["access_token"]
+
+
+class TokenBroker:
+    """
+    Keep an up-to-date access token in a token file.
+
+    Args:
+        get_token: function returning the current access token (e.g. the
+            get_access_token method of a blue_brain_token_fetch token fetcher)
+        token_file: path of the token file
+        refresh_margin: the token is refreshed this number of seconds before it expires
+    """
+
+    def __init__(self, get_token, token_file, refresh_margin=REFRESH_MARGIN):
+        self.get_token = get_token
+        self.token_file = token_file
+        self.refresh_margin = refresh_margin
+        self.token = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        """Get the current token and write it to the token file if it changed"""
+        token = self.get_token()
+        if token != self.token:
+            write_token_file(self.token_file, token)
+            self.token = token
+        return token_expiry(token)
+
+    def start(self):
+        """Write the token file and start refreshing it in the background"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.token_file)), exist_ok=True)
+        expiry = self.refresh()
+        self._thread = threading.Thread(target=self._refresh_loop, args=(expiry,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _refresh_loop(self, expiry):
+        while not self._stop.wait(max(expiry - self.refresh_margin - time.time(), 0)):
+            try:
+                new_expiry = self.refresh()
+            except Exception as error:
+                print(f"The access token could not be refreshed: {error!r}")
+                new_expiry = expiry
+            if new_expiry == expiry:
+                # the token fetcher has not refreshed the token yet
+                if self._stop.wait(RETRY_INTERVAL):
+                    break
+            expiry = new_expiry
+
+
+if __name__ == "__main__":
+    print(read_token(sys.argv[1]))